@@ -1,110 +1,80 @@
-import base64
 import json
+import mimetypes
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import threading
+import time
 
 import requests as http_requests
 from dotenv import load_dotenv
-from flask import Flask, Response, jsonify, render_template, request
+from flask import Flask, Response, jsonify, render_template, request, send_file
 
+# Before the local imports: they read their ARCADE_* settings at import time
+load_dotenv()
+
+import metrics
+import ratelimit
+import retry
+import singleflight
+from batch import DEFAULT_CONCURRENCY, batch_output_path, get_batch, start_batch
+from bookmarks import bookmark_store
+from cache import cache_key, cache_ttl, response_cache
+from catalog import send_encoded
+from deadlines import Cancellation, deadline_for, declared_timeout, timeout_for, watch_disconnect
+from history import history
+from jobs import ensure_job, get_job, subscribe_job
+from keycheck import key_checker
+from media import (
+    STORE_NAME_RE,
+    get_media,
+    media_store,
+    replace_strings,
+    start_passthrough,
+    store_base64_outputs,
+    stored_media_present,
+)
 from proxy import (
     build_auth_headers,
+    build_cancel_url,
     build_curl_string,
     build_request,
     build_result_url,
     build_status_url,
     check_done,
+    compile_path,
     extract_error,
     extract_outputs,
     extract_value,
 )
-
-load_dotenv()
+from registry import Registry
+from streaming import COALESCE_BYTES, COALESCE_MS, StreamTimer, TokenCoalescer, active_streams, open_stream
+from upstream import pool_stats, session_for
 
 app = Flask(__name__)
 
 # ---------------------------------------------------------------------------
-# API key config from .env
+# Definitions and API keys (definitions/ and .env, hot-reloaded)
 # ---------------------------------------------------------------------------
 
-API_KEYS = {}
-
-# ---------------------------------------------------------------------------
-# Definition loading
-# ---------------------------------------------------------------------------
-
-DEFINITIONS = {}
-PROVIDER_DISPLAY_NAMES = {}
-
-
-def load_definitions():
-    """Walk the definitions/ folder, load all JSON files, and collect API keys."""
-    defs_dir = os.path.join(os.path.dirname(__file__), "definitions")
-    for root, _dirs, files in os.walk(defs_dir):
-        for fname in files:
-            if not fname.endswith(".json"):
-                continue
-            path = os.path.join(root, fname)
-            try:
-                with open(path) as f:
-                    defn = json.load(f)
-                DEFINITIONS[defn["id"]] = defn
-            except (json.JSONDecodeError, KeyError, OSError) as e:
-                print(f"WARNING: skipping {path}: {e}")
-                continue
-
-            # Collect provider display name from definition
-            provider = defn.get("provider", "")
-            if provider and provider not in PROVIDER_DISPLAY_NAMES:
-                PROVIDER_DISPLAY_NAMES[provider] = defn.get(
-                    "provider_display_name", provider.title()
-                )
-
-            # Load API key from auth.env_key (if not already loaded for this provider)
-            env_key = defn.get("auth", {}).get("env_key", "")
-            if provider and env_key and provider not in API_KEYS:
-                val = os.getenv(env_key, "")
-                if val:
-                    API_KEYS[provider] = val
-
-
-load_definitions()
+registry = Registry()
+registry.reload()
+registry.start_watcher()
 
 # ---------------------------------------------------------------------------
 # Routes — Pages
 # ---------------------------------------------------------------------------
 
 
-def provider_display_name(slug):
-    """Return display name for a provider slug, falling back to title case."""
-    return PROVIDER_DISPLAY_NAMES.get(slug, slug.title())
-
-
 @app.route("/")
 def index():
-    """Render the main playground page."""
-    definitions_list = []
-    for d in DEFINITIONS.values():
-        model_param = next(
-            (p for p in d.get("request", {}).get("params", []) if p.get("name") == "model"),
-            None,
-        )
-        model_count = len(model_param.get("options", [])) if model_param else 0
-        definitions_list.append({
-            "id": d["id"],
-            "name": d["name"],
-            "provider": d["provider"],
-            "provider_display_name": provider_display_name(d["provider"]),
-            "provider_url": d.get("provider_url", ""),
-            "output_type": d.get("response", {}).get("outputs", [{}])[0].get("type", "text"),
-            "model_count": model_count,
-        })
-    definitions_list.sort(key=lambda d: d["name"])
-    return render_template(
+    """Render the main playground page (rendered once per catalog, then revalidated by ETag)."""
+    catalog = registry.snapshot.catalog
+    page = catalog.page(lambda: render_template(
         "index.html",
-        definitions=definitions_list,
-        api_keys=list(API_KEYS.keys()),
-    )
+        definitions=catalog.entries,
+        api_keys=catalog.providers_with_keys,
+    ))
+    return send_encoded(page, request)
 
 
 # ---------------------------------------------------------------------------
@@ -114,30 +84,54 @@ def index():
 
 def get_api_key(definition_id):
     """Look up the API key for a definition's provider, server-side."""
-    defn = DEFINITIONS.get(definition_id)
+    snapshot = registry.snapshot
+    defn = snapshot.definitions.get(definition_id)
     if not defn:
         return None, None
-    return defn, API_KEYS.get(defn["provider"], "")
-
-
-BOOKMARKS_FILE = os.path.join(os.path.dirname(__file__), "bookmarks.json")
+    return defn, snapshot.api_keys.get(defn["provider"], "")
 
 
 @app.route("/api/bookmarks")
 def get_bookmarks():
-    """Return saved bookmarks."""
-    if not os.path.exists(BOOKMARKS_FILE):
-        return jsonify([])
-    with open(BOOKMARKS_FILE) as f:
-        return jsonify(json.load(f))
+    """Return saved bookmarks, optionally only those using ?definition_id=."""
+    return jsonify(bookmark_store.list(request.args.get("definition_id")))
 
 
 @app.route("/api/bookmarks", methods=["POST"])
-def save_bookmarks():
-    """Overwrite the full bookmarks array."""
-    data = request.get_json()
-    with open(BOOKMARKS_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+def create_bookmark():
+    """Save one bookmark (an object), or overwrite all of them (an array, the old format)."""
+    data = request.get_json(silent=True)
+    if isinstance(data, list) and all(isinstance(b, dict) for b in data):
+        return jsonify(bookmark_store.replace_all(data))
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a bookmark object"}), 400
+    return jsonify(bookmark_store.create(data)), 201
+
+
+@app.route("/api/bookmarks/<int:bookmark_id>")
+def get_bookmark(bookmark_id):
+    bookmark = bookmark_store.get(bookmark_id)
+    if not bookmark:
+        return jsonify({"error": "Bookmark not found"}), 404
+    return jsonify(bookmark)
+
+
+@app.route("/api/bookmarks/<int:bookmark_id>", methods=["PUT"])
+def update_bookmark(bookmark_id):
+    """Replace one bookmark's saved state."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a bookmark object"}), 400
+    bookmark = bookmark_store.update(bookmark_id, data)
+    if not bookmark:
+        return jsonify({"error": "Bookmark not found"}), 404
+    return jsonify(bookmark)
+
+
+@app.route("/api/bookmarks/<int:bookmark_id>", methods=["DELETE"])
+def delete_bookmark(bookmark_id):
+    if not bookmark_store.delete(bookmark_id):
+        return jsonify({"error": "Bookmark not found"}), 404
     return jsonify({"ok": True})
 
 
@@ -149,13 +143,14 @@ def preview():
     params = data.get("params", {})
     include_key = data.get("include_key", False)
 
-    defn = DEFINITIONS.get(definition_id)
+    snapshot = registry.snapshot
+    defn = snapshot.definitions.get(definition_id)
     if not defn:
         return jsonify({"error": f"Definition '{definition_id}' not found"}), 404
 
     api_key = None
     if include_key:
-        _, api_key = get_api_key(definition_id)
+        api_key = snapshot.api_keys.get(defn["provider"])
 
     try:
         curl = build_curl_string(defn, params, api_key=api_key or None)
@@ -165,13 +160,19 @@ def preview():
     return jsonify({"curl": curl})
 
 
+@app.route("/api/definitions")
+def get_catalog():
+    """Return the palette catalog: one summary row per definition."""
+    return send_encoded(registry.snapshot.catalog.catalog_body, request)
+
+
 @app.route("/api/definitions/<definition_id>")
 def get_definition(definition_id):
     """Return the full definition JSON for client-side use."""
-    defn = DEFINITIONS.get(definition_id)
-    if not defn:
+    body = registry.snapshot.catalog.definition_body(definition_id)
+    if not body:
         return jsonify({"error": f"Definition '{definition_id}' not found"}), 404
-    return jsonify(defn)
+    return send_encoded(body, request)
 
 
 @app.route("/api/generate", methods=["POST"])
@@ -179,7 +180,6 @@ def generate():
     """Submit a generation request to the provider API."""
     data = request.get_json()
     definition_id = data.get("definition_id")
-    params = data.get("params", {})
 
     defn, api_key = get_api_key(definition_id)
     if not defn:
@@ -188,75 +188,236 @@ def generate():
     if not api_key:
         return jsonify({"error": f"No API key configured for provider '{defn['provider']}'"}), 400
 
+    result, status = _run_generate(defn, api_key, data)
+    return jsonify(result), status
+
+
+def _run_generate(defn, api_key, data):
+    """Make one non-streaming provider call for /api/generate or a compare slot.
+
+    Returns (result, http_status); result carries "error" on failure.
+    """
+    params = data.get("params", {})
     try:
         url, headers, body = build_request(defn, params, api_key)
     except ValueError as e:
-        return jsonify({"error": str(e)}), 400
+        return {"error": str(e)}, 400
 
     # When a streaming definition is called via /api/generate (sync mode),
     # override stream to false so the provider returns a complete response.
     if body and body.get("stream") is True:
         body["stream"] = False
 
-    try:
-        resp = http_requests.request(
+    # Serve repeat generations from the response cache when the definition opts in.
+    # Polling submissions are never cached: each one starts a new upstream job.
+    interaction = defn.get("interaction", {})
+    ttl = _request_cache_ttl(defn, data) if interaction.get("pattern") != "polling" else 0
+    key = cache_key(defn["id"], url, body) if ttl > 0 else None
+    if key:
+        cached = response_cache.get(key)
+        # An answer whose media files were evicted from the store is treated as a miss
+        if cached and stored_media_present(cached[0].get("outputs")):
+            result, tier, age = cached
+            result = dict(result, cache={"hit": True, "tier": tier, "age_seconds": round(age, 1)})
+            return result, result["status_code"]
+
+    # Identical calls already in flight share one upstream request (never for
+    # polling submissions, which each start their own job)
+    if interaction.get("pattern") == "polling" or data.get("dedupe") is False:
+        return _call_generate(defn, api_key, params, url, headers, body, key, ttl)
+    (result, status), shared = singleflight.generations.do(
+        key or cache_key(defn["id"], url, body),
+        lambda: _call_generate(defn, api_key, params, url, headers, body, key, ttl),
+    )
+    if shared:
+        metrics.observe_shared("generate", defn["provider"], defn["id"])
+        result = dict(result, shared=True)
+    return result, status
+
+
+def _call_generate(defn, api_key, params, url, headers, body, key, ttl):
+    """The upstream half of _run_generate: call the provider and build the result."""
+    interaction = defn.get("interaction", {})
+    provider = defn["provider"]
+    started = None
+    resp = None
+    permit = None
+    body_read = True
+    deadline = deadline_for(defn, "request")
+
+    def call():
+        nonlocal started
+        if started is None:
+            started = time.monotonic()  # first attempt upstream; failures are timed from here
+        return session_for(provider).request(
             method=defn["request"]["method"],
             url=url,
             headers=headers,
             json=body,
-            timeout=60,
+            stream=True,
+            timeout=deadline.timeout(),
+        )
+
+    try:
+        resp, permit, attempts = retry.call(
+            defn, lambda on_grant: ratelimit.send(defn, body, call, on_grant=on_grant), "generate", deadline=deadline
         )
+        started = permit.granted_at  # the answer's own attempt, not an earlier retry or a losing hedge
 
-        # Handle binary audio responses (TTS endpoints return raw audio)
+        # Binary audio responses (TTS endpoints return raw audio) are not buffered:
+        # the body is spooled in the background and served from /api/media/<id>
+        # while it is still arriving.
         content_type = resp.headers.get("Content-Type", "")
         if resp.ok and ("audio" in content_type or "octet-stream" in content_type):
-            audio_b64 = base64.b64encode(resp.content).decode("utf-8")
             mime = content_type.split(";")[0].strip()
-            data_url = f"data:{mime};base64,{audio_b64}"
-            resp_data = {"audio_url": data_url}
+            body_read = False
+            passthrough_permit, permit = permit, None  # held until the audio finishes downloading
+
+            def on_complete(size):
+                passthrough_permit.release()
+                metrics.observe_bytes("generate", provider, defn["id"], size)
+
+            media = start_passthrough(resp, mime, on_complete=on_complete)
+            resp_data = {"audio_url": f"/api/media/{media.id}"}
+            key = None  # passthrough URLs are short-lived, so never cache them
         else:
+            deadline.read(resp)
             resp_data = resp.json()
+    except ratelimit.RateLimitTimeout as e:
+        return {"error": str(e), "retry_after": e.retry_after}, 429
     except http_requests.RequestException as e:
         app.logger.error("Generate request failed: %s", e)
-        return jsonify({"error": "Upstream request failed"}), 502
+        history.record("generate", defn, params, "error", time.monotonic() - started, error=str(e), request=body)
+        return {"error": "Upstream request failed"}, 502
     except ValueError:
-        return jsonify({"error": "Non-JSON response from provider"}), 502
+        history.record(
+            "generate", defn, params, "error", time.monotonic() - started, http_status=resp.status_code,
+            error="Non-JSON response from provider", request=body,
+        )
+        return {"error": "Non-JSON response from provider"}, 502
+    finally:
+        if permit is not None:
+            permit.release()
+        if started is not None:
+            metrics.observe_response("generate", provider, defn["id"], resp, started, body, body_read)
+    latency = time.monotonic() - started
 
     # For polling patterns, extract the request_id
-    interaction = defn.get("interaction", {})
     result = {"response": resp_data, "status_code": resp.status_code}
 
     if interaction.get("pattern") == "polling" and resp.ok:
         rid_path = interaction.get("request_id_path", "$.request_id")
         request_id = extract_value(resp_data, rid_path)
         result["request_id"] = request_id
+        # Start the shared server-side poller; clients subscribe via /api/jobs/events
+        if request_id:
+            try:
+                ensure_job(defn, api_key, str(request_id), params)
+            except ValueError:
+                pass
 
     # For sync responses (including streaming defs called via /api/generate),
     # extract typed outputs (images, audio, etc.)
     if resp.ok and "request_id" not in result:
         outputs = extract_outputs(defn, resp_data)
         if outputs:
-            # Convert base64 image/audio values to data URLs for client rendering
-            for output_def, output in zip(defn.get("response", {}).get("outputs", []), outputs):
-                if output_def.get("source") == "base64" and output["type"] in ("image", "audio"):
-                    mime = output_def.get("mime_type", "image/png" if output["type"] == "image" else "audio/wav")
-                    output["value"] = [
-                        f"data:{mime};base64,{v}" if v and not v.startswith("data:") else v
-                        for v in output["value"]
-                    ]
+            # Move base64 image/audio values into the content-addressed media store and
+            # hand the client short /media/<hash> URLs, in outputs and the raw response
+            stored = store_base64_outputs(defn, outputs)
+            if stored:
+                result["response"] = replace_strings(resp_data, stored)
             result["outputs"] = outputs
 
     # Check for provider errors
     if not resp.ok:
         error_msg = extract_error(defn, resp_data) or resp_data
         result["error"] = error_msg
-
-    return jsonify(result), resp.status_code if resp.ok else 502
+    elif key:
+        response_cache.put(key, result, ttl)
+        result = dict(result, cache={"hit": False})
+    if attempts:
+        result["upstream"] = attempts
+
+    history.record(
+        "generate", defn, params, "ok" if resp.ok else "error", latency,
+        http_status=resp.status_code, ttfb=resp.elapsed.total_seconds(),
+        request_id=str(result["request_id"]) if result.get("request_id") else None,
+        error=result.get("error"), request=body, response=result["response"], outputs=result.get("outputs"),
+    )
+    # A 429 that outlasted the retries is passed on, so clients can back off too
+    return result, resp.status_code if resp.ok or resp.status_code == 429 else 502
+
+
+def _request_cache_ttl(defn, data):
+    """Cache TTL for this call; clients can bypass the cache with "cache": false."""
+    if data.get("cache") is False:
+        return 0
+    return cache_ttl(defn)
+
+
+@app.route("/api/media/<media_id>")
+def get_media_stream(media_id):
+    """Serve a binary provider response (e.g. TTS audio) while it downloads.
+
+    Supports single-range HTTP Range requests so the browser can seek.
+    """
+    media = get_media(media_id)
+    if not media:
+        return jsonify({"error": "Media not found or expired"}), 404
+
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "private, max-age=600"}
+    length = media.length
+    byte_range = request.range
+
+    if byte_range is None or byte_range.units != "bytes" or len(byte_range.ranges) != 1:
+        if length is not None:
+            headers["Content-Length"] = str(length)
+        return Response(media.iter_range(0), mimetype=media.mime, headers=headers)
+
+    start, stop = byte_range.ranges[0]
+    if length is None and (start < 0 or (stop is None and start > 0)):
+        # Suffix and open-ended ranges need the total size
+        media.wait_complete()
+        length = media.length
+
+    if length is None:
+        if stop is None:
+            # bytes=0- while the size is still unknown: stream everything as it arrives
+            return Response(media.iter_range(0), mimetype=media.mime, headers=headers)
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/*"
+        return Response(media.iter_range(start, stop - 1), 206, mimetype=media.mime, headers=headers)
+
+    if start < 0:
+        start, stop = max(length + start, 0), None
+    if start >= length:
+        return Response(status=416, headers={"Content-Range": f"bytes */{length}"})
+    end = min(stop, length) - 1 if stop is not None else length - 1
+    headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    headers["Content-Length"] = str(end - start + 1)
+    return Response(media.iter_range(start, end), 206, mimetype=media.mime, headers=headers)
+
+
+@app.route("/media/<name>")
+def get_stored_media(name):
+    """Serve a content-addressed media file; its URL never changes content."""
+    if not STORE_NAME_RE.match(name):
+        return jsonify({"error": "Media not found"}), 404
+    path = media_store.path(name)
+    if not os.path.exists(path):
+        # Evicted files may be stored again later: don't let the miss be cached
+        return jsonify({"error": "Media not found"}), 404, {"Cache-Control": "no-store"}
+    resp = send_file(path, mimetype=mimetypes.guess_type(name)[0], conditional=True, etag=name.split(".")[0])
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
 
 
 @app.route("/api/stream", methods=["POST"])
 def stream():
-    """Proxy a streaming SSE request to the provider and forward chunks."""
+    """Proxy a streaming SSE request to the provider and forward chunks.
+
+    The upstream connection runs on the shared asyncio stream engine; this
+    generator only turns its lines into SSE frames for the browser.
+    """
     data = request.get_json()
     definition_id = data.get("definition_id")
     params = data.get("params", {})
@@ -270,58 +431,376 @@ def stream():
 
     try:
         url, headers, body = build_request(defn, params, api_key)
+        coalescer = _request_coalescer(data)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
-    stream_path = defn.get("interaction", {}).get("stream_path", "")
+    events, cache_status = _stream_events(defn, data, url, headers, body, coalescer)
+    # Stop listening the moment the browser goes away, not at the next failed write
+    watch = watch_disconnect(request.environ, events.close)
 
     def generate():
         try:
-            resp = http_requests.request(
-                method=defn["request"]["method"],
-                url=url,
-                headers=headers,
-                json=body,
-                stream=True,
-                timeout=60,
-            )
+            for event, payload in events:
+                yield _sse(event, payload)
+        finally:
+            watch.stop()
+            events.close()
+
+    cache_headers = {"X-Arcade-Cache": cache_status} if cache_status else None
+    return Response(generate(), mimetype="text/event-stream", headers=cache_headers)
+
 
-            if not resp.ok:
-                error_data = resp.text
+def _request_coalescer(data):
+    """Token coalescer from the request's "coalesce" options or the env defaults."""
+    # Batch fast token streams into fewer frames (first token always goes out at once)
+    coalesce = data.get("coalesce") or {}
+    try:
+        return TokenCoalescer(
+            window_ms=int(coalesce.get("window_ms", COALESCE_MS)),
+            max_bytes=int(coalesce.get("max_bytes", COALESCE_BYTES)),
+        )
+    except (TypeError, ValueError):
+        raise ValueError("coalesce.window_ms and coalesce.max_bytes must be integers")
+
+
+def _stream_events(defn, data, url, headers, body, coalescer):
+    """Start a streaming call for /api/stream or a compare slot.
+
+    Returns (events, cache_status). events is an iterator of (event, payload)
+    pairs: ("token", {...}) per frame, then ("done", {}) or ("error", {...});
+    close() it when done. cache_status is the cache tier for a replay, "miss", "shared" when an
+    identical stream in flight was joined, or None if uncached.
+    """
+    # A cached completion is replayed as a fast SSE stream in its original chunks
+    ttl = _request_cache_ttl(defn, data)
+    key = cache_key(defn["id"], url, body) if ttl > 0 else None
+    cached = response_cache.get(key) if key else None
+    if cached:
+        value, tier, _age = cached
+        return singleflight.replay(_replay_tokens(value["tokens"])), tier
+    cache_status = "miss" if key else None
+    # The upstream stream runs in the background and is closed as soon as its last listener leaves
+    cancellation = Cancellation()
+
+    def start():
+        return _upstream_tokens(defn, data.get("params", {}), url, headers, body, coalescer, key, ttl, cancellation)
+
+    if data.get("dedupe") is False:
+        return singleflight.broadcast(start(), cancel=cancellation.cancel), cache_status
+    # Join an identical stream already in flight: its tokens so far are replayed, then the live tail.
+    # Frames are coalesced by whoever started the stream, so the coalescing window is part of the key.
+    flight_key = (key or cache_key(defn["id"], url, body), coalescer.window, coalescer.max_bytes)
+    events, shared = singleflight.streams.join(flight_key, start, cancel=cancellation.cancel)
+    if shared:
+        metrics.observe_shared("stream", defn["provider"], defn["id"])
+        cache_status = "shared"
+    return events, cache_status
+
+
+def _replay_tokens(tokens):
+    for token in tokens:
+        yield "token", _token_payload(token)
+    yield "done", {}
+
+
+def _upstream_tokens(defn, params, url, headers, body, coalescer, key, ttl, cancellation):
+    stream_path = defn.get("interaction", {}).get("stream_path", "")
+    extractor = compile_path(stream_path) if stream_path else None
+    resp = None
+    tokens = []
+    timer = StreamTimer(defn)
+    summary = None
+    bytes_in = 0
+    ttfb = None
+    error = None
+    permit = None
+    queued = time.monotonic()
+    started = None
+
+    def call():
+        nonlocal started
+        if started is None:
+            started = time.monotonic()  # first attempt upstream; failures are timed from here
+        cancellation.check()
+        return open_stream(
+            defn["provider"],
+            defn["request"]["method"],
+            url,
+            headers=headers,
+            json=body,
+            timeout=timeout_for(defn, "request"),
+            total=declared_timeout(defn, "request"),
+            cancellation=cancellation,
+        )
+
+    try:
+        try:
+            # Only opening the stream is retried; nothing has reached the client yet
+            resp, permit, attempts = retry.call(
+                defn, lambda on_grant: ratelimit.send(defn, body, call, on_grant=on_grant), "stream", idempotent=False
+            )
+            started = permit.granted_at  # the stream that opened, not an earlier failed attempt
+        except ratelimit.RateLimitTimeout as e:
+            error = str(e)
+            yield "error", {"error": error, "retry_after": e.retry_after}
+            return
+        ttfb = time.monotonic() - started
+
+        if not resp.ok:
+            error_data = resp.text
+            bytes_in = len(error_data)
+            try:
+                error_json = resp.json()
+                error_msg = extract_error(defn, error_json) or error_data
+            except ValueError:
+                error_msg = error_data
+            error = str(error_msg)
+            yield "error", {"error": error}
+            return
+
+        for line in resp.iter_lines(decode_unicode=True, idle=coalescer.wait_time):
+            if line is None:
+                # Coalescing window elapsed with no new upstream chunk
+                batch = coalescer.flush()
+                if batch:
+                    yield "token", _token_payload(*batch)
+                continue
+            bytes_in += len(line) + 1
+            if not line:
+                continue
+            if line.startswith("data: "):
+                chunk_str = line[6:]
+                if chunk_str.strip() == "[DONE]":
+                    break
                 try:
-                    error_json = resp.json()
-                    error_msg = extract_error(defn, error_json) or error_data
-                except ValueError:
-                    error_msg = error_data
-                yield f"event: error\ndata: {json.dumps({'error': str(error_msg)})}\n\n"
-                return
+                    chunk = json.loads(chunk_str)
+                    # Extract the token using stream_path
+                    token = extractor.extract(chunk) if extractor else ""
+                    if token and not isinstance(token, str):
+                        token = json.dumps(token)  # stream_path hit a number or object: pass on its JSON text
+                    timer.chunk(chunk, resp.line_time, bool(token))
+                    if token:
+                        tokens.append(token)
+                        batch = coalescer.add(token)
+                        if batch:
+                            yield "token", _token_payload(*batch)
+                except (json.JSONDecodeError, KeyError, TypeError, IndexError):
+                    pass
+
+        batch = coalescer.flush()
+        if batch:
+            yield "token", _token_payload(*batch)
+        if key and tokens:  # an empty answer is more likely a hiccup than something to replay
+            response_cache.put(key, {"tokens": tokens}, ttl)
+        # Server-side timing, measured at the upstream socket rather than in the browser
+        summary = timer.summary(resp, time.monotonic())
+        yield "metrics", {"metrics": summary, "upstream": attempts} if attempts else {"metrics": summary}
+        yield "done", {}
 
-            for line in resp.iter_lines(decode_unicode=True):
-                if not line:
-                    continue
-                if line.startswith("data: "):
-                    chunk_str = line[6:]
-                    if chunk_str.strip() == "[DONE]":
-                        yield f"event: done\ndata: {{}}\n\n"
-                        return
-                    try:
-                        chunk = json.loads(chunk_str)
-                        # Extract the token using stream_path
-                        token = extract_value(chunk, stream_path) if stream_path else ""
-                        if token:
-                            yield f"data: {json.dumps({'token': token})}\n\n"
-                    except (json.JSONDecodeError, KeyError, TypeError, IndexError):
-                        pass
-
-            yield f"event: done\ndata: {{}}\n\n"
+    except http_requests.RequestException as e:
+        if cancellation.cancelled:
+            return  # every listener left; recorded as cancelled below
+        app.logger.error("Stream request failed: %s", e)
+        error = str(e)
+        yield "error", {"error": "Upstream request failed"}
+    finally:
+        if resp is not None:
+            resp.close()
+        if permit is not None:
+            permit.release()
+        # A stream that neither finished nor failed was cancelled by the client
+        history.record(
+            "stream", defn, params, "ok" if summary else "error" if error else "cancelled",
+            time.monotonic() - (started or queued),
+            http_status=resp.status_code if resp is not None else None,
+            ttfb=ttfb,
+            ttft_ms=summary["ttft_ms"] if summary else None,
+            tokens=summary["completion_tokens"] if summary else None,
+            error=error,
+            request=body,
+            response="".join(tokens),
+        )
+        if started is not None:
+            metrics.observe_upstream(
+                "stream",
+                defn["provider"],
+                defn["id"],
+                resp.status_code if resp is not None else None,
+                time.monotonic() - started,
+                ttfb=ttfb,
+                bytes_out=len(json.dumps(body)) if body else 0,
+                bytes_in=bytes_in,
+            )
+        metrics.observe_stream(defn["provider"], defn["id"], timer.chunks, summary)
 
-        except http_requests.RequestException as e:
-            app.logger.error("Stream request failed: %s", e)
-            yield f"event: error\ndata: {json.dumps({'error': 'Upstream request failed'})}\n\n"
+
+def _token_payload(text, count=1):
+    """Token frame payload; count > 1 means several upstream chunks were coalesced."""
+    return {"token": text, "n": count} if count > 1 else {"token": text}
+
+
+def _sse(event, payload):
+    """Format one SSE frame. Token frames are sent as unnamed data frames."""
+    if event == "token":
+        return f"data: {json.dumps(payload)}\n\n"
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+# ---------------------------------------------------------------------------
+# Routes — Compare (server-side fan-out)
+# ---------------------------------------------------------------------------
+
+
+COMPARE_MAX_SLOTS = 8
+_SLOT_FINISHED = object()  # queue marker: one slot has produced its last event
+_CLIENT_GONE = object()  # queue marker: the browser closed the connection
+
+
+@app.route("/api/compare", methods=["POST"])
+def compare():
+    """Run N (definition_id, params) slots at once and multiplex them over one SSE stream.
+
+    Every slot is released at the same moment, so time-to-first-token is
+    measured from an identical start. Frames carry a "slot" index: token
+    frames ({"slot", "token"}), then per slot a terminal "done" (streamed),
+    "result" (sync, or a polling job's final result) or "error". Polling
+    slots also emit "submitted" and "status". A final "end" closes the stream.
+    """
+    data = request.get_json()
+    slot_requests = data.get("slots", [])
+    if not isinstance(slot_requests, list) or not slot_requests:
+        return jsonify({"error": "slots must be a non-empty list"}), 400
+    if len(slot_requests) > COMPARE_MAX_SLOTS:
+        return jsonify({"error": f"At most {COMPARE_MAX_SLOTS} slots can be compared"}), 400
+    try:
+        coalescer_opts = {"coalesce": data.get("coalesce")}
+        _request_coalescer(coalescer_opts)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    out = queue.Queue()
+    go = threading.Event()
+    cancelled = threading.Event()
+    # Closes every slot's stream listener and job subscription once the browser is gone
+    slots_gone = Cancellation()
+    watch = watch_disconnect(request.environ, lambda: out.put((_CLIENT_GONE, None)))
+
+    def run_slot(index, slot_data):
+        go.wait()
+        events = _compare_slot_events(slot_data, dict(coalescer_opts), slots_gone)
+        try:
+            for event, payload in events:
+                if cancelled.is_set():
+                    return
+                out.put((event, dict(payload, slot=index)))
+        except Exception as e:  # a failing slot must not take down the others
+            app.logger.error("Compare slot %s failed: %s", index, e)
+            out.put(("error", {"slot": index, "error": "Slot failed"}))
+        finally:
+            events.close()
+            out.put((_SLOT_FINISHED, index))
+
+    def generate():
+        # Threads wait on one event so every slot's upstream call starts together
+        for index, slot_data in enumerate(slot_requests):
+            threading.Thread(target=run_slot, args=(index, slot_data), name=f"compare-{index}", daemon=True).start()
+        go.set()
+        remaining = len(slot_requests)
+        try:
+            while remaining:
+                try:
+                    event, payload = out.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is _SLOT_FINISHED:
+                    remaining -= 1
+                    continue
+                if event is _CLIENT_GONE:
+                    return
+                yield _sse(event, payload)
+            yield _sse("end", {})
+        finally:
+            watch.stop()
+            cancelled.set()
+            slots_gone.cancel()
 
     return Response(generate(), mimetype="text/event-stream")
 
 
+class _QueueCloser:
+    """Lets a Cancellation wake a thread blocked on a job subscription queue."""
+
+    def __init__(self, q):
+        self._q = q
+
+    def close(self):
+        self._q.put((_CLIENT_GONE, None))
+
+
+def _compare_slot_events(slot_data, data, cancellation):
+    """Run one compare slot to completion, yielding (event, payload) pairs.
+
+    cancellation (a deadlines.Cancellation) ends a streaming or polling slot
+    at once, from any thread, instead of at its next event.
+    """
+    if not isinstance(slot_data, dict):
+        yield "error", {"error": "Each slot must be an object"}
+        return
+    definition_id = slot_data.get("definition_id")
+    defn, api_key = get_api_key(definition_id)
+    if not defn:
+        yield "error", {"error": f"Definition '{definition_id}' not found"}
+        return
+    if not api_key:
+        yield "error", {"error": f"No API key configured for provider '{defn['provider']}'"}
+        return
+    data.update(slot_data)
+
+    pattern = defn.get("interaction", {}).get("pattern")
+    if pattern == "streaming" and slot_data.get("stream", True):
+        try:
+            url, headers, body = build_request(defn, data.get("params", {}), api_key)
+        except ValueError as e:
+            yield "error", {"error": str(e)}
+            return
+        events, _cache_status = _stream_events(defn, data, url, headers, body, _request_coalescer(data))
+        cancellation.attach(events)
+        try:
+            yield from events
+        finally:
+            events.close()
+        return
+
+    result, _status = _run_generate(defn, api_key, data)
+    if "error" in result:
+        yield "error", result
+        return
+    if pattern != "polling" or not result.get("request_id"):
+        yield "result", result
+        return
+
+    # Polling: follow the shared job poller until its terminal event
+    yield "submitted", {"request_id": result["request_id"], "response": result["response"]}
+    try:
+        job, q = subscribe_job(defn, api_key, str(result["request_id"]))
+    except ValueError:
+        yield "error", {"error": "Invalid request_id"}
+        return
+    cancellation.attach(_QueueCloser(q))
+    try:
+        while True:
+            event, payload = q.get()
+            if event is _CLIENT_GONE:
+                return
+            yield event, payload
+            if event in ("result", "error"):
+                return
+    finally:
+        job.unsubscribe(q)
+
+
 @app.route("/api/status")
 def check_status():
     """Check the status of an async job."""
@@ -339,15 +818,70 @@ def check_status():
 
     headers = build_auth_headers(defn, api_key)
 
+    started = time.monotonic()
+    resp = None
     try:
-        resp = http_requests.get(url, headers=headers, timeout=15)
+        resp, attempts = retry.get(defn, url, headers, "poll")
         resp_data = resp.json()
     except (http_requests.RequestException, ValueError) as e:
         app.logger.error("Status check failed: %s", e)
         return jsonify({"error": "Upstream request failed", "poll_status": "error"}), 502
+    finally:
+        metrics.observe_response("status", defn["provider"], definition_id, resp, started)
 
     poll_status = check_done(defn, resp_data)
-    return jsonify({"poll_status": poll_status, "response": resp_data})
+    result = {"poll_status": poll_status, "response": resp_data}
+    if attempts:
+        result["upstream"] = attempts
+    return jsonify(result)
+
+
+@app.route("/api/jobs/events")
+def job_events():
+    """Push status changes and the final result of an async job over SSE.
+
+    All subscribers to the same (definition_id, request_id) share one
+    server-side poll loop. Events: status, result, error, and reconnect
+    when this server is shutting down (see jobs.drain).
+    """
+    definition_id = request.args.get("definition_id")
+    request_id = request.args.get("request_id", "")
+
+    defn, api_key = get_api_key(definition_id)
+    if not defn:
+        return jsonify({"error": f"Definition '{definition_id}' not found"}), 404
+
+    if defn.get("interaction", {}).get("pattern") != "polling":
+        return jsonify({"error": f"Definition '{definition_id}' does not use polling"}), 400
+
+    try:
+        job, q = subscribe_job(defn, api_key, request_id)
+    except ValueError:
+        return jsonify({"error": "Invalid request_id"}), 400
+
+    environ = request.environ
+
+    def events():
+        watch = watch_disconnect(environ, lambda: q.put((_CLIENT_GONE, None)))
+        try:
+            while True:
+                try:
+                    event, payload = q.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is _CLIENT_GONE:
+                    return
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+                if event in ("result", "error", "reconnect"):
+                    return
+        finally:
+            watch.stop()
+            job.unsubscribe(q)
+
+    response = Response(events(), mimetype="text/event-stream")
+    response.call_on_close(lambda: job.unsubscribe(q))  # also when events() never started
+    return response
 
 
 @app.route("/api/result")
@@ -367,15 +901,74 @@ def get_result():
 
     headers = build_auth_headers(defn, api_key)
 
+    started = time.monotonic()
+    resp = None
     try:
-        resp = http_requests.get(url, headers=headers, timeout=30)
+        resp, attempts = retry.get(defn, url, headers, "result")
         resp_data = resp.json()
     except (http_requests.RequestException, ValueError) as e:
         app.logger.error("Result fetch failed: %s", e)
         return jsonify({"error": "Upstream request failed"}), 502
+    finally:
+        metrics.observe_response("result", defn["provider"], definition_id, resp, started)
 
     outputs = extract_outputs(defn, resp_data)
-    return jsonify({"response": resp_data, "outputs": outputs})
+    result = {"response": resp_data, "outputs": outputs}
+    if attempts:
+        result["upstream"] = attempts
+    return jsonify(result)
+
+
+@app.route("/api/cancel", methods=["POST"])
+def cancel_job():
+    """Cancel an async job at the provider (interaction.cancel_url) and stop polling it."""
+    data = request.get_json(silent=True) or {}
+    definition_id = data.get("definition_id")
+    request_id = str(data.get("request_id", ""))
+
+    defn, api_key = get_api_key(definition_id)
+    if not defn:
+        return jsonify({"error": f"Definition '{definition_id}' not found"}), 404
+    if defn.get("interaction", {}).get("pattern") != "polling":
+        return jsonify({"error": f"Definition '{definition_id}' does not use polling"}), 400
+
+    try:
+        url = build_cancel_url(defn, request_id)
+    except ValueError:
+        return jsonify({"error": "Invalid request_id"}), 400
+
+    upstream_status = None
+    if url:
+        started = time.monotonic()
+        resp = None
+        deadline = deadline_for(defn, "cancel")
+        try:
+            resp = session_for(defn["provider"]).request(
+                method=defn["interaction"].get("cancel_method", "POST"),
+                url=url,
+                headers=build_auth_headers(defn, api_key),
+                stream=True,
+                timeout=deadline.timeout(),
+            )
+            deadline.read(resp)
+        except http_requests.RequestException as e:
+            app.logger.error("Cancel request failed: %s", e)
+            return jsonify({"error": "Upstream request failed"}), 502
+        finally:
+            metrics.observe_response("cancel", defn["provider"], definition_id, resp, started)
+        if not resp.ok:
+            try:
+                error_msg = extract_error(defn, resp.json()) or resp.text
+            except ValueError:
+                error_msg = resp.text
+            return jsonify({"error": error_msg, "status_code": resp.status_code}), 502
+        upstream_status = resp.status_code
+
+    # Stop the shared poller either way: nobody is waiting for this job any more
+    job = get_job(defn["id"], request_id)
+    if job:
+        job.cancel()
+    return jsonify({"cancelled": True, "upstream_cancelled": url is not None, "status_code": upstream_status})
 
 
 # ---------------------------------------------------------------------------
@@ -383,63 +976,166 @@ def get_result():
 # ---------------------------------------------------------------------------
 
 
-def _validate_provider(provider, api_key, auth_info):
-    """Validate a single provider's API key. Returns (provider, status)."""
-    validation_url = auth_info.get("validation_url")
-    if not validation_url:
-        return provider, "unknown"
-    headers = {
-        auth_info.get("header", "Authorization"): auth_info.get("prefix", "Bearer ") + api_key
-    }
+@app.route("/api/validate-keys")
+def validate_keys():
+    """Return each provider's key status from the validation cache.
+
+    Expired entries are re-checked in the background; ?wait=<seconds> waits
+    up to that long (max 10) for those checks before answering.
+    """
+    wait_seconds = min(request.args.get("wait", 0, type=float), 10)
+    return jsonify(key_checker.statuses(registry.snapshot, wait_seconds))
+
+
+@app.route("/api/batch", methods=["POST"])
+def create_batch():
+    """Start or resume a named batch of param sets against one or more definitions."""
+    data = request.get_json()
+    name = data.get("name", "")
+    definition_ids = data.get("definition_ids", [])
+    rows = data.get("rows", [])
+
+    if not isinstance(definition_ids, list) or not all(isinstance(d, str) for d in definition_ids):
+        return jsonify({"error": "definition_ids must be a list of definition ids"}), 400
+
+    snapshot = registry.snapshot
+    unknown = [d for d in definition_ids if d not in snapshot.definitions]
+    if not definition_ids or unknown:
+        return jsonify({"error": f"Unknown definition(s): {', '.join(unknown) or '(none given)'}"}), 400
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        return jsonify({"error": "rows must be a list of param objects"}), 400
     try:
-        resp = http_requests.get(validation_url, headers=headers, timeout=5)
-        if resp.status_code == 200:
-            return provider, "valid"
-        elif resp.status_code in (401, 403):
-            return provider, "invalid"
-        else:
-            return provider, "unknown"
-    except http_requests.RequestException:
-        return provider, "unknown"
+        concurrency = int(data.get("concurrency", DEFAULT_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be an integer"}), 400
+
+    try:
+        batch = start_batch(
+            name,
+            list(enumerate(rows, 1)),
+            {d: snapshot.definitions[d] for d in definition_ids},
+            snapshot.api_keys,
+            concurrency,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(dict(batch.status(), name=name)), 202
 
 
-@app.route("/api/validate-keys")
-def validate_keys():
-    """Validate all configured API keys by hitting each provider's validation_url."""
-    # Collect unique providers that have keys and validation URLs
-    to_validate = {}
-    for defn in DEFINITIONS.values():
-        provider = defn.get("provider", "")
-        if provider in to_validate or provider not in API_KEYS:
-            continue
-        auth = defn.get("auth", {})
-        if auth.get("validation_url"):
-            to_validate[provider] = auth
-
-    results = {}
-
-    # Mark providers with no key
-    all_providers = {d["provider"] for d in DEFINITIONS.values()}
-    for p in all_providers:
-        if p not in API_KEYS:
-            results[p] = "no_key"
-
-    # Validate in parallel
-    with ThreadPoolExecutor(max_workers=10) as pool:
-        futures = {
-            pool.submit(_validate_provider, provider, API_KEYS[provider], auth): provider
-            for provider, auth in to_validate.items()
-        }
-        for future in as_completed(futures):
-            provider, status = future.result()
-            results[provider] = status
-
-    # Providers with keys but no validation_url
-    for p in API_KEYS:
-        if p not in results:
-            results[p] = "unknown"
-
-    return jsonify(results)
+@app.route("/api/batch/<name>")
+def get_batch_status(name):
+    """Return progress counters for a batch started by this server."""
+    batch = get_batch(name)
+    if not batch:
+        return jsonify({"error": "Batch not found"}), 404
+    return jsonify(dict(batch.status(), name=name))
+
+
+@app.route("/api/batch/<name>/results")
+def get_batch_results(name):
+    """Return the batch's JSONL results file as written so far."""
+    path = batch_output_path(name)
+    if not path or not os.path.exists(path):
+        return jsonify({"error": "Batch not found"}), 404
+    return send_file(path, mimetype="application/x-ndjson", max_age=0)
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Expose upstream latency, status, byte and job metrics for Prometheus."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def _pool_samples(field):
+    return [((provider,), stats[field]) for provider, stats in pool_stats().items()]
+
+
+metrics.register_callback(
+    "arcade_pool_requests_total", "counter", "Requests sent through each provider's keep-alive pool.",
+    ("provider",), lambda: _pool_samples("requests"),
+)
+metrics.register_callback(
+    "arcade_pool_new_connections_total", "counter", "New upstream connections (TCP + TLS handshakes) per provider.",
+    ("provider",), lambda: _pool_samples("misses"),
+)
+metrics.register_callback(
+    "arcade_active_streams", "gauge", "Upstream streams currently open on the stream engine.",
+    (), lambda: [((), active_streams())],
+)
+metrics.register_callback(
+    "arcade_ratelimit_queued", "gauge", "Upstream calls waiting in each provider's rate-limit queue.",
+    ("provider",), lambda: [((provider,), s["queued"]) for provider, s in ratelimit.limiter_stats().items()],
+)
+metrics.register_callback(
+    "arcade_ratelimit_active", "gauge", "Upstream calls holding a provider concurrency slot.",
+    ("provider",), lambda: [((provider,), s["active"]) for provider, s in ratelimit.limiter_stats().items()],
+)
+
+
+@app.route("/api/pool-stats")
+def get_pool_stats():
+    """Return per-provider keep-alive pool hit/miss counts."""
+    return jsonify(pool_stats())
+
+
+@app.route("/api/rate-limits")
+def get_rate_limits():
+    """Return each provider's rate-limit queue depth, in-flight calls and bucket levels."""
+    return jsonify(ratelimit.limiter_stats())
+
+
+_LOCAL_ADDRS = {"127.0.0.1", "::1"}  # who may call /api/reload
+
+
+@app.route("/api/reload", methods=["POST"])
+def reload_definitions():
+    """Re-read changed definition files and .env now instead of waiting for the watcher.
+
+    Only answered for requests from this machine: it touches the server's
+    files and keys, so it is not something a remote visitor should trigger.
+    """
+    if request.remote_addr not in _LOCAL_ADDRS:
+        return jsonify({"error": "Reload is only available from localhost"}), 403
+    changed = registry.reload()
+    here = os.path.dirname(os.path.abspath(__file__))
+    return jsonify({
+        "changed": [os.path.relpath(p, here) for p in changed],
+        "definitions": len(registry.snapshot.definitions),
+    })
+
+
+# ---------------------------------------------------------------------------
+# Routes — Run history
+# ---------------------------------------------------------------------------
+
+
+@app.route("/api/history")
+def get_history():
+    """Recent runs, newest first; page with ?before=<id>, filter with ?definition_id=."""
+    limit = min(request.args.get("limit", 50, type=int), 500)
+    runs = history.recent(request.args.get("definition_id"), limit, request.args.get("before", type=int))
+    return jsonify({"runs": runs, "next_before": runs[-1]["id"] if len(runs) == limit else None})
+
+
+@app.route("/api/history/<int:run_id>")
+def get_history_run(run_id):
+    """One run with its request body, response and outputs."""
+    run = history.get(run_id)
+    if not run:
+        return jsonify({"error": "Run not found"}), 404
+    return jsonify(run)
+
+
+@app.route("/api/history/latency")
+def get_history_latency():
+    """Latency/TTFT percentiles per definition and model over ?window= seconds, split by ?bucket=."""
+    window = request.args.get("window", 86400, type=float)
+    bucket = request.args.get("bucket", type=float)
+    if window <= 0 or (bucket is not None and bucket <= 0):
+        return jsonify({"error": "window and bucket must be positive"}), 400
+    return jsonify(history.latency(
+        request.args.get("definition_id"), request.args.get("model"), window, bucket,
+    ))
 
 
 # ---------------------------------------------------------------------------
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""Batch runner: a JSONL file of param sets against one or more definitions.
+
+Each input line is a JSON object of params, exactly what the form would
+send. Every (line, definition) pair becomes one upstream call, run with a
+bounded number in flight, and its result is appended to a JSONL output
+file as soon as it finishes. Re-running with the same output file skips
+pairs that already have a successful record, so a killed run resumes where
+it stopped and failed calls are tried again (the newer record is appended
+after the failed one).
+
+Usage:
+    python batch.py prompts.jsonl -d openai-chat-completions -d together-chat-completions -o results.jsonl
+    python batch.py prompts.jsonl -d openai-image-generation -o results.jsonl -c 8
+"""
+
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests as http_requests
+
+import metrics
+import ratelimit
+import retry
+from deadlines import deadline_for, timeout_for
+from jobs import subscribe_job
+from media import media_store, replace_strings, store_base64_outputs
+from proxy import build_request, extract_error, extract_outputs, extract_value
+from upstream import session_for
+
+DEFAULT_CONCURRENCY = int(os.getenv("ARCADE_BATCH_CONCURRENCY", "4"))
+BATCH_DIR = os.getenv(
+    "ARCADE_BATCH_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "batches")
+)
+BATCH_NAME_RE = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+_batches = {}  # batch name -> BatchRun (started from /api/batch)
+_lock = threading.Lock()
+
+
+def read_rows(path):
+    """Read a JSONL file of param objects. Returns [(line_number, params), ...].
+
+    Line numbers are 1-based file lines, so they stay stable across resumes.
+    Raises ValueError on a line that is not a JSON object.
+    """
+    rows = []
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                params = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_no}: invalid JSON: {e}")
+            if not isinstance(params, dict):
+                raise ValueError(f"{path}:{line_no}: expected a JSON object of params")
+            rows.append((line_no, params))
+    return rows
+
+
+def completed_pairs(output_path):
+    """Return the (line, definition_id) pairs already recorded without an error.
+
+    A record cut off by a killed run is dropped from the file so appending
+    resumes on a clean line.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        content = f.read()
+        end = content.rfind(b"\n") + 1
+        if end < len(content):
+            f.truncate(end)
+    for line in content[:end].splitlines():
+        try:
+            record = json.loads(line)
+            if not record.get("error"):  # failed calls are run again
+                done.add((record["line"], record["definition_id"]))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue
+    return done
+
+
+def run_one(defn, api_key, params):
+    """Run one generation to completion (polling inline). Returns a result record."""
+    record = {"definition_id": defn["id"], "params": params}
+    if not api_key:
+        record["error"] = f"No API key configured for provider '{defn['provider']}'"
+        return record
+
+    try:
+        url, headers, body = build_request(defn, params, api_key)
+    except ValueError as e:
+        record["error"] = str(e)
+        return record
+    if body and body.get("stream") is True:
+        body["stream"] = False
+
+    interaction = defn.get("interaction", {})
+    started = None
+    resp = None
+    permit = None
+    deadline = deadline_for(defn, "request")
+
+    def call():
+        nonlocal started
+        if started is None:
+            started = time.monotonic()  # first attempt upstream; failures are timed from here
+        return session_for(defn["provider"]).request(
+            method=defn["request"]["method"], url=url, headers=headers, json=body,
+            stream=True, timeout=deadline.timeout(),
+        )
+
+    try:
+        # Batch calls queue in their own lane so interactive requests keep getting turns
+        resp, permit, attempts = retry.call(
+            defn,
+            lambda on_grant: ratelimit.send(defn, body, call, lane="batch", on_grant=on_grant),
+            "generate",
+            deadline=deadline,
+        )
+        started = permit.granted_at  # the answer's own attempt, not an earlier retry or a losing hedge
+        content = deadline.read(resp)
+        content_type = resp.headers.get("Content-Type", "")
+        if resp.ok and ("audio" in content_type or "octet-stream" in content_type):
+            # Binary output: keep the bytes in the media store, record its URL
+            name = media_store.put(content, content_type.split(";")[0].strip())
+            resp_data = {"audio_url": f"/media/{name}"}
+        else:
+            resp_data = resp.json()
+    except ratelimit.RateLimitTimeout as e:
+        record["error"] = str(e)
+        return record
+    except http_requests.RequestException as e:
+        record["error"] = f"Upstream request failed: {e}"
+        return record
+    except ValueError:
+        record["error"] = "Non-JSON response from provider"
+        return record
+    finally:
+        if permit is not None:
+            permit.release()
+        if started is not None:
+            metrics.observe_response("batch", defn["provider"], defn["id"], resp, started, body)
+
+    record["status_code"] = resp.status_code
+    if attempts:
+        record["upstream"] = attempts
+    if not resp.ok:
+        record["error"] = extract_error(defn, resp_data) or resp_data
+        record["response"] = resp_data
+        return record
+
+    if interaction.get("pattern") == "polling":
+        request_id = extract_value(resp_data, interaction.get("request_id_path", "$.request_id"))
+        if not request_id:
+            record["error"] = "No request_id in provider response"
+            record["response"] = resp_data
+            return record
+        record["request_id"] = str(request_id)
+        event, data = _wait_for_job(defn, api_key, str(request_id), params)
+        record["poll_count"] = data.get("poll_count")
+        if event != "result":
+            record["error"] = data.get("error", "Generation failed.")
+            record["response"] = data.get("response")
+            return record
+        resp_data = data["response"]
+
+    outputs = extract_outputs(defn, resp_data)
+    stored = store_base64_outputs(defn, outputs)
+    record["outputs"] = outputs
+    record["response"] = replace_strings(resp_data, stored) if stored else resp_data
+    record["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+    return record
+
+
+def _wait_for_job(defn, api_key, request_id, params):
+    """Attach to the shared job poller and block until its terminal event."""
+    job, q = subscribe_job(defn, api_key, request_id, params)
+    deadline = time.monotonic() + timeout_for(defn, "job") + 60
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return "error", {"error": "Job timed out."}
+            try:
+                event, data = q.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if event in ("result", "error"):
+                return event, data
+    finally:
+        job.unsubscribe(q)
+
+
+class BatchRun:
+    """One batch: rows x definitions, written to output_path as they finish."""
+
+    def __init__(self, rows, definitions, api_keys, output_path, concurrency=DEFAULT_CONCURRENCY):
+        self.output_path = output_path
+        self.concurrency = max(1, concurrency)
+        self._definitions = definitions
+        self._api_keys = api_keys
+        done = completed_pairs(output_path)
+        self.pending = [
+            (line, params, defn_id)
+            for line, params in rows
+            for defn_id in definitions
+            if (line, defn_id) not in done
+        ]
+        self.total = len(rows) * len(definitions)
+        self.skipped = self.total - len(self.pending)
+        self.completed = 0
+        self.errors = 0
+        self.running = False
+        self.finished = False
+
+    def status(self):
+        return {
+            "output": self.output_path,
+            "total": self.total,
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "errors": self.errors,
+            "running": self.running,
+            "finished": self.finished,
+        }
+
+    def run(self, on_record=None):
+        """Run every pending pair, appending one JSON line per result."""
+        self.running = True
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+        try:
+            with open(self.output_path, "a") as out, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                futures = {
+                    pool.submit(self._run_pair, defn_id, params): line
+                    for line, params, defn_id in self.pending
+                }
+                for future in as_completed(futures):
+                    record = dict(line=futures[future], **future.result())
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    self.completed += 1
+                    if "error" in record:
+                        self.errors += 1
+                    if on_record:
+                        on_record(record)
+        finally:
+            self.running = False
+            self.finished = True
+
+    def _run_pair(self, defn_id, params):
+        defn = self._definitions[defn_id]
+        try:
+            return run_one(defn, self._api_keys.get(defn["provider"]), params)
+        except Exception as e:  # one bad call must not stop the batch
+            return {"definition_id": defn_id, "params": params, "error": f"{type(e).__name__}: {e}"}
+
+
+def start_batch(name, rows, definitions, api_keys, concurrency=DEFAULT_CONCURRENCY):
+    """Start (or resume) a named batch in the background, writing under BATCH_DIR.
+
+    Raises ValueError for a bad name or if that batch is already running.
+    """
+    if not BATCH_NAME_RE.match(name):
+        raise ValueError(f"Invalid batch name: {name}")
+    with _lock:
+        existing = _batches.get(name)
+        if existing and existing.running:
+            raise ValueError(f"Batch '{name}' is already running")
+        batch = _batches[name] = BatchRun(
+            rows, definitions, api_keys, os.path.join(BATCH_DIR, f"{name}.jsonl"), concurrency
+        )
+        batch.running = True
+    threading.Thread(target=batch.run, name=f"batch-{name}", daemon=True).start()
+    return batch
+
+
+def get_batch(name):
+    """Return the BatchRun for a name started in this process, or None."""
+    with _lock:
+        return _batches.get(name)
+
+
+def batch_output_path(name):
+    """Return the output file for a batch name, or None if the name is invalid."""
+    if not BATCH_NAME_RE.match(name):
+        return None
+    return os.path.join(BATCH_DIR, f"{name}.jsonl")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file, one JSON object of params per line")
+    parser.add_argument("-d", "--definition", action="append", required=True, help="definition id (repeatable)")
+    parser.add_argument("-o", "--output", required=True, help="JSONL results file (resumed if it exists)")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="requests in flight")
+    args = parser.parse_args()
+
+    # Loading app reads .env and every definition, same as the server
+    import app
+
+    snapshot = app.registry.snapshot
+    unknown = [d for d in args.definition if d not in snapshot.definitions]
+    if unknown:
+        print(f"Unknown definition(s): {', '.join(unknown)}", file=sys.stderr)
+        sys.exit(2)
+    try:
+        rows = read_rows(args.input)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+
+    definitions = {d: snapshot.definitions[d] for d in args.definition}
+    batch = BatchRun(rows, definitions, snapshot.api_keys, args.output, args.concurrency)
+    print(f"{batch.total} calls, {batch.skipped} already done, {len(batch.pending)} to run", file=sys.stderr)
+
+    def progress(record):
+        mark = "✗" if "error" in record else "✓"
+        print(f"  {mark} line {record['line']} {record['definition_id']} "
+              f"({batch.completed}/{len(batch.pending)})", file=sys.stderr)
+
+    batch.run(on_record=progress)
+    print(f"Done: {batch.completed - batch.errors} ok, {batch.errors} failed -> {args.output}", file=sys.stderr)
+    sys.exit(1 if batch.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
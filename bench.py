@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for arcade's per-request hot paths.
+
+Usage:
+    python bench.py extract        # JSONPath extraction per SSE chunk
+    python bench.py build          # request building per generate/preview call
+    python bench.py startup        # time to first request with thousands of definitions
+    python bench.py validate       # validate.py over thousands of definitions
+"""
+
+import argparse
+import copy
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from proxy import _recursive_find, build_auth_headers, build_request, compile_path, extract_value
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A typical OpenAI-compatible streaming chunk
+SAMPLE_CHUNK = {
+    "id": "chatcmpl-123",
+    "object": "chat.completion.chunk",
+    "created": 1700000000,
+    "model": "gpt-4o-mini",
+    "choices": [{"index": 0, "delta": {"content": " world"}, "finish_reason": None}],
+}
+
+SAMPLE_RESPONSES = [
+    SAMPLE_CHUNK,
+    {"choices": [{"message": {"content": "hi", "audio": {"data": "AAAA"}}}]},
+    {"data": [{"url": "https://example.com/a.png"}, {"url": "https://example.com/b.png"}]},
+    {"status": "COMPLETED", "request_id": "abc", "id": "xyz", "outputs": {"video_url": "https://v"}},
+    {"output": {"images": [{"url": "https://example.com/c.png"}]}},
+    {"error": {"message": "bad key"}},
+    {"predictions": [{"bytesBase64Encoded": "AAAA"}]},
+    {"items": [{"tags": [{"name": "a"}, {"name": "b"}]}, {"tags": [{"name": "c"}]}]},
+]
+
+EXTRA_PATHS = ["$.items[*].tags[*].name", "$.data[*].url", "$.data.0.url", "$[0]", "$..name"]
+
+
+def _report(label, seconds, number):
+    print(f"  {label:<28} {seconds / number * 1e6:8.3f} us/call  ({number / seconds:,.0f} calls/s)")
+
+
+# ---------------------------------------------------------------------------
+# extract — JSONPath extraction
+# ---------------------------------------------------------------------------
+
+
+def _legacy_extract_value(data, path):
+    """The pre-compilation extract_value: re-parses the path on every call."""
+    if not path or not data:
+        return None
+    path = path.lstrip("$")
+    if path.startswith(".."):
+        key = path[2:].split(".")[0].split("[")[0]
+        return _recursive_find(data, key)
+    parts = []
+    for segment in path.strip(".").split("."):
+        if not segment:
+            continue
+        match = re.match(r"^(\w+)\[(\*|\d+)\]$", segment)
+        if match:
+            parts.append(match.group(1))
+            parts.append(f"[{match.group(2)}]")
+        else:
+            parts.append(segment)
+    return _legacy_walk(data, parts)
+
+
+def _legacy_walk(data, parts):
+    current = data
+    for part in parts:
+        if current is None:
+            return None
+        if part == "[*]":
+            if isinstance(current, list):
+                remaining = parts[parts.index(part) + 1:]
+                return [_legacy_walk(item, remaining) for item in current if item is not None]
+            return None
+        elif part.startswith("[") and part.endswith("]"):
+            idx = int(part[1:-1])
+            if isinstance(current, list) and idx < len(current):
+                current = current[idx]
+            else:
+                return None
+        elif isinstance(current, dict):
+            current = current.get(part)
+        else:
+            return None
+    return current
+
+
+def _definition_paths():
+    """Collect every JSONPath used by the shipped definitions."""
+    paths = set(EXTRA_PATHS)
+    for root, _dirs, files in os.walk(os.path.join(HERE, "definitions")):
+        for fname in files:
+            if not fname.endswith(".json"):
+                continue
+            with open(os.path.join(root, fname)) as f:
+                defn = json.load(f)
+            interaction = defn.get("interaction", {})
+            response = defn.get("response", {})
+            for path in (
+                interaction.get("stream_path"),
+                interaction.get("request_id_path"),
+                interaction.get("done_when", {}).get("path"),
+                interaction.get("failed_when", {}).get("path"),
+                response.get("error", {}).get("path"),
+                *(out.get("path") for out in response.get("outputs", [])),
+            ):
+                if path:
+                    paths.add(path)
+    return sorted(paths)
+
+
+def bench_extract(number):
+    paths = _definition_paths()
+    mismatches = [
+        (path, sample)
+        for path in paths
+        for sample in SAMPLE_RESPONSES
+        if _legacy_extract_value(sample, path) != extract_value(sample, path)
+    ]
+    print(f"extract: {len(paths)} paths x {len(SAMPLE_RESPONSES)} samples, {len(mismatches)} mismatches")
+    if mismatches:
+        for path, sample in mismatches:
+            print(f"  MISMATCH {path} on {sample}")
+        return 1
+
+    stream_path = "$.choices[0].delta.content"
+    extractor = compile_path(stream_path)
+    print(f"per-chunk cost for {stream_path}:")
+    _report("before (re-parse per call)", timeit.timeit(lambda: _legacy_extract_value(SAMPLE_CHUNK, stream_path), number=number), number)
+    _report("extract_value (cached)", timeit.timeit(lambda: extract_value(SAMPLE_CHUNK, stream_path), number=number), number)
+    _report("compiled extractor", timeit.timeit(lambda: extractor.extract(SAMPLE_CHUNK), number=number), number)
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# build — request building
+# ---------------------------------------------------------------------------
+
+
+def _legacy_set_nested(obj, path, value):
+    """The pre-compilation body_path setter: splits the dot-separated path per call.
+
+    Numeric segments are treated as list indices (e.g. 'instances.0.prompt').
+    """
+    keys = path.split(".")
+    for key in keys[:-1]:
+        if key.isdigit():
+            obj = obj[int(key)]
+        else:
+            if key not in obj:
+                obj[key] = {}
+            obj = obj[key]
+    final = keys[-1]
+    if final.isdigit():
+        obj[int(final)] = value
+    else:
+        obj[final] = value
+
+
+def _legacy_build_request(definition, params, api_key):
+    """The pre-compilation build_request: deep-copies and re-walks params per call."""
+    req = definition["request"]
+    headers = {"Content-Type": req.get("content_type", "application/json")}
+    headers.update(build_auth_headers(definition, api_key))
+    for k, v in req.get("headers", {}).items():
+        headers[k] = v
+
+    body = copy.deepcopy(req.get("body_template", {}))
+    for param_def in req.get("params", []):
+        name = param_def["name"]
+        if name not in params:
+            continue
+        if param_def.get("url_path"):
+            continue
+        value = params[name]
+        try:
+            if param_def.get("type") == "integer":
+                value = int(value)
+            elif param_def.get("type") == "float":
+                value = float(value)
+        except (ValueError, TypeError):
+            raise ValueError(f"Parameter '{name}' expects {param_def.get('type')}, got '{value}'")
+
+        body_path = param_def.get("body_path")
+        if body_path == "_chat_message":
+            body["messages"] = [{"role": "user", "content": value}]
+        elif body_path:
+            _legacy_set_nested(body, body_path, value)
+        else:
+            body[name] = value
+
+    system_prompt = params.get("_system_prompt", "")
+    body.pop("_system_prompt", None)
+    if "messages" in body and system_prompt:
+        body["messages"].insert(0, {"role": "system", "content": system_prompt})
+
+    url = req["url"]
+    for param_def in req.get("params", []):
+        if param_def.get("url_path"):
+            name = param_def["name"]
+            if name in params:
+                url = url.replace(f"{{{name}}}", str(params[name]))
+    return url, headers, body
+
+
+def _load_definitions():
+    definitions = []
+    for root, _dirs, files in os.walk(os.path.join(HERE, "definitions")):
+        for fname in sorted(files):
+            if fname.endswith(".json"):
+                with open(os.path.join(root, fname)) as f:
+                    definitions.append(json.load(f))
+    return definitions
+
+
+def _param_sets(defn):
+    """Example params, plus variants with a system prompt, every param set, and bad numbers."""
+    sets = [dict(ex.get("params", {})) for ex in defn.get("examples", [])] or [{}]
+    full = {}
+    for param_def in defn["request"].get("params", []):
+        default = param_def.get("default")
+        if default is None:
+            default = (param_def.get("options") or ["x"])[0]
+        full[param_def["name"]] = default
+    sets.append(full)
+    sets.append(dict(sets[0], _system_prompt="Be brief."))
+    for param_def in defn["request"].get("params", []):
+        if param_def.get("type") in ("integer", "float"):
+            sets.append(dict(full, **{param_def["name"]: "not-a-number"}))
+    return sets
+
+
+def _build_outcome(fn, defn, params):
+    try:
+        url, headers, body = fn(defn, params, "sk-test")
+    except ValueError as e:
+        return f"ValueError: {e}"
+    return json.dumps([url, list(headers.items()), body])
+
+
+def bench_build(number):
+    definitions = _load_definitions()
+    cases = [(defn, params) for defn in definitions for params in _param_sets(defn)]
+    mismatches = [
+        (defn["id"], params)
+        for defn, params in cases
+        if _build_outcome(_legacy_build_request, defn, params) != _build_outcome(build_request, defn, params)
+    ]
+    print(f"build: {len(definitions)} definitions, {len(cases)} param sets, {len(mismatches)} mismatches")
+    if mismatches:
+        for defn_id, params in mismatches:
+            print(f"  MISMATCH {defn_id} with {params}")
+        return 1
+
+    # The largest body template is the worst case for the per-call copy
+    defn = max(definitions, key=lambda d: len(json.dumps(d["request"].get("body_template", {}))))
+    params = _param_sets(defn)[0]
+    print(f"per-call cost for {defn['id']}:")
+    _report("before (deepcopy + re-walk)", timeit.timeit(lambda: _legacy_build_request(defn, params, "sk"), number=number), number)
+    _report("compiled plan", timeit.timeit(lambda: build_request(defn, params, "sk"), number=number), number)
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# startup — definition loading
+# ---------------------------------------------------------------------------
+
+STARTUP_DEFINITIONS = 3000
+
+# Imports the app (which loads every definition) and serves one catalog request
+_FIRST_REQUEST = """
+import time
+start = time.perf_counter()
+import app
+resp = app.app.test_client().get("/api/definitions")
+assert resp.status_code == 200, resp.status_code
+print(time.perf_counter() - start)
+"""
+
+
+def _write_generated_definitions(root, count):
+    """Write count definitions, cycling through the shipped ones with fresh ids."""
+    shipped = _load_definitions()
+    for i in range(count):
+        defn = dict(shipped[i % len(shipped)])
+        defn["id"] = f"{defn['id']}-{i}"
+        defn["name"] = f"{defn['name']} #{i}"
+        provider_dir = os.path.join(root, defn["provider"])
+        os.makedirs(provider_dir, exist_ok=True)
+        with open(os.path.join(provider_dir, f"{defn['id']}.json"), "w") as f:
+            json.dump(defn, f, indent=2)
+
+
+def _time_first_request(env):
+    out = subprocess.run(
+        [sys.executable, "-c", _FIRST_REQUEST], cwd=HERE, env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def bench_startup(number):
+    from registry import Registry
+
+    tmp = tempfile.mkdtemp(prefix="arcade-bench-")
+    try:
+        defs_dir = os.path.join(tmp, "definitions")
+        cache_path = os.path.join(tmp, "definitions.snapshot")
+        _write_generated_definitions(defs_dir, STARTUP_DEFINITIONS)
+        print(f"startup: {STARTUP_DEFINITIONS} generated definitions")
+
+        def load(use_cache):
+            if not use_cache and os.path.exists(cache_path):
+                os.remove(cache_path)
+            start = time.perf_counter()
+            registry = Registry(defs_dir, os.path.join(tmp, ".env"), cache_path)
+            registry.reload()
+            return time.perf_counter() - start
+
+        print("registry load (best of 3):")
+        print(f"  {'no snapshot (parse all)':<28} {min(load(False) for _ in range(3)) * 1000:8.1f} ms")
+        print(f"  {'snapshot, lazy bodies':<28} {min(load(True) for _ in range(3)) * 1000:8.1f} ms")
+
+        env = dict(os.environ, ARCADE_DEFINITIONS_DIR=defs_dir, ARCADE_DEFINITIONS_CACHE=cache_path,
+                   ARCADE_RELOAD_INTERVAL="0")
+        cold = []
+        for _ in range(3):
+            os.remove(cache_path)
+            cold.append(_time_first_request(env))
+        warm = [_time_first_request(env) for _ in range(3)]
+        print("import app + first /api/definitions (best of 3):")
+        print(f"  {'no snapshot (parse all)':<28} {min(cold) * 1000:8.1f} ms")
+        print(f"  {'snapshot, lazy bodies':<28} {min(warm) * 1000:8.1f} ms")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# validate — validate.py over generated definitions
+# ---------------------------------------------------------------------------
+
+
+def _time_validate(defs_dir, *args, env=None):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(HERE, "validate.py"), defs_dir, *args], check=True,
+                   capture_output=True, env=env)
+    return time.perf_counter() - start
+
+
+def bench_validate(number):
+    tmp = tempfile.mkdtemp(prefix="arcade-bench-")
+    try:
+        defs_dir = os.path.join(tmp, "definitions")
+        _write_generated_definitions(defs_dir, STARTUP_DEFINITIONS)
+        print(f"validate: {STARTUP_DEFINITIONS} generated definitions, {os.cpu_count()} CPUs")
+        serial = min(_time_validate(defs_dir, "--no-cache", "-j", "1") for _ in range(3))
+        parallel = min(_time_validate(defs_dir, "--no-cache") for _ in range(3))
+        env = dict(os.environ, ARCADE_VALIDATE_CACHE=os.path.join(tmp, "validate.json"))
+        _time_validate(defs_dir, env=env)
+        cached = min(_time_validate(defs_dir, env=env) for _ in range(3))
+        print("python validate.py (best of 3):")
+        print(f"  {'one process, no cache':<28} {serial * 1000:8.1f} ms")
+        print(f"  {'process pool, no cache':<28} {parallel * 1000:8.1f} ms")
+        print(f"  {'unchanged (cached)':<28} {cached * 1000:8.1f} ms")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=["extract", "build", "startup", "validate"])
+    parser.add_argument("-n", "--number", type=int, default=200_000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    benchmarks = {"extract": bench_extract, "build": bench_build, "startup": bench_startup, "validate": bench_validate}
+    sys.exit(benchmarks[args.benchmark](args.number))
+
+
+if __name__ == "__main__":
+    main()
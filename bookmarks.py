@@ -0,0 +1,210 @@
+"""Bookmark store: one SQLite row per saved configuration.
+
+Each bookmark is the client's saved state (mode, definition ids, params)
+kept as a JSON document, with its name, mode and timestamp in columns and
+the definition ids it uses in an indexed side table. Every change is its
+own transaction, so two tabs saving at once both land. SQLite runs in WAL
+mode, letting reads proceed while a write is in progress.
+
+On first use an existing bookmarks.json is imported in one transaction and
+renamed to bookmarks.json.migrated.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.getenv("ARCADE_BOOKMARKS_DB", os.path.join(HERE, "bookmarks.db"))
+LEGACY_JSON = os.path.join(HERE, "bookmarks.json")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bookmarks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL DEFAULT '',
+    mode TEXT,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bookmark_definitions (
+    definition_id TEXT NOT NULL,
+    bookmark_id INTEGER NOT NULL REFERENCES bookmarks(id) ON DELETE CASCADE,
+    PRIMARY KEY (definition_id, bookmark_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bookmark_definitions_bookmark ON bookmark_definitions (bookmark_id);
+"""
+
+
+def definition_ids(state):
+    """Definition ids a saved state refers to (play slot, or both compare sides)."""
+    ids = []
+    if isinstance(state.get("play"), dict):
+        ids.append(state["play"].get("definitionId"))
+    if isinstance(state.get("compare"), dict):
+        for side in ("left", "right"):
+            if isinstance(state["compare"].get(side), dict):
+                ids.append(state["compare"][side].get("definitionId"))
+    return sorted({i for i in ids if isinstance(i, str) and i})
+
+
+class BookmarkStore:
+    """CRUD over the bookmarks database, one connection per thread."""
+
+    def __init__(self, path=DB_PATH, legacy_json=LEGACY_JSON):
+        self.path = path
+        self.legacy_json = legacy_json
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(SCHEMA)
+                    self._migrate_json(conn)
+                    self._initialized = True
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    def _migrate_json(self, conn):
+        """Import bookmarks.json once, if the database is still empty."""
+        if not os.path.exists(self.legacy_json):
+            return
+        try:
+            with open(self.legacy_json) as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Not migrating %s: %s", self.legacy_json, e)
+            return
+        states = [s for s in legacy if isinstance(s, dict)] if isinstance(legacy, list) else []
+        with _Transaction(conn):
+            if conn.execute("SELECT 1 FROM bookmarks LIMIT 1").fetchone():
+                return
+            for state in states:
+                self._insert(conn, state)
+        os.replace(self.legacy_json, self.legacy_json + ".migrated")
+        logger.warning("Migrated %d bookmarks from %s", len(states), self.legacy_json)
+
+    # -----------------------------------------------------------------------
+    # CRUD
+    # -----------------------------------------------------------------------
+
+    def list(self, definition_id=None):
+        """All bookmarks in creation order, optionally only those using definition_id."""
+        conn = self._conn()
+        if definition_id:
+            rows = conn.execute(
+                "SELECT b.id, b.data FROM bookmark_definitions d JOIN bookmarks b ON b.id = d.bookmark_id"
+                " WHERE d.definition_id = ? ORDER BY b.id",
+                (definition_id,),
+            )
+        else:
+            rows = conn.execute("SELECT id, data FROM bookmarks ORDER BY id")
+        return [_to_bookmark(row) for row in rows]
+
+    def get(self, bookmark_id):
+        row = self._conn().execute("SELECT id, data FROM bookmarks WHERE id = ?", (bookmark_id,)).fetchone()
+        return _to_bookmark(row) if row else None
+
+    def create(self, state):
+        """Insert one bookmark and return it with its new id."""
+        with self._transaction() as conn:
+            bookmark_id = self._insert(conn, state)
+        return self.get(bookmark_id)
+
+    def update(self, bookmark_id, state):
+        """Replace a bookmark's saved state. Returns the bookmark, or None if missing."""
+        state = _strip_id(state)
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE bookmarks SET name = ?, mode = ?, updated_at = ?, data = ? WHERE id = ?",
+                (*_columns(state), _now_ms(), json.dumps(state), bookmark_id),
+            )
+            if not cur.rowcount:
+                return None
+            conn.execute("DELETE FROM bookmark_definitions WHERE bookmark_id = ?", (bookmark_id,))
+            _index_definitions(conn, bookmark_id, state)
+        return self.get(bookmark_id)
+
+    def delete(self, bookmark_id):
+        """Delete a bookmark. Returns False if it did not exist."""
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM bookmarks WHERE id = ?", (bookmark_id,)).rowcount > 0
+
+    def replace_all(self, states):
+        """Overwrite every bookmark with an array (the pre-CRUD save format)."""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM bookmarks")
+            for state in states:
+                self._insert(conn, state)
+        return self.list()
+
+    def _insert(self, conn, state):
+        state = _strip_id(state)
+        created = state.get("timestamp") if isinstance(state.get("timestamp"), int) else _now_ms()
+        cur = conn.execute(
+            "INSERT INTO bookmarks (name, mode, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?)",
+            (*_columns(state), created, _now_ms(), json.dumps(state)),
+        )
+        _index_definitions(conn, cur.lastrowid, state)
+        return cur.lastrowid
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK, taking the write lock up front."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def _index_definitions(conn, bookmark_id, state):
+    conn.executemany(
+        "INSERT INTO bookmark_definitions (definition_id, bookmark_id) VALUES (?, ?)",
+        [(definition_id, bookmark_id) for definition_id in definition_ids(state)],
+    )
+
+
+def _columns(state):
+    """(name, mode) column values for a saved state."""
+    mode = state.get("mode")
+    return str(state.get("name", "")), None if mode is None else str(mode)
+
+
+def _to_bookmark(row):
+    return dict(json.loads(row["data"]), id=row["id"])
+
+
+def _strip_id(state):
+    return {k: v for k, v in state.items() if k != "id"}
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+bookmark_store = BookmarkStore()
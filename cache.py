@@ -0,0 +1,177 @@
+"""Opt-in response cache for repeatable generations.
+
+Entries are keyed by definition id plus the canonicalized URL and body
+produced by build_request(), so the same example prompt with the same
+params hits the cache no matter which tab sent it. Auth headers are never
+part of the key or the stored value.
+
+Two tiers: a bounded in-memory LRU, backed by a size-capped directory of
+JSON files that survives restarts. A definition opts in with a "cache"
+block, e.g. {"cache": {"ttl_seconds": 3600}}; ARCADE_CACHE_TTL sets a
+default TTL for every definition (0 = disabled).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = float(os.getenv("ARCADE_CACHE_TTL", "0"))
+MEMORY_ENTRIES = int(os.getenv("ARCADE_CACHE_MEMORY_ENTRIES", "256"))
+DISK_DIR = os.getenv(
+    "ARCADE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "responses")
+)
+DISK_MAX_BYTES = int(float(os.getenv("ARCADE_CACHE_DISK_MB", "256")) * 1024 * 1024)
+
+
+def cache_ttl(definition):
+    """Return the cache TTL in seconds for a definition (0 = not cached)."""
+    conf = definition.get("cache", {})
+    return float(conf.get("ttl_seconds", DEFAULT_TTL))
+
+
+def cache_key(definition_id, url, body):
+    """Build a stable key from the definition id and the outgoing request."""
+    canonical = json.dumps(
+        {"definition_id": definition_id, "url": url, "body": body},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier (memory LRU + disk) cache of JSON-serializable values."""
+
+    def __init__(self, max_entries=MEMORY_ENTRIES, disk_dir=DISK_DIR, disk_max_bytes=DISK_MAX_BYTES):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()  # key -> (stored_at, expires_at, value)
+        self._disk_sizes = None  # key -> file size, loaded on first disk access
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (value, tier, age_seconds) or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    return value, "memory", now - stored_at
+                del self._memory[key]
+
+        entry = self._read_disk(key)
+        if entry is None:
+            return None
+        stored_at, expires_at, value = entry
+        if expires_at <= now:
+            self._delete_disk(key)
+            return None
+        with self._lock:
+            self._remember(key, entry)
+        return value, "disk", now - stored_at
+
+    def put(self, key, value, ttl):
+        """Store a value in both tiers for ttl seconds."""
+        if ttl <= 0:
+            return
+        now = time.time()
+        entry = (now, now + ttl, value)
+        with self._lock:
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+
+    def _remember(self, key, entry):
+        """Insert into the memory tier, evicting least-recently used. Caller holds _lock."""
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    # --- Disk tier ---
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _load_disk_index(self):
+        """Scan the cache directory once to learn current file sizes. Caller holds _lock."""
+        if self._disk_sizes is not None:
+            return
+        self._disk_sizes = {}
+        if not os.path.isdir(self.disk_dir):
+            return
+        for root, _dirs, files in os.walk(self.disk_dir):
+            for fname in files:
+                if fname.endswith(".json"):
+                    try:
+                        self._disk_sizes[fname[:-5]] = os.path.getsize(os.path.join(root, fname))
+                    except OSError:
+                        continue
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key)) as f:
+                data = json.load(f)
+            return data["stored_at"], data["expires_at"], data["value"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, entry):
+        if self.disk_max_bytes <= 0:
+            return
+        stored_at, expires_at, value = entry
+        payload = json.dumps({"stored_at": stored_at, "expires_at": expires_at, "value": value})
+        if len(payload) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "w") as f:
+                f.write(payload)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            self._load_disk_index()
+            self._disk_sizes[key] = len(payload)
+            self._enforce_disk_cap()
+
+    def _delete_disk(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+        with self._lock:
+            if self._disk_sizes is not None:
+                self._disk_sizes.pop(key, None)
+
+    def _enforce_disk_cap(self):
+        """Delete the oldest files until the disk tier fits. Caller holds _lock."""
+        total = sum(self._disk_sizes.values())
+        if total <= self.disk_max_bytes:
+            return
+        by_age = []
+        for key in self._disk_sizes:
+            try:
+                by_age.append((os.path.getmtime(self._path(key)), key))
+            except OSError:
+                by_age.append((0, key))
+        by_age.sort()
+        for _mtime, key in by_age:
+            if total <= self.disk_max_bytes:
+                break
+            total -= self._disk_sizes.pop(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,147 @@
+"""Precomputed, pre-encoded bodies for the playground page and definition API.
+
+The catalog (one summary row per definition) is serialized once per load
+and every definition's JSON once on first request, hashed for an ETag,
+and compressed ahead of time with gzip (and brotli when the optional
+`brotli` package is installed). Requests then only pick a representation:
+a revalidation with a matching If-None-Match is answered 304, anything
+else gets the stored bytes without re-serializing or re-compressing.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # optional: gzip alone is always available
+    brotli = None
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 512
+
+
+class EncodedBody:
+    """One response body with its ETag and precompressed variants."""
+
+    __slots__ = ("raw", "encoded", "etag", "mimetype")
+
+    def __init__(self, data, mimetype):
+        self.raw = data
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(data).hexdigest()[:32]
+        self.encoded = {}  # content-coding -> precompressed bytes
+        if len(data) >= MIN_COMPRESS_BYTES:
+            if brotli is not None:
+                self.encoded["br"] = brotli.compress(data)
+            self.encoded["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(json.dumps(value, separators=(",", ":")).encode("utf-8"), "application/json")
+
+    def select(self, accept_encodings):
+        """Return (coding or None, bytes) for a request's Accept-Encoding."""
+        for coding in ("br", "gzip"):
+            if coding in self.encoded and accept_encodings[coding]:
+                return coding, self.encoded[coding]
+        return None, self.raw
+
+
+def send_encoded(body, request):
+    """Serve an EncodedBody, answering 304 when the client's copy is current.
+
+    Responses are marked no-cache so browsers revalidate on every use, which
+    costs a bodiless 304 once they hold the current version.
+    """
+    coding, data = body.select(request.accept_encodings)
+    etag = f"{body.etag}-{coding}" if coding else body.etag
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(data, mimetype=body.mimetype)
+        if coding:
+            resp.headers["Content-Encoding"] = coding
+    resp.set_etag(etag)
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.cache_control.no_cache = True
+    return resp
+
+
+def catalog_row(definition):
+    """A definition's palette summary (everything but the provider display name)."""
+    model_param = next(
+        (p for p in definition.get("request", {}).get("params", []) if p.get("name") == "model"),
+        None,
+    )
+    return {
+        "id": definition["id"],
+        "name": definition["name"],
+        "provider": definition["provider"],
+        "provider_url": definition.get("provider_url", ""),
+        "output_type": (definition.get("response", {}).get("outputs") or [{}])[0].get("type", "text"),
+        "model_count": len(model_param.get("options", [])) if model_param else 0,
+    }
+
+
+def catalog_entries(summaries, provider_names):
+    """Summary rows for the command palette, sorted by name."""
+    entries = []
+    for row in summaries.values():
+        provider = row["provider"]
+        entries.append({
+            "id": row["id"],
+            "name": row["name"],
+            "provider": provider,
+            "provider_display_name": provider_names.get(provider, provider.title()),
+            "provider_url": row["provider_url"],
+            "output_type": row["output_type"],
+            "model_count": row["model_count"],
+        })
+    entries.sort(key=lambda d: d["name"])
+    return entries
+
+
+class Catalog:
+    """Everything the UI reads about the loaded definitions, encoded once.
+
+    summaries maps id -> catalog_row() and is all that is needed up front;
+    a definition's full body is encoded the first time it is requested.
+    Pass the previous Catalog on reload: definitions whose summary is the
+    same object as before (an unchanged file) keep their encoded bodies.
+    """
+
+    def __init__(self, definitions, summaries, provider_names, api_keys, previous=None):
+        self.entries = catalog_entries(summaries, provider_names)
+        self.providers_with_keys = list(api_keys.keys())
+        self.catalog_body = EncodedBody.from_json({"definitions": self.entries, "api_keys": self.providers_with_keys})
+        self._definitions = definitions
+        self._summaries = summaries
+        self._bodies = {}  # id -> EncodedBody, filled on first request
+        if previous is not None:
+            for did, body in previous._bodies.items():
+                if did in summaries and summaries[did] is previous._summaries.get(did):
+                    self._bodies[did] = body
+        self._page = None
+        self._page_lock = threading.Lock()
+
+    def definition_body(self, definition_id):
+        """Return the EncodedBody for one definition, or None if it is unknown."""
+        body = self._bodies.get(definition_id)
+        if body is None:
+            definition = self._definitions.get(definition_id)
+            if definition is None:
+                return None
+            body = self._bodies.setdefault(definition_id, EncodedBody.from_json(definition))
+        return body
+
+    def page(self, render):
+        """Return the rendered playground page, calling render() only the first time."""
+        if self._page is None:
+            with self._page_lock:
+                if self._page is None:
+                    self._page = EncodedBody(render().encode("utf-8"), "text/html")
+        return self._page
@@ -0,0 +1,327 @@
+"""Deadlines for upstream calls, and cancelling them when nobody is waiting.
+
+A definition can set its own time budgets in a "timeouts" block (seconds):
+
+    {"timeouts": {"request": 120, "poll": 10, "result": 60, "cancel": 10, "job": 3600}}
+
+request bounds a generation including its retries and hedges; poll,
+result and cancel bound one status check, result fetch or cancel call;
+job bounds how long the server-side poller follows an async job.
+
+The defaults (DEFAULT_TIMEOUTS) only bound each socket read, so a long
+generation or a stream that keeps producing tokens runs as long as it
+needs. A value the definition declares is a wall-clock limit: a socket
+timeout cannot stop a provider trickling bytes, so Deadline.read() has a
+watchdog thread close the response once the budget runs out, ending a
+body read in progress (streams get the same limit from aiohttp's total
+timeout).
+
+A Cancellation is handed to an upstream stream when it is opened and
+cancels it (closing the socket) when the caller gives up. watch_disconnect()
+notices a browser closing its connection as soon as the FIN arrives,
+instead of at the next failed write, so an abandoned stream stops reading
+from, and paying for, its provider right away.
+"""
+
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+
+import requests as http_requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUTS = {"request": 60, "poll": 15, "result": 30, "cancel": 15, "job": 30 * 60}
+
+
+def timeout_for(definition, kind):
+    """The definition's time budget in seconds for kind (see DEFAULT_TIMEOUTS)."""
+    timeouts = definition.get("timeouts")
+    value = timeouts.get(kind) if isinstance(timeouts, dict) else None
+    return value if isinstance(value, (int, float)) and value > 0 else DEFAULT_TIMEOUTS[kind]
+
+
+def declared_timeout(definition, kind):
+    """The definition's own time budget for kind, or None when it relies on the default."""
+    timeouts = definition.get("timeouts")
+    value = timeouts.get(kind) if isinstance(timeouts, dict) else None
+    return value if isinstance(value, (int, float)) and value > 0 else None
+
+
+def deadline_for(definition, kind):
+    """A Deadline for kind: wall-clock if the definition declares it, else per-read."""
+    declared = declared_timeout(definition, kind)
+    return Deadline(declared or DEFAULT_TIMEOUTS[kind], wall_clock=declared is not None)
+
+
+class DeadlineExceeded(http_requests.Timeout):
+    """Raised when a call's time budget is spent before it could (re)try."""
+
+
+class Deadline:
+    """A time budget shared by every attempt of one call.
+
+    The clock starts at the first attempt, so time spent queued behind a
+    provider's rate limits is not charged to it. Without wall_clock the
+    budget still stops new retries, but a body read is only bounded per
+    socket read.
+    """
+
+    def __init__(self, seconds, wall_clock=True):
+        self.seconds = seconds
+        self.wall_clock = wall_clock
+        self.expires = None
+
+    def remaining(self):
+        if self.expires is None:
+            return self.seconds
+        return max(0.0, self.expires - time.monotonic())
+
+    def timeout(self):
+        """Seconds left for the next attempt. Raises DeadlineExceeded once none are."""
+        if self.expires is None:
+            self.expires = time.monotonic() + self.seconds
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline of {self.seconds}s exceeded")
+        return remaining
+
+    def read(self, resp):
+        """Return a streamed requests response's body, read within the deadline.
+
+        requests' timeout= only bounds each socket read, so a watchdog closes
+        the response if the budget runs out first; that raises DeadlineExceeded.
+        Without wall_clock the body is read under the per-read timeout alone.
+        """
+        if not self.wall_clock:
+            return resp.content
+        if self.expires is None:
+            self.expires = time.monotonic() + self.seconds
+        entry = _watchdog.add(self.expires, resp)
+        try:
+            return resp.content
+        finally:
+            if not _watchdog.cancel(entry):
+                raise DeadlineExceeded(f"Deadline of {self.seconds}s exceeded")
+
+
+class _Watchdog:
+    """One thread closing responses whose deadline passes while they are still being read."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []  # [expires, seq, resp]; resp is None once cancelled or closed
+        self._seq = itertools.count()
+        self._thread = None
+
+    def add(self, expires, resp):
+        entry = [expires, next(self._seq), resp]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="deadline-watchdog", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        """Stop watching; False if the response was already closed for running out of time."""
+        with self._cond:
+            if entry[2] is None:
+                return False
+            entry[2] = None
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0][2] is None:
+                        heapq.heappop(self._heap)
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        entry = heapq.heappop(self._heap)
+                        resp, entry[2] = entry[2], None
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            try:
+                _abort(resp)
+            except Exception:
+                logger.exception("Could not close a response past its deadline")
+
+
+def _abort(resp):
+    """Close a requests response, waking a thread blocked reading it.
+
+    Closing a socket does not interrupt a recv() already waiting on it in
+    another thread; shutting it down does.
+    """
+    connection = getattr(getattr(resp, "raw", None), "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    resp.close()
+
+
+_watchdog = _Watchdog()
+
+
+class Cancellation:
+    """Cancels the upstream streams attached to it once the caller gives up."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams = []
+        self.cancelled = False
+
+    def attach(self, stream):
+        """Track an open stream (anything with close()); closed at once if already cancelled."""
+        with self._lock:
+            if not self.cancelled:
+                self._streams.append(stream)
+                return
+        stream.close()
+
+    def check(self):
+        """Raise before starting new upstream work for a cancelled call."""
+        if self.cancelled:
+            raise http_requests.ConnectionError("Upstream request cancelled")
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            streams, self._streams = self._streams, []
+        for stream in streams:
+            stream.close()
+
+
+# ---------------------------------------------------------------------------
+# Client disconnect detection
+# ---------------------------------------------------------------------------
+
+
+class _Watch:
+    """One client connection being watched; stop() before the response ends."""
+
+    def __init__(self, watcher, sock, callback):
+        self._watcher = watcher
+        self.sock = sock
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._done = False
+
+    def fire(self):
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+        try:
+            self._callback()
+        except Exception:
+            logger.exception("Disconnect callback failed")
+
+    def stop(self):
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+        self._watcher._submit("remove", self)
+
+
+class _NoWatch:
+    def stop(self):
+        pass
+
+
+class _DisconnectWatcher:
+    """One thread selecting on every watched client socket for EOF."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = []
+        self._selector = None
+        self._wake_r = self._wake_w = None
+
+    def watch(self, sock, callback):
+        watch = _Watch(self, sock, callback)
+        self._submit("add", watch)
+        return watch
+
+    def _submit(self, op, watch):
+        with self._lock:
+            if self._selector is None:
+                self._selector = selectors.DefaultSelector()
+                self._wake_r, self._wake_w = socket.socketpair()
+                self._wake_r.setblocking(False)
+                self._selector.register(self._wake_r, selectors.EVENT_READ)
+                threading.Thread(target=self._run, name="disconnect-watcher", daemon=True).start()
+            self._ops.append((op, watch))
+        self._wake_w.send(b"\0")
+
+    def _apply_ops(self):
+        with self._lock:
+            ops, self._ops = self._ops, []
+        for op, watch in ops:
+            try:
+                if op == "add":
+                    self._selector.register(watch.sock, selectors.EVENT_READ, watch)
+                else:
+                    self._selector.unregister(watch.sock)
+            except (KeyError, ValueError, OSError):
+                pass  # already closed or unregistered
+
+    def _run(self):
+        while True:
+            for key, _events in self._selector.select():
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    self._apply_ops()
+                    continue
+                watch = key.data
+                try:
+                    self._selector.unregister(key.fileobj)
+                except (KeyError, ValueError):
+                    continue
+                if _closed_by_peer(watch.sock):
+                    watch.fire()
+
+
+def _closed_by_peer(sock):
+    """True if a readable client socket has reached EOF (it sends nothing else mid-response)."""
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (BlockingIOError, InterruptedError):
+        return False
+    except ValueError:
+        return False  # TLS sockets can't peek; stop watching
+    except OSError:
+        return True
+
+
+_watcher = _DisconnectWatcher()
+
+
+def watch_disconnect(environ, callback):
+    """Call callback() from a background thread if the client closes its connection.
+
+    Works under the Flask dev server and gunicorn (which expose the client
+    socket); elsewhere it does nothing. Returns a handle: stop() it in the
+    response's finally block.
+    """
+    sock = environ.get("werkzeug.socket") or environ.get("gunicorn.socket")
+    if sock is None:
+        return _NoWatch()
+    return _watcher.watch(sock, callback)
@@ -0,0 +1,313 @@
+"""Run history: every generation, stream and async job kept in SQLite.
+
+Each finished call appends one narrow row (when, which definition and
+model, outcome, latency, time to first byte/token, tokens). Request bodies,
+responses and outputs go to a separate content-addressed blob table,
+zlib-compressed, so the runs table stays small enough to scan quickly.
+Covering indexes on (definition, model, time) and on time keep window
+queries index-only at millions of rows.
+
+Recording never blocks a request: rows go onto a bounded queue, and a
+writer thread inserts them in batches, one transaction per batch. If the
+writer falls that far behind (a locked or slow disk), new rows are dropped
+with a warning rather than piling up in memory.
+
+Percentiles are computed inside SQLite with window functions, so a query
+returns a handful of ranked values per group instead of every row.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Empty string disables history
+DB_PATH = os.getenv("ARCADE_HISTORY_DB", os.path.join(HERE, "history.db"))
+# Rows inserted per write transaction
+WRITE_BATCH = 256
+# Rows waiting for the writer before new ones are dropped
+QUEUE_MAX = int(os.getenv("ARCADE_HISTORY_QUEUE_MAX", "10000"))
+PERCENTILES = (0.5, 0.9, 0.95, 0.99)
+_PERCENT = {p: round(p * 100) for p in PERCENTILES}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    route TEXT NOT NULL,
+    definition_id TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL,
+    http_status INTEGER,
+    latency_ms REAL,
+    ttfb_ms REAL,
+    ttft_ms REAL,
+    tokens INTEGER,
+    request_id TEXT,
+    error TEXT,
+    request_blob TEXT,
+    response_blob TEXT,
+    outputs_blob TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_definition_time
+    ON runs (definition_id, model, started_at, status, latency_ms, ttft_ms);
+CREATE INDEX IF NOT EXISTS runs_time
+    ON runs (started_at, definition_id, model, status, latency_ms, ttft_ms);
+CREATE INDEX IF NOT EXISTS runs_definition_recent ON runs (definition_id, id);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+) WITHOUT ROWID;
+"""
+
+RUN_COLUMNS = (
+    "id", "started_at", "route", "definition_id", "provider", "model", "status", "http_status",
+    "latency_ms", "ttfb_ms", "ttft_ms", "tokens", "request_id", "error",
+)
+_BLOB_FIELDS = ("request", "response", "outputs")
+
+
+class HistoryStore:
+    """Append-only run log with a background batch writer."""
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._queue = queue.Queue(maxsize=QUEUE_MAX)
+        self._dropped = 0
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self._writer = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(SCHEMA)
+                    self._initialized = True
+        return conn
+
+    # -----------------------------------------------------------------------
+    # Writing
+    # -----------------------------------------------------------------------
+
+    def record(self, route, definition, params, status, latency, http_status=None, ttfb=None,
+               ttft_ms=None, tokens=None, request_id=None, error=None, request=None, response=None,
+               outputs=None):
+        """Queue one finished run. Times are seconds except ttft_ms; never blocks."""
+        if not self.enabled:
+            return
+        row = {
+            "started_at": time.time() - latency,
+            "route": route,
+            "definition_id": definition["id"],
+            "provider": definition["provider"],
+            "model": str((params or {}).get("model") or ""),
+            "status": status,
+            "http_status": http_status,
+            "latency_ms": round(latency * 1000, 1),
+            "ttfb_ms": round(ttfb * 1000, 1) if ttfb is not None else None,
+            "ttft_ms": ttft_ms,
+            "tokens": tokens,
+            "request_id": request_id,
+            "error": error if error is None or isinstance(error, str) else json.dumps(error),
+            "request": request,
+            "response": response,
+            "outputs": outputs,
+        }
+        if self._writer is None:
+            self._start_writer()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self._dropped += 1
+            if self._dropped == 1 or self._dropped % 1000 == 0:
+                logger.warning("History writer is %d rows behind; %d runs dropped so far", QUEUE_MAX, self._dropped)
+
+    def _start_writer(self):
+        with self._init_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            rows = [self._queue.get()]
+            while len(rows) < WRITE_BATCH:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._insert(rows)
+            except sqlite3.Error:
+                logger.exception("Could not write %d history rows", len(rows))
+            finally:
+                for _ in rows:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Block until every queued row is written."""
+        self._queue.join()
+
+    def _insert(self, rows):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in rows:
+                hashes = [_put_blob(conn, row[field]) for field in _BLOB_FIELDS]
+                conn.execute(
+                    f"INSERT INTO runs ({', '.join(RUN_COLUMNS[1:])}, request_blob, response_blob, outputs_blob)"
+                    f" VALUES ({', '.join('?' * (len(RUN_COLUMNS) + 2))})",
+                    [row[c] for c in RUN_COLUMNS[1:]] + hashes,
+                )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # -----------------------------------------------------------------------
+    # Queries
+    # -----------------------------------------------------------------------
+
+    def recent(self, definition_id=None, limit=50, before=None):
+        """Newest runs first (without blobs); pass the last id as before= to page."""
+        where, args = [], []
+        if definition_id:
+            where.append("definition_id = ?")
+            args.append(definition_id)
+        if before:
+            where.append("id < ?")
+            args.append(before)
+        sql = f"SELECT {', '.join(RUN_COLUMNS)} FROM runs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        return [dict(row) for row in self._conn().execute(sql, args + [limit])]
+
+    def get(self, run_id):
+        """One run with its request, response and outputs."""
+        conn = self._conn()
+        row = conn.execute(
+            f"SELECT {', '.join(RUN_COLUMNS)}, request_blob, response_blob, outputs_blob FROM runs WHERE id = ?",
+            (run_id,),
+        ).fetchone()
+        if not row:
+            return None
+        run = {c: row[c] for c in RUN_COLUMNS}
+        for field in _BLOB_FIELDS:
+            run[field] = _get_blob(conn, row[f"{field}_blob"])
+        return run
+
+    def latency(self, definition_id=None, model=None, window=86400, bucket=None, now=None):
+        """Latency and TTFT percentiles per (definition, model[, time bucket]) over the last window seconds.
+
+        Only successful runs count toward percentiles; failed and user-cancelled
+        runs are counted separately (errors, cancelled).
+        """
+        now = time.time() if now is None else now
+        since = now - window
+        bucket = bucket or window
+        where, args = [], []
+        if definition_id:
+            where.append("definition_id = ?")
+            args.append(definition_id)
+        if model is not None:
+            where.append("model = ?")
+            args.append(model)
+        where.append("started_at >= ?")
+        args.append(since)
+        where = " AND ".join(where)
+        conn = self._conn()
+
+        groups = {}  # (definition_id, model, bucket index) -> series entry
+        for definition, run_model, index, count, errors, cancelled in conn.execute(
+            "SELECT definition_id, model, CAST((started_at - ?) / ? AS INTEGER) AS bucket,"
+            " COUNT(*), SUM(status = 'error'), SUM(status = 'cancelled')"
+            f" FROM runs WHERE {where} GROUP BY definition_id, model, bucket",
+            [since, bucket] + args,
+        ):
+            groups[(definition, run_model, index)] = {
+                "definition_id": definition,
+                "model": run_model,
+                "bucket_start": round(since + index * bucket, 3),
+                "count": count,
+                "errors": errors,
+                "cancelled": cancelled,
+                "latency_ms": None,
+                "ttft_ms": None,
+            }
+        for column in ("latency_ms", "ttft_ms"):
+            for key, summary in self._percentiles(conn, column, where, args, since, bucket).items():
+                groups[key][column] = summary
+        series = [groups[key] for key in sorted(groups)]
+        return {"window_seconds": window, "bucket_seconds": bucket, "since": round(since, 3), "series": series}
+
+    @staticmethod
+    def _percentiles(conn, column, where, args, since, bucket):
+        """Nearest-rank PERCENTILES and max of column for each group's successful runs.
+
+        Each group's values are ranked by a window function over the covering
+        index, and only the rows at the wanted ranks come back.
+        """
+        wanted = " OR ".join(f"pos = ({_PERCENT[p]} * n + 99) / 100" for p in PERCENTILES)
+        sql = (
+            "SELECT definition_id, model, bucket, n, pos, value FROM ("
+            "  SELECT definition_id, model, bucket, value,"
+            "   ROW_NUMBER() OVER (PARTITION BY definition_id, model, bucket ORDER BY value) AS pos,"
+            "   COUNT(*) OVER (PARTITION BY definition_id, model, bucket) AS n"
+            f"  FROM (SELECT definition_id, model, CAST((started_at - ?) / ? AS INTEGER) AS bucket, {column} AS value"
+            f"   FROM runs WHERE {where} AND status = 'ok' AND {column} IS NOT NULL)"
+            f") WHERE {wanted} OR pos = n"
+        )
+        ranked = {}  # (definition_id, model, bucket index) -> (n, {pos: value})
+        for definition, run_model, index, n, pos, value in conn.execute(sql, [since, bucket] + args):
+            ranked.setdefault((definition, run_model, index), (n, {}))[1][pos] = value
+        return {
+            key: {**{f"p{_PERCENT[p]}": values[_rank(p, n)] for p in PERCENTILES}, "max": values[n]}
+            for key, (n, values) in ranked.items()
+        }
+
+
+def _rank(p, n):
+    """1-based nearest rank of percentile p among n values: ceil(p * n), in integer math."""
+    return (_PERCENT[p] * n + 99) // 100
+
+
+def _put_blob(conn, value):
+    if value is None:
+        return None
+    data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    conn.execute("INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)", (digest, zlib.compress(data)))
+    return digest
+
+
+def _get_blob(conn, digest):
+    if not digest:
+        return None
+    row = conn.execute("SELECT data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+    return json.loads(zlib.decompress(row["data"])) if row else None
+
+
+history = HistoryStore()
@@ -0,0 +1,283 @@
+"""Server-side poller for polling-pattern definitions.
+
+Each (definition_id, request_id) pair gets one background poll loop. Any
+number of subscribers (browser tabs, compare slots) attach to the same job
+and receive its status changes and final result as pushed events, so the
+provider sees one status request per interval no matter how many watchers.
+
+A poll loop stops once nobody has subscribed for JOB_IDLE_SECONDS (a later
+subscriber starts a new one), and a 4xx status response (e.g. an unknown
+request id) ends the job with an error instead of polling until timeout.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+import requests as http_requests
+
+import metrics
+import retry
+from deadlines import timeout_for
+from history import history
+from proxy import build_auth_headers, build_result_url, build_status_url, check_done, extract_error, extract_outputs
+
+logger = logging.getLogger(__name__)
+
+# Give up after this many consecutive failed status checks
+MAX_POLL_ERRORS = 10
+# Keep finished jobs around so late subscribers still get the result
+JOB_RETENTION_SECONDS = 10 * 60
+# Stop polling a job nobody has subscribed to for this long
+JOB_IDLE_SECONDS = 60
+
+_jobs = {}  # (definition_id, request_id) -> Job
+_lock = threading.Lock()
+
+
+class Job:
+    """One upstream async job and the subscribers watching it."""
+
+    def __init__(self, definition, api_key, request_id, params=None):
+        self.definition = definition
+        self.api_key = api_key
+        self.request_id = request_id
+        self.params = params or {}  # the submission's params, for run history
+        self.started = time.monotonic()
+        self.finished_at = None
+        self.poll_count = 0
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._last_status = None  # most recent ("status", data) event
+        self._final = None  # terminal ("result" | "error", data) event
+        self._cancelled = threading.Event()
+        self._idle_since = self.started  # when the last subscriber left (or the job was created)
+
+    @property
+    def finished(self):
+        return self._final is not None
+
+    def subscribe(self):
+        """Return a queue that receives (event, data) tuples for this job.
+
+        The latest status and, if the job already finished, its terminal
+        event are replayed immediately.
+        """
+        q = queue.Queue()
+        with self._lock:
+            if self._last_status:
+                q.put(self._last_status)
+            if self._final:
+                q.put(self._final)
+            else:
+                self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+            if not self._subscribers:
+                self._idle_since = time.monotonic()
+
+    def _abandon_if_idle(self):
+        """Forget the job if nobody has watched it for JOB_IDLE_SECONDS. Returns True if so."""
+        key = (self.definition["id"], self.request_id)
+        with _lock:
+            with self._lock:
+                if self._subscribers or time.monotonic() - self._idle_since < JOB_IDLE_SECONDS:
+                    return False
+            if _jobs.get(key) is self:
+                del _jobs[key]
+        logger.info("Stopped polling %s: no subscribers for %ds", self.request_id, JOB_IDLE_SECONDS)
+        return True
+
+    def _publish(self, event, data, final=False):
+        with self._lock:
+            if final:
+                self._final = (event, data)
+                self.finished_at = time.monotonic()
+                metrics.observe_job(
+                    self.definition["provider"],
+                    self.definition["id"],
+                    "completed" if event == "result" else data.get("poll_status", "error"),
+                    self.finished_at - self.started,
+                    self.poll_count,
+                )
+                history.record(
+                    "job", self.definition, self.params,
+                    "ok" if event == "result" else "cancelled" if data.get("poll_status") == "cancelled" else "error",
+                    self.finished_at - self.started,
+                    request_id=self.request_id,
+                    error=data.get("error"),
+                    response=data.get("response"),
+                    outputs=data.get("outputs"),
+                )
+            elif event == "status":
+                self._last_status = (event, data)
+            subscribers = list(self._subscribers)
+            if final:
+                self._subscribers.clear()
+        for q in subscribers:
+            q.put((event, data))
+
+    def release_subscribers(self):
+        """Send every subscriber a "reconnect" event and drop them."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+        for q in subscribers:
+            q.put(("reconnect", {}))
+
+    def cancel(self):
+        """Stop polling; subscribers get a final "cancelled" error event."""
+        self._cancelled.set()
+
+    def _wait(self, seconds):
+        """Sleep between polls. Returns True if the job was cancelled meanwhile."""
+        if self._cancelled.wait(seconds):
+            self._publish("error", {"error": "Job cancelled.", "poll_status": "cancelled"}, final=True)
+            return True
+        return False
+
+    def run(self):
+        """Poll status_url until the job completes, fails, times out, is cancelled or is abandoned."""
+        try:
+            self._poll()
+        except Exception:
+            logger.exception("Poller for %s failed", self.request_id)
+            if not self.finished:
+                self._publish("error", {"error": "Polling failed.", "poll_status": "error"}, final=True)
+
+    def _poll(self):
+        defn = self.definition
+        interval = defn["interaction"].get("poll_interval_ms", 2000) / 1000
+        headers = build_auth_headers(defn, self.api_key)
+        status_url = build_status_url(defn, self.request_id)
+        max_seconds = timeout_for(defn, "job")
+        errors = 0
+
+        while time.monotonic() - self.started < max_seconds:
+            if self._wait(0) or self._abandon_if_idle():
+                return
+            self.poll_count += 1
+            started = time.monotonic()
+            resp = None
+            try:
+                resp, _attempts = retry.get(defn, status_url, headers, "poll")
+                resp_data = resp.json()
+                if 400 <= resp.status_code < 500 and resp.status_code != 429:
+                    # The provider rejected the request id or our key; polling again won't help
+                    error = extract_error(defn, resp_data) or f"Status check returned HTTP {resp.status_code}."
+                    self._publish("error", {
+                        "error": error, "poll_status": "error", "status_code": resp.status_code, "response": resp_data,
+                    }, final=True)
+                    return
+                if not resp.ok:
+                    raise http_requests.HTTPError(f"HTTP {resp.status_code}", response=resp)
+                errors = 0
+            except (http_requests.RequestException, ValueError) as e:
+                errors += 1
+                logger.error("Status check failed for %s: %s", self.request_id, e)
+                if errors >= MAX_POLL_ERRORS:
+                    self._publish("error", {"error": "Polling failed after too many errors.", "poll_status": "error"}, final=True)
+                    return
+                if self._wait(interval):
+                    return
+                continue
+            finally:
+                metrics.observe_response("poll", defn["provider"], defn["id"], resp, started)
+
+            poll_status = check_done(defn, resp_data)
+            self._publish("status", {"poll_status": poll_status, "response": resp_data, "poll_count": self.poll_count})
+
+            if poll_status == "done":
+                self._fetch_result(headers)
+                return
+            if poll_status == "failed":
+                self._publish("error", {"error": "Generation failed.", "poll_status": "failed", "response": resp_data}, final=True)
+                return
+            if self._wait(interval):
+                return
+
+        self._publish("error", {"error": "Job timed out.", "poll_status": "error"}, final=True)
+
+    def _fetch_result(self, headers):
+        defn = self.definition
+        started = time.monotonic()
+        resp = None
+        try:
+            resp, _attempts = retry.get(defn, build_result_url(defn, self.request_id), headers, "result")
+            resp_data = resp.json()
+            if not resp.ok:
+                raise http_requests.HTTPError(f"HTTP {resp.status_code}", response=resp)
+        except (http_requests.RequestException, ValueError) as e:
+            logger.error("Result fetch failed for %s: %s", self.request_id, e)
+            self._publish("error", {"error": "Failed to fetch result.", "poll_status": "error"}, final=True)
+            return
+        finally:
+            metrics.observe_response("result", defn["provider"], defn["id"], resp, started)
+        outputs = extract_outputs(defn, resp_data)
+        self._publish("result", {"response": resp_data, "outputs": outputs, "poll_count": self.poll_count}, final=True)
+
+
+def _purge_finished(now):
+    """Drop finished jobs past their retention window. Caller holds _lock."""
+    expired = [
+        key for key, job in _jobs.items()
+        if job.finished and now - job.finished_at > JOB_RETENTION_SECONDS
+    ]
+    for key in expired:
+        del _jobs[key]
+
+
+def get_job(definition_id, request_id):
+    """Return the job for (definition_id, request_id) if this server is polling or has polled it."""
+    with _lock:
+        return _jobs.get((definition_id, request_id))
+
+
+def drain():
+    """Hand job subscribers off before this process exits.
+
+    Their SSE feeds end with a "reconnect" event; the browser re-subscribes
+    and whichever server answers resumes polling the job.
+    """
+    with _lock:
+        jobs = list(_jobs.values())
+    for job in jobs:
+        job.release_subscribers()
+
+
+def subscribe_job(definition, api_key, request_id, params=None):
+    """ensure_job() and subscribe to it in one step. Returns (job, queue).
+
+    Unsubscribe the queue when done. Raises ValueError like ensure_job().
+    """
+    with _lock:
+        job = _ensure_job(definition, api_key, request_id, params)
+        return job, job.subscribe()
+
+
+def ensure_job(definition, api_key, request_id, params=None):
+    """Return the job for (definition, request_id), starting its poller if new.
+
+    params are the submission's params, recorded with the job in run history.
+
+    Raises ValueError if request_id contains unsafe characters.
+    """
+    with _lock:
+        return _ensure_job(definition, api_key, request_id, params)
+
+
+def _ensure_job(definition, api_key, request_id, params):
+    """ensure_job() body. Caller holds _lock."""
+    build_status_url(definition, request_id)  # validates request_id
+    key = (definition["id"], request_id)
+    _purge_finished(time.monotonic())
+    job = _jobs.get(key)
+    if job is None:
+        job = _jobs[key] = Job(definition, api_key, request_id, params)
+        threading.Thread(target=job.run, name=f"job-{request_id}", daemon=True).start()
+    return job
+
@@ -0,0 +1,112 @@
+"""Cached API key validation.
+
+Each provider's key is checked against its validation_url at most once per
+TTL. Callers always get the cached statuses right away, each with the time
+it was checked. An expired or missing entry starts a background re-check,
+and concurrent callers share that one in-flight request per provider
+rather than issuing their own. Results are keyed by a fingerprint of the
+key, so editing .env (see registry.py) invalidates them.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests as http_requests
+
+from upstream import session_for
+
+# Seconds a valid/invalid result is served before it is re-checked
+KEY_CHECK_TTL = float(os.getenv("ARCADE_KEY_CHECK_TTL", "600"))
+# Inconclusive results (timeouts, 5xx) are retried sooner
+UNKNOWN_TTL = min(KEY_CHECK_TTL, 60)
+
+
+def validate_key(provider, api_key, auth_info):
+    """Check one provider's API key. Returns 'valid', 'invalid' or 'unknown'."""
+    validation_url = auth_info.get("validation_url")
+    if not validation_url:
+        return "unknown"
+    headers = {
+        auth_info.get("header", "Authorization"): auth_info.get("prefix", "Bearer ") + api_key
+    }
+    try:
+        resp = session_for(provider).get(validation_url, headers=headers, timeout=5)
+        if resp.status_code == 200:
+            return "valid"
+        elif resp.status_code in (401, 403):
+            return "invalid"
+        else:
+            return "unknown"
+    except http_requests.RequestException:
+        return "unknown"
+
+
+class KeyChecker:
+    """TTL cache of key statuses with single-flight background refresh."""
+
+    def __init__(self, ttl=KEY_CHECK_TTL, workers=10):
+        self.ttl = ttl
+        self._results = {}  # (provider, key fingerprint, url) -> (status, checked_at)
+        self._inflight = {}  # same key -> Future of the running check
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="key-check")
+
+    def statuses(self, snapshot, wait_seconds=0):
+        """Return {"providers": {provider: {status, checked_at, stale}}, "refreshing": bool}.
+
+        Providers whose result is missing or expired are re-checked in the
+        background; pass wait_seconds to wait that long for those checks.
+        """
+        results, pending = self._read(snapshot)
+        if pending and wait_seconds > 0:
+            wait(pending, timeout=wait_seconds)
+            results, pending = self._read(snapshot, start=False)
+        return {"providers": results, "refreshing": bool(pending), "ttl_seconds": self.ttl}
+
+    def _read(self, snapshot, start=True):
+        now = time.time()
+        results = {}
+        pending = []
+        with self._lock:
+            for provider in snapshot.provider_names:
+                if provider not in snapshot.api_keys:
+                    results[provider] = {"status": "no_key", "checked_at": None, "stale": False}
+            for provider, api_key in snapshot.api_keys.items():
+                auth = snapshot.validation_auth.get(provider)
+                if not auth:
+                    # Key present but nothing to check it against
+                    results[provider] = {"status": "unknown", "checked_at": None, "stale": False}
+                    continue
+                key = (provider, _fingerprint(api_key), auth["validation_url"])
+                cached = self._results.get(key)
+                stale = cached is None or now - cached[1] >= (self.ttl if cached[0] != "unknown" else UNKNOWN_TTL)
+                future = self._inflight.get(key)
+                if stale and future is None and start:
+                    future = self._inflight[key] = self._pool.submit(self._check, key, provider, api_key, auth)
+                if future is not None and not future.done():
+                    pending.append(future)
+                results[provider] = {
+                    "status": cached[0] if cached else "unknown",
+                    "checked_at": round(cached[1], 3) if cached else None,
+                    "stale": stale,
+                }
+        return results, pending
+
+    def _check(self, key, provider, api_key, auth):
+        status = "unknown"
+        try:
+            status = validate_key(provider, api_key, auth)
+        finally:
+            with self._lock:
+                self._results[key] = (status, time.time())
+                self._inflight.pop(key, None)
+
+
+def _fingerprint(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+key_checker = KeyChecker()
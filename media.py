@@ -0,0 +1,317 @@
+"""Local handling of binary outputs: streaming passthrough and a media store.
+
+Streaming passthrough: instead of buffering a binary response and inlining
+it as a base64 data: URL, /api/generate hands the open upstream response to
+a MediaStream. A background thread spools the bytes to a temp file as they
+arrive, and /api/media/<id> serves that file to the browser while it is
+still growing, so playback starts before the provider has finished sending.
+HTTP Range requests are answered from the spooled bytes.
+
+Media store: decoded base64 outputs (images, audio) are written once to a
+content-addressed directory keyed by their SHA-256 and served from
+/media/<hash>.<ext> with long-lived cache headers. Identical outputs share
+one file, and the store evicts least-recently-written files past its cap.
+"""
+
+import base64
+import binascii
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+import requests as http_requests
+
+logger = logging.getLogger(__name__)
+
+# Keep finished passthrough media available for replays and seeks this long
+MEDIA_TTL_SECONDS = int(os.getenv("ARCADE_MEDIA_TTL_SECONDS", "1800"))
+STORE_DIR = os.getenv(
+    "ARCADE_MEDIA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "media")
+)
+STORE_MAX_BYTES = int(float(os.getenv("ARCADE_MEDIA_STORE_MB", "512")) * 1024 * 1024)
+# Give up on a reader waiting this long for the next upstream bytes
+READ_WAIT_SECONDS = 60
+
+CHUNK_SIZE = 64 * 1024
+
+_streams = {}  # media id -> MediaStream
+_lock = threading.Lock()
+
+
+class MediaStream:
+    """A binary upstream response being spooled to disk for concurrent readers."""
+
+    def __init__(self, resp, mime, on_complete=None):
+        self.id = uuid.uuid4().hex
+        self.on_complete = on_complete  # called with the byte count once spooled
+        self.mime = mime
+        self.created = time.monotonic()
+        length = resp.headers.get("Content-Length")
+        self.expected_length = int(length) if length and length.isdigit() else None
+        self.size = 0  # bytes spooled so far
+        self.complete = False
+        self.error = None
+        self._cond = threading.Condition()
+        fd, self.path = tempfile.mkstemp(prefix="arcade-media-")
+        self._file = os.fdopen(fd, "wb")
+        threading.Thread(target=self._pump, args=(resp,), name=f"media-{self.id}", daemon=True).start()
+
+    @property
+    def length(self):
+        """Total size in bytes if known (finished, or declared by the provider)."""
+        if self.complete and self.error is None:
+            return self.size
+        return self.expected_length
+
+    def _pump(self, resp):
+        try:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                if not chunk:
+                    continue
+                self._file.write(chunk)
+                self._file.flush()
+                with self._cond:
+                    self.size += len(chunk)
+                    self._cond.notify_all()
+        except http_requests.RequestException as e:
+            self.error = str(e)
+        finally:
+            resp.close()
+            self._file.close()
+            with self._cond:
+                self.complete = True
+                self._cond.notify_all()
+            if self.on_complete:
+                self.on_complete(self.size)
+
+    def wait_for(self, offset):
+        """Block until more than offset bytes are spooled or the stream ends.
+
+        Returns False if the upstream stalled for READ_WAIT_SECONDS.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.size > offset or self.complete, timeout=READ_WAIT_SECONDS)
+
+    def wait_complete(self):
+        """Block until the upstream response has been fully spooled."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.complete, timeout=READ_WAIT_SECONDS)
+
+    def iter_range(self, start, end=None):
+        """Yield bytes [start, end] (inclusive), following the spool as it grows."""
+        offset = start
+        with open(self.path, "rb") as f:
+            while end is None or offset <= end:
+                if offset >= self.size:
+                    if self.complete or not self.wait_for(offset):
+                        return
+                    if offset >= self.size:
+                        return
+                available = self.size if end is None else min(self.size, end + 1)
+                f.seek(offset)
+                chunk = f.read(min(CHUNK_SIZE, available - offset))
+                if not chunk:
+                    return
+                offset += len(chunk)
+                yield chunk
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _purge_expired(now):
+    """Delete finished passthrough media past MEDIA_TTL_SECONDS. Caller holds _lock."""
+    expired = [
+        media_id for media_id, media in _streams.items()
+        if media.complete and now - media.created > MEDIA_TTL_SECONDS
+    ]
+    for media_id in expired:
+        _streams.pop(media_id).discard()
+
+
+def start_passthrough(resp, mime, on_complete=None):
+    """Start spooling a streaming requests.Response; returns its MediaStream."""
+    media = MediaStream(resp, mime, on_complete)
+    with _lock:
+        _purge_expired(time.monotonic())
+        _streams[media.id] = media
+    return media
+
+
+def get_media(media_id):
+    """Return the MediaStream for an id, or None."""
+    with _lock:
+        return _streams.get(media_id)
+
+
+# ---------------------------------------------------------------------------
+# Content-addressed media store
+# ---------------------------------------------------------------------------
+
+STORE_NAME_RE = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]+)?$")
+
+
+class MediaStore:
+    """Write-once, content-addressed files with a total size cap."""
+
+    def __init__(self, root=STORE_DIR, max_bytes=STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._sizes = None  # file name -> size, loaded on first write
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def has(self, name):
+        return os.path.exists(self.path(name))
+
+    def put(self, data, mime):
+        """Store bytes and return their file name (<sha256><ext>). Raises OSError if it can't be written."""
+        ext = mimetypes.guess_extension(mime) or ""
+        name = hashlib.sha256(data).hexdigest() + ext
+        path = self.path(name)
+        with self._lock:
+            self._load_index()
+            if name in self._sizes:
+                # Already stored: refresh its age so eviction keeps it
+                try:
+                    os.utime(path)
+                    return name
+                except OSError:
+                    self._sizes.pop(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except OSError:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+            self._sizes[name] = len(data)
+            self._evict(keep=name)
+        return name
+
+    def _load_index(self):
+        """Scan the store once to learn current file sizes. Caller holds _lock."""
+        if self._sizes is not None:
+            return
+        self._sizes = {}
+        if not os.path.isdir(self.root):
+            return
+        for root, _dirs, files in os.walk(self.root):
+            for fname in files:
+                if STORE_NAME_RE.match(fname):
+                    try:
+                        self._sizes[fname] = os.path.getsize(os.path.join(root, fname))
+                    except OSError:
+                        continue
+
+    def _evict(self, keep):
+        """Delete the oldest files until the store fits its cap. Caller holds _lock."""
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+        by_age = []
+        for name in self._sizes:
+            if name == keep:
+                continue
+            try:
+                by_age.append((os.path.getmtime(self.path(name)), name))
+            except OSError:
+                by_age.append((0, name))
+        by_age.sort()
+        for _mtime, name in by_age:
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes.pop(name)
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+
+
+media_store = MediaStore()
+
+
+def store_base64(value, default_mime):
+    """Decode a base64 string or data: URL into the media store.
+
+    Returns the /media/<name> URL, or None if value is not valid base64 or
+    the store can't be written (disk full, permissions).
+    """
+    mime = default_mime
+    payload = value
+    if value.startswith("data:"):
+        header, _, payload = value.partition(",")
+        if ";base64" not in header:
+            return None
+        mime = header[5:].split(";")[0] or default_mime
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    try:
+        return f"/media/{media_store.put(data, mime)}"
+    except OSError as e:
+        logger.warning("Could not write to media store %s: %s", media_store.root, e)
+        return None
+
+
+def store_base64_outputs(definition, outputs):
+    """Swap base64 image/audio output values for media store URLs, in place.
+
+    Returns {original value: URL} so callers can rewrite the raw response.
+    Values that are not valid base64, or that could not be stored, fall
+    back to an inline data: URL.
+    """
+    stored = {}
+    for output_def, output in zip(definition.get("response", {}).get("outputs", []), outputs):
+        if output_def.get("source") != "base64" or output["type"] not in ("image", "audio"):
+            continue
+        mime = output_def.get("mime_type", "image/png" if output["type"] == "image" else "audio/wav")
+        values = []
+        for v in output["value"]:
+            if isinstance(v, str) and v:
+                url = stored.get(v) or store_base64(v, mime)
+                if url:
+                    stored[v] = url
+                else:
+                    url = v if v.startswith("data:") else f"data:{mime};base64,{v}"
+                v = url
+            values.append(v)
+        output["value"] = values
+    return stored
+
+
+def stored_media_present(outputs):
+    """False if an output links a /media/ file the store has since evicted."""
+    for output in outputs or ():
+        for v in output.get("value") or ():
+            if isinstance(v, str) and v.startswith("/media/") and not media_store.has(v[len("/media/"):]):
+                return False
+    return True
+
+
+def replace_strings(data, mapping):
+    """Return a copy of a JSON structure with exact string matches replaced."""
+    if isinstance(data, dict):
+        return {k: replace_strings(v, mapping) for k, v in data.items()}
+    if isinstance(data, list):
+        return [replace_strings(v, mapping) for v in data]
+    if isinstance(data, str):
+        return mapping.get(data, data)
+    return data
@@ -0,0 +1,307 @@
+"""In-process counters and histograms, exposed in Prometheus text format at /metrics.
+
+Every upstream call records one observation labelled by provider and
+definition id: total latency, time to first byte, HTTP status class and
+bytes sent/received. Streams add their SSE chunk counts, and the job
+poller records how long async jobs took end to end. Updates are a dict
+lookup and a few additions under one lock, so recording costs far less
+than the network call it describes.
+"""
+
+import bisect
+import json
+import threading
+import time
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+
+_lock = threading.Lock()
+_metrics = []  # registration order is exposition order
+_callbacks = []  # (name, type, help, label_names, fn) sampled at scrape time
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    type = "counter"
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._values = {}  # label values tuple -> float
+        _metrics.append(self)
+
+    def inc(self, labels, amount=1):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, self.label_names, labels, value
+
+
+class Histogram:
+    """Bucketed observations per label set, with running sum and count."""
+
+    type = "histogram"
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values tuple -> [per-bucket counts..., +Inf count, sum]
+        _metrics.append(self)
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        bucket_names = self.label_names + ("le",)
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket", bucket_names, labels + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.label_names, labels, series[-1]
+            yield f"{self.name}_count", self.label_names, labels, cumulative
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+UPSTREAM_LABELS = ("route", "provider", "definition")
+
+upstream_requests = Counter(
+    "arcade_upstream_requests_total",
+    "Upstream provider requests by HTTP status class (error = no response).",
+    UPSTREAM_LABELS + ("status_class",),
+)
+upstream_latency = Histogram(
+    "arcade_upstream_latency_seconds",
+    "Time from sending an upstream request to receiving its full response.",
+    UPSTREAM_LABELS,
+)
+upstream_ttfb = Histogram(
+    "arcade_upstream_ttfb_seconds",
+    "Time from sending an upstream request to receiving its response headers.",
+    UPSTREAM_LABELS,
+)
+upstream_bytes = Counter(
+    "arcade_upstream_bytes_total",
+    "Bytes sent to (out) and received from (in) upstream providers.",
+    UPSTREAM_LABELS + ("direction",),
+)
+stream_chunks = Counter(
+    "arcade_stream_chunks_total",
+    "SSE data chunks received from upstream streams.",
+    ("provider", "definition"),
+)
+stream_ttft = Histogram(
+    "arcade_stream_ttft_seconds",
+    "Time from sending a streaming request to the first token-bearing upstream chunk.",
+    ("provider", "definition"),
+)
+stream_tokens = Counter(
+    "arcade_stream_tokens_total",
+    "Completion tokens streamed (provider usage when reported, else token chunks).",
+    ("provider", "definition"),
+)
+job_duration = Histogram(
+    "arcade_job_duration_seconds",
+    "Async job wall time from first poll to result or failure.",
+    ("provider", "definition", "outcome"),
+    buckets=JOB_BUCKETS,
+)
+job_polls = Counter(
+    "arcade_job_polls_total",
+    "Status polls made by the server-side job poller.",
+    ("provider", "definition"),
+)
+ratelimit_wait = Histogram(
+    "arcade_ratelimit_wait_seconds",
+    "Time upstream calls spent queued behind a provider's rate limits.",
+    ("provider", "lane"),
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+ratelimit_throttled = Counter(
+    "arcade_ratelimit_throttled_total",
+    "429 responses from providers, by whether the call was retried or returned to the client.",
+    ("provider", "outcome"),
+)
+ratelimit_timeouts = Counter(
+    "arcade_ratelimit_timeouts_total",
+    "Calls that gave up waiting in a provider's rate-limit queue.",
+    ("provider", "lane"),
+)
+upstream_retries = Counter(
+    "arcade_upstream_retries_total",
+    "Upstream calls retried after a connection error or 5xx, or not retried once attempts or budget ran out.",
+    ("provider", "definition", "reason"),
+)
+shared_calls = Counter(
+    "arcade_shared_calls_total",
+    "Requests answered by joining an identical upstream call already in flight.",
+    ("route", "provider", "definition"),
+)
+upstream_hedges = Counter(
+    "arcade_upstream_hedges_total",
+    "Hedged duplicate requests sent, by whether the hedge or the original answered first.",
+    ("provider", "definition", "outcome"),
+)
+
+
+def status_class(status):
+    """Map an HTTP status (or None for a failed connection) to 2xx/4xx/5xx/error."""
+    if not status:
+        return "error"
+    return f"{status // 100}xx"
+
+
+def observe_upstream(route, provider, definition, status, seconds, ttfb=None, bytes_out=0, bytes_in=0):
+    """Record one upstream call."""
+    labels = (route, provider, definition)
+    upstream_requests.inc(labels + (status_class(status),))
+    upstream_latency.observe(labels, seconds)
+    if ttfb is not None:
+        upstream_ttfb.observe(labels, ttfb)
+    if bytes_out:
+        upstream_bytes.inc(labels + ("out",), bytes_out)
+    if bytes_in:
+        upstream_bytes.inc(labels + ("in",), bytes_in)
+
+
+def _bytes_received(resp):
+    """Body bytes read off the wire so far, without reading any more of them."""
+    raw = getattr(resp, "raw", None)
+    if raw is not None and hasattr(raw, "tell"):
+        return raw.tell()
+    try:
+        return int(resp.headers.get("Content-Length") or 0)
+    except ValueError:
+        return 0
+
+
+def observe_response(route, provider, definition, resp, started, body=None, body_read=True):
+    """Record a requests call that began at time.monotonic() == started.
+
+    resp is None when no response arrived. Pass body_read=False for a
+    streamed response whose body is still unread. Safe to call from a
+    finally block: it counts only the bytes already received and never
+    touches resp.content, which would block on (or fail reading) the rest.
+    """
+    if resp is None:
+        observe_upstream(route, provider, definition, None, time.monotonic() - started)
+        return
+    observe_upstream(
+        route,
+        provider,
+        definition,
+        resp.status_code,
+        time.monotonic() - started,
+        ttfb=resp.elapsed.total_seconds(),
+        bytes_out=len(json.dumps(body)) if body else 0,
+        bytes_in=_bytes_received(resp) if body_read else 0,
+    )
+
+
+def observe_bytes(route, provider, definition, bytes_in):
+    """Record bytes received after the call itself was observed (spooled media)."""
+    if bytes_in:
+        upstream_bytes.inc((route, provider, definition, "in"), bytes_in)
+
+
+def observe_stream(provider, definition, chunks, summary=None):
+    """Record a finished stream's chunk count and, if it completed, its timing summary."""
+    labels = (provider, definition)
+    if chunks:
+        stream_chunks.inc(labels, chunks)
+    if summary:
+        if summary["ttft_ms"] is not None:
+            stream_ttft.observe(labels, summary["ttft_ms"] / 1000)
+        if summary["completion_tokens"]:
+            stream_tokens.inc(labels, summary["completion_tokens"])
+
+
+def observe_job(provider, definition, outcome, seconds, polls):
+    job_duration.observe((provider, definition, outcome), seconds)
+    job_polls.inc((provider, definition), polls)
+
+
+def observe_ratelimit_wait(provider, lane, seconds):
+    ratelimit_wait.observe((provider, lane), seconds)
+
+
+def observe_ratelimit_timeout(provider, lane):
+    ratelimit_timeouts.inc((provider, lane))
+
+
+def observe_throttled(provider, outcome):
+    ratelimit_throttled.inc((provider, outcome))
+
+
+def observe_retry(provider, definition, reason):
+    upstream_retries.inc((provider, definition, reason))
+
+
+def observe_hedge(provider, definition, outcome):
+    upstream_hedges.inc((provider, definition, outcome))
+
+
+def observe_shared(route, provider, definition):
+    shared_calls.inc((route, provider, definition))
+
+
+def register_callback(name, metric_type, help_text, label_names, fn):
+    """Expose a value sampled at scrape time; fn() returns [(label_values, value), ...]."""
+    _callbacks.append((name, metric_type, help_text, label_names, fn))
+
+
+# ---------------------------------------------------------------------------
+# Exposition
+# ---------------------------------------------------------------------------
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, label_names, labels, value in metric.samples():
+                lines.append(_format_sample(name, label_names, labels, value))
+    for name, metric_type, help_text, label_names, fn in _callbacks:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in fn():
+            lines.append(_format_sample(name, label_names, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+def _format_sample(name, label_names, labels, value):
+    if label_names:
+        pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(label_names, labels))
+        return f"{name}{{{pairs}}} {_format_value(value)}"
+    return f"{name} {_format_value(value)}"
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -1,4 +1,3 @@
-import copy
 import json
 import re
 
@@ -30,7 +29,7 @@ def build_curl_string(definition, params, api_key_placeholder="<API_KEY>", api_k
             prefix = auth.get("prefix", "")
             headers[header_name] = f"{prefix}{api_key_placeholder}"
 
-    method = definition["request"].get("method", "POST").upper()
+    method = compile_request(definition).method
     parts = [f"curl -X {method} '{_escape_single_quotes(url)}'"]
     for key, value in headers.items():
         parts.append(f"  -H '{_escape_single_quotes(key)}: {_escape_single_quotes(value)}'")
@@ -48,65 +47,120 @@ def _escape_single_quotes(s):
 def build_request(definition, params, api_key):
     """Build an HTTP request from a definition and user-supplied params.
 
-    Returns (url, headers, body) ready to send via requests.
+    Returns (url, headers, body) ready to send via requests. The definition
+    is compiled into a RequestPlan on first use, see compile_request().
     """
-    req = definition["request"]
+    return compile_request(definition).build(params, api_key)
 
-    # Build headers
-    headers = {"Content-Type": req.get("content_type", "application/json")}
-    headers.update(build_auth_headers(definition, api_key))
 
-    # Merge any static headers from the definition
-    for k, v in req.get("headers", {}).items():
-        headers[k] = v
+class RequestPlan:
+    """A definition's request section compiled once into build steps.
 
-    # Build body from template + params
-    body = copy.deepcopy(req.get("body_template", {}))
-    for param_def in req.get("params", []):
-        name = param_def["name"]
-        if name not in params:
-            continue
-        # url_path params are substituted into the URL, not the body
-        if param_def.get("url_path"):
-            continue
-        value = params[name]
-        # Coerce types
-        try:
-            if param_def.get("type") == "integer":
-                value = int(value)
-            elif param_def.get("type") == "float":
-                value = float(value)
-        except (ValueError, TypeError):
-            raise ValueError(f"Parameter '{name}' expects {param_def.get('type')}, got '{value}'")
-
-        body_path = param_def.get("body_path")
-        if body_path == "_chat_message":
-            # Special handling: wrap as OpenAI-style messages array
-            body["messages"] = [{"role": "user", "content": value}]
-        elif body_path:
-            _set_nested(body, body_path, value)
-        else:
-            body[name] = value
-
-    # System prompt injection
-    system_prompt = params.get("_system_prompt", "")
-    body.pop("_system_prompt", None)
-    if "messages" in body and system_prompt:
-        body["messages"].insert(0, {"role": "system", "content": system_prompt})
-
-    # Substitute url_path params into the URL template (e.g. {model})
-    url = req["url"]
-    for param_def in req.get("params", []):
-        if param_def.get("url_path"):
+    Headers, setter paths, type coercers and URL placeholders are worked out
+    up front, so building a request is a template clone plus one pass over
+    the supplied params.
+    """
+
+    __slots__ = ("definition", "method", "url", "content_type", "auth_header", "auth_prefix",
+                 "static_headers", "template", "body_params", "url_params")
+
+    def __init__(self, definition):
+        self.definition = definition
+        req = definition["request"]
+        self.method = req.get("method", "POST").upper()
+        self.url = req["url"]
+        self.content_type = req.get("content_type", "application/json")
+        auth = definition.get("auth", {})
+        self.auth_header = auth["header"] if auth.get("type") == "header" else None
+        self.auth_prefix = auth.get("prefix", "")
+        self.static_headers = dict(req.get("headers", {}))
+        self.template = req.get("body_template", {})
+
+        # (name, declared type, coercer, setter) in definition order; setter
+        # is _CHAT_MESSAGE, a pre-split body_path, or None for body[name]
+        body_params = []
+        url_params = []
+        for param_def in req.get("params", []):
             name = param_def["name"]
+            if param_def.get("url_path"):
+                url_params.append((name, f"{{{name}}}"))
+                continue
+            param_type = param_def.get("type")
+            body_path = param_def.get("body_path")
+            if body_path == "_chat_message":
+                setter = _CHAT_MESSAGE
+            elif body_path:
+                setter = _compile_setter(body_path)
+            else:
+                setter = None
+            body_params.append((name, param_type, _COERCERS.get(param_type), setter))
+        self.body_params = tuple(body_params)
+        self.url_params = tuple(url_params)
+
+    def build(self, params, api_key):
+        """Return (url, headers, body) for one call."""
+        headers = {"Content-Type": self.content_type}
+        if self.auth_header is not None:
+            headers[self.auth_header] = f"{self.auth_prefix}{api_key}"
+        headers.update(self.static_headers)
+
+        body = _clone_json(self.template)
+        for name, param_type, coerce, setter in self.body_params:
+            if name not in params:
+                continue
+            value = params[name]
+            if coerce is not None:
+                try:
+                    value = coerce(value)
+                except (ValueError, TypeError):
+                    raise ValueError(f"Parameter '{name}' expects {param_type}, got '{value}'")
+
+            if setter is _CHAT_MESSAGE:
+                # Special handling: wrap as OpenAI-style messages array
+                body["messages"] = [{"role": "user", "content": value}]
+            elif setter is not None:
+                _apply_setter(body, setter, value)
+            else:
+                body[name] = value
+
+        # System prompt injection
+        system_prompt = params.get("_system_prompt", "")
+        body.pop("_system_prompt", None)
+        if "messages" in body and system_prompt:
+            body["messages"].insert(0, {"role": "system", "content": system_prompt})
+
+        # Substitute url_path params into the URL template (e.g. {model})
+        url = self.url
+        for name, placeholder in self.url_params:
             if name in params:
-                url = url.replace(f"{{{name}}}", str(params[name]))
-    return url, headers, body
+                url = url.replace(placeholder, str(params[name]))
+        return url, headers, body
+
+
+_CHAT_MESSAGE = object()
+_COERCERS = {"integer": int, "float": float}
+_REQUEST_PLANS = {}  # definition id -> RequestPlan
+
+
+def compile_request(definition):
+    """Return the RequestPlan for a definition, compiling it on first use.
+
+    Plans are keyed by id and remember the definition object they were
+    built from, so a reloaded definition gets a fresh plan.
+    """
+    plan = _REQUEST_PLANS.get(definition.get("id"))
+    if plan is None or plan.definition is not definition:
+        plan = RequestPlan(definition)
+        _REQUEST_PLANS[definition.get("id")] = plan
+    return plan
+
+
+_REQUEST_ID_RE = re.compile(r"^[a-zA-Z0-9_\-]+$")
 
 
 def _validate_request_id(request_id):
     """Validate that request_id contains only safe characters."""
-    if not re.match(r'^[a-zA-Z0-9_\-]+$', request_id):
+    if not _REQUEST_ID_RE.match(request_id):
         raise ValueError(f"Invalid request_id: {request_id}")
 
 
@@ -122,6 +176,13 @@ def build_result_url(definition, request_id):
     return definition["interaction"]["result_url"].replace("{request_id}", request_id)
 
 
+def build_cancel_url(definition, request_id):
+    """Build the cancel URL by substituting {request_id}, or None if the definition has none."""
+    _validate_request_id(request_id)
+    cancel_url = definition["interaction"].get("cancel_url")
+    return cancel_url.replace("{request_id}", request_id) if cancel_url else None
+
+
 def check_done(definition, status_response):
     """Check if a polling response indicates completion or failure.
 
@@ -155,21 +216,74 @@ def extract_value(data, path):
       $.foo.bar       - dot notation
       $..key          - recursive descent (returns first match)
       $.foo[*].bar    - array wildcard
+
+    Paths are compiled on first use and cached, see compile_path().
     """
     if not path or not data:
         return None
+    return compile_path(path).extract(data)
+
+
+class JsonPath:
+    """A JSONPath expression parsed once into walk steps and reused per call."""
+
+    __slots__ = ("path", "_recursive_key", "_steps")
 
-    # Remove leading $
-    path = path.lstrip("$")
+    def __init__(self, path):
+        self.path = path
+        self._recursive_key = None
+        self._steps = ()
 
-    # Recursive descent: $..key
-    if path.startswith(".."):
-        key = path[2:].split(".")[0].split("[")[0]
-        return _recursive_find(data, key)
+        # Remove leading $
+        path = path.lstrip("$")
 
-    # Dot notation with optional array wildcards
-    parts = _parse_path_parts(path)
-    return _walk(data, parts)
+        # Recursive descent: $..key
+        if path.startswith(".."):
+            self._recursive_key = path[2:].split(".")[0].split("[")[0]
+            return
+
+        # Dot notation with optional array wildcards
+        self._steps = _compile_steps(_parse_path_parts(path))
+
+    def extract(self, data):
+        """Return the value at this path in data, or None."""
+        if not data:
+            return None
+        if self._recursive_key is not None:
+            return _recursive_find(data, self._recursive_key)
+        return _walk(data, self._steps)
+
+
+_COMPILED_PATHS = {}  # path string -> JsonPath
+
+
+def compile_path(path):
+    """Return the shared compiled JsonPath for a path string."""
+    compiled = _COMPILED_PATHS.get(path)
+    if compiled is None:
+        compiled = _COMPILED_PATHS[path] = JsonPath(path)
+    return compiled
+
+
+def compile_definition_paths(definition):
+    """Compile every JSONPath a definition uses so requests never parse paths.
+
+    Covers stream_path, request_id_path, done_when/failed_when paths,
+    response.outputs[].path and response.error.path.
+    """
+    interaction = definition.get("interaction", {})
+    response = definition.get("response", {})
+    paths = [
+        interaction.get("stream_path"),
+        interaction.get("request_id_path"),
+        interaction.get("done_when", {}).get("path"),
+        interaction.get("failed_when", {}).get("path"),
+        response.get("error", {}).get("path"),
+    ]
+    paths.extend(out.get("path") for out in response.get("outputs", []))
+    for path in paths:
+        if path:
+            compile_path(path)
 
 
 def extract_error(definition, response_data):
@@ -200,24 +314,27 @@ def extract_outputs(definition, response_data):
 
 # --- Internal helpers ---
 
-def _set_nested(obj, path, value):
-    """Set a value in a nested dict/list using dot-separated path.
+def _compile_setter(path):
+    """Pre-split a body_path for _apply_setter: (int or str key, ...)."""
+    return tuple(int(key) if key.isdigit() else key for key in path.split("."))
 
-    Numeric segments are treated as list indices (e.g. 'instances.0.prompt').
-    """
-    keys = path.split(".")
+
+def _apply_setter(obj, keys, value):
+    """Set a value in a nested dict/list along keys from _compile_setter()."""
     for key in keys[:-1]:
-        if key.isdigit():
-            obj = obj[int(key)]
-        else:
-            if key not in obj:
-                obj[key] = {}
-            obj = obj[key]
-    final = keys[-1]
-    if final.isdigit():
-        obj[int(final)] = value
-    else:
-        obj[final] = value
+        if type(key) is not int and key not in obj:
+            obj[key] = {}
+        obj = obj[key]
+    obj[keys[-1]] = value
+
+
+def _clone_json(value):
+    """Copy a JSON-shaped value (dicts, lists, scalars) far faster than deepcopy."""
+    if type(value) is dict:
+        return {k: _clone_json(v) for k, v in value.items()}
+    if type(value) is list:
+        return [_clone_json(v) for v in value]
+    return value
 
 
 def _recursive_find(data, key):
@@ -250,7 +367,7 @@ def _parse_path_parts(path):
         if not segment:
             continue
         # Handle foo[*] or foo[0]
-        match = re.match(r"^(\w+)\[(\*|\d+)\]$", segment)
+        match = _SEGMENT_RE.match(segment)
         if match:
             parts.append(match.group(1))
             parts.append(f"[{match.group(2)}]")
@@ -259,25 +376,47 @@ def _parse_path_parts(path):
     return parts
 
 
-def _walk(data, parts):
-    """Walk a data structure following parsed path parts."""
+_SEGMENT_RE = re.compile(r"^(\w+)\[(\*|\d+)\]$")
+
+_KEY, _INDEX, _WILDCARD = 0, 1, 2
+
+
+def _compile_steps(parts):
+    """Turn parsed path parts into (kind, arg) steps.
+
+    A wildcard step carries the remaining steps as its arg so walking never
+    has to search for its own position.
+    """
+    steps = []
+    for i, part in enumerate(parts):
+        if part == "[*]":
+            steps.append((_WILDCARD, _compile_steps(parts[i + 1:])))
+            break
+        if part.startswith("[") and part.endswith("]") and part[1:-1].isdigit():
+            steps.append((_INDEX, int(part[1:-1])))
+        else:
+            steps.append((_KEY, part))
+    return tuple(steps)
+
+
+def _walk(data, steps):
+    """Walk a data structure following compiled path steps."""
     current = data
-    for part in parts:
+    for kind, arg in steps:
         if current is None:
             return None
-        if part == "[*]":
-            if isinstance(current, list):
-                remaining = parts[parts.index(part) + 1:]
-                return [_walk(item, remaining) for item in current if item is not None]
-            return None
-        elif part.startswith("[") and part.endswith("]"):
-            idx = int(part[1:-1])
-            if isinstance(current, list) and idx < len(current):
-                current = current[idx]
+        if kind == _KEY:
+            if isinstance(current, dict):
+                current = current.get(arg)
+            else:
+                return None
+        elif kind == _INDEX:
+            if isinstance(current, list) and arg < len(current):
+                current = current[arg]
             else:
                 return None
-        elif isinstance(current, dict):
-            current = current.get(part)
         else:
+            if isinstance(current, list):
+                return [_walk(item, arg) for item in current if item is not None]
             return None
     return current
@@ -0,0 +1,324 @@
+"""Per-provider rate limiting: token buckets, a concurrency cap and a fair queue.
+
+A definition opts in with a "rate_limit" block, e.g.
+
+    {"rate_limit": {"requests_per_minute": 60, "tokens_per_minute": 90000,
+                    "max_concurrency": 4, "max_retries": 3}}
+
+Limits apply per provider, shared by every definition of that provider.
+Upstream calls wait in a queue in front of the provider until a request
+token, enough tokens-per-minute budget and a concurrency slot are all
+free. Callers are grouped into lanes (interactive requests, batch runs),
+and lanes are served round-robin, so a long batch cannot starve the
+playground. A 429 pauses the whole provider for the Retry-After delay
+(or a jittered exponential backoff when there is none), and the caller
+retries through the queue, up to max_retries times.
+"""
+
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+# Longest a call waits in the queue before it gives up with a 429
+MAX_WAIT_SECONDS = float(os.getenv("ARCADE_RATE_LIMIT_MAX_WAIT", "60"))
+DEFAULT_MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+_limiters = {}  # provider -> ProviderLimiter
+_lock = threading.Lock()
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a call waited longer than allowed for a rate-limit slot."""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"Rate limit queue for provider '{provider}' is full; try again later")
+        self.retry_after = retry_after
+
+
+def rate_limit_config(definition):
+    """Return the definition's rate_limit block ({} = unlimited)."""
+    conf = definition.get("rate_limit")
+    return conf if isinstance(conf, dict) else {}
+
+
+def estimate_tokens(body):
+    """Rough token cost of a request: ~4 bytes per prompt token plus the output cap."""
+    if not body:
+        return 1
+    prompt = len(json.dumps(body, separators=(",", ":"))) // 4
+    output = next(
+        (body[k] for k in ("max_tokens", "max_completion_tokens", "max_output_tokens")
+         if isinstance(body.get(k), int)),
+        0,
+    )
+    return max(1, prompt + output)
+
+
+class _Bucket:
+    """A token bucket refilled continuously at capacity per minute."""
+
+    __slots__ = ("capacity", "level", "updated")
+
+    def __init__(self, capacity, now):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = now
+
+    def refill(self, capacity, now):
+        if capacity != self.capacity:  # limits changed on reload
+            self.level = min(self.level, capacity)
+            self.capacity = capacity
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_for(self, amount):
+        """Seconds until the bucket holds amount (0 if it already does)."""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.capacity)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class Permit:
+    """A granted slot; release() it once the upstream call is finished.
+
+    granted_at is the time.monotonic() it was granted, i.e. when the call it
+    covers left the queue and went upstream.
+    """
+
+    __slots__ = ("_limiter", "waited", "granted_at", "_released")
+
+    def __init__(self, limiter, waited):
+        self._limiter = limiter
+        self.waited = waited
+        self.granted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released and self._limiter is not None:
+            self._released = True
+            self._limiter._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class ProviderLimiter:
+    """The queue, buckets and concurrency count for one provider."""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self._cond = threading.Condition()
+        self._lanes = OrderedDict()  # lane -> deque of waiting tickets, served round-robin
+        self._active = 0
+        self._requests = None  # _Bucket for requests_per_minute
+        self._tokens = None  # _Bucket for tokens_per_minute
+        self.blocked_until = 0.0  # monotonic time a 429 paused this provider until
+
+    def acquire(self, conf, lane, cost, timeout=MAX_WAIT_SECONDS):
+        """Block until this call may go upstream. Raises RateLimitTimeout."""
+        started = time.monotonic()
+        deadline = started + timeout
+        ticket = object()
+        with self._cond:
+            self._lanes.setdefault(lane, deque()).append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._delay(conf, lane, ticket, cost, now)
+                    if delay == 0:
+                        self._grant(conf, lane, cost)
+                        break
+                    if now >= deadline:
+                        metrics.observe_ratelimit_timeout(self.provider, lane)
+                        raise RateLimitTimeout(self.provider, max(1, round(delay)))
+                    self._cond.wait(min(delay, deadline - now))
+            except BaseException:
+                self._dequeue(lane, ticket)
+                self._cond.notify_all()
+                raise
+        waited = time.monotonic() - started
+        metrics.observe_ratelimit_wait(self.provider, lane, waited)
+        return Permit(self, waited)
+
+    def _delay(self, conf, lane, ticket, cost, now):
+        """0 if ticket may go now, else roughly how long before it is worth checking again."""
+        head_lane = next(lane_name for lane_name, tickets in self._lanes.items() if tickets)
+        if head_lane != lane or self._lanes[lane][0] is not ticket:
+            return 1.0  # not our turn; woken when the queue moves
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        max_concurrency = conf.get("max_concurrency")
+        if max_concurrency and self._active >= max_concurrency:
+            return 1.0  # woken by _release
+        delay = 0.0
+        rpm = conf.get("requests_per_minute")
+        if rpm:
+            if self._requests is None:
+                self._requests = _Bucket(rpm, now)
+            self._requests.refill(rpm, now)
+            delay = max(delay, self._requests.wait_for(1))
+        tpm = conf.get("tokens_per_minute")
+        if tpm:
+            if self._tokens is None:
+                self._tokens = _Bucket(tpm, now)
+            self._tokens.refill(tpm, now)
+            delay = max(delay, self._tokens.wait_for(cost))
+        return delay
+
+    def _grant(self, conf, lane, cost):
+        if conf.get("requests_per_minute"):
+            self._requests.take(1)
+        if conf.get("tokens_per_minute"):
+            self._tokens.take(cost)
+        self._active += 1
+        self._dequeue(lane, None)
+        if lane in self._lanes:
+            self._lanes.move_to_end(lane)  # next grant goes to the next lane
+        self._cond.notify_all()
+
+    def _dequeue(self, lane, ticket):
+        tickets = self._lanes.get(lane)
+        if not tickets:
+            return
+        if ticket is None:
+            tickets.popleft()
+        elif ticket in tickets:
+            tickets.remove(ticket)
+        if not tickets:
+            del self._lanes[lane]
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def pause(self, delay):
+        """Hold every queued call for delay seconds (after a 429)."""
+        with self._cond:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "queued": sum(len(t) for t in self._lanes.values()),
+                "queued_by_lane": {lane: len(t) for lane, t in self._lanes.items()},
+                "active": self._active,
+                "requests_available": round(self._requests.level, 2) if self._requests else None,
+                "tokens_available": round(self._tokens.level) if self._tokens else None,
+                "paused_seconds": round(max(0.0, self.blocked_until - now), 2),
+            }
+
+
+def _limiter(provider):
+    with _lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            limiter = _limiters[provider] = ProviderLimiter(provider)
+        return limiter
+
+
+def acquire(definition, body=None, lane="interactive"):
+    """Wait for a slot to call the definition's provider. Returns a Permit.
+
+    Without a rate_limit block a call only waits out a 429 pause.
+    Raises RateLimitTimeout after MAX_WAIT_SECONDS in the queue.
+    """
+    conf = rate_limit_config(definition)
+    cost = estimate_tokens(body) if conf.get("tokens_per_minute") else 0
+    return _limiter(definition["provider"]).acquire(conf, lane, cost)
+
+
+def retry_delay(definition, resp, attempt):
+    """After a 429, pause the provider and return how long to back off.
+
+    Returns None when the response is not a 429 or retries are used up.
+    """
+    if resp.status_code != 429:
+        return None
+    provider = definition["provider"]
+    max_retries = rate_limit_config(definition).get("max_retries", DEFAULT_MAX_RETRIES)
+    if attempt >= max_retries:
+        metrics.observe_throttled(provider, "returned")
+        return None
+    retry_after = parse_retry_after(_header(resp.headers, "Retry-After"))
+    if retry_after is not None:
+        # Honor the provider's hint, spread out so queued callers don't return in lockstep
+        delay = retry_after * random.uniform(1.0, 1.2)
+    else:
+        delay = random.uniform(0.5, 1.0) * min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    _limiter(provider).pause(delay)
+    metrics.observe_throttled(provider, "retried")
+    return delay
+
+
+def send(definition, body, request_fn, lane="interactive", on_grant=None):
+    """Make an upstream call through the provider's queue, retrying 429s.
+
+    request_fn() performs the call and returns a response (requests or
+    UpstreamStream). Returns (resp, permit): the permit holds a concurrency
+    slot and must be released once the response is consumed. on_grant() is
+    called each time a permit is granted, just before request_fn().
+    """
+    attempt = 0
+    while True:
+        permit = acquire(definition, body, lane)
+        try:
+            if on_grant is not None:
+                on_grant()
+            resp = request_fn()
+        except BaseException:
+            permit.release()
+            raise
+        if retry_delay(definition, resp, attempt) is None:
+            return resp, permit
+        # The provider is paused for the backoff; the next acquire() waits it out
+        resp.close()
+        permit.release()
+        attempt += 1
+
+
+def _header(headers, name):
+    """Case-insensitive header lookup that also works on a plain dict."""
+    value = headers.get(name)
+    if value is None:
+        lowered = name.lower()
+        value = next((v for k, v in headers.items() if k.lower() == lowered), None)
+    return value
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def limiter_stats():
+    """Queue depth, in-flight calls and bucket levels per rate-limited provider."""
+    with _lock:
+        limiters = list(_limiters.values())
+    return {limiter.provider: limiter.stats() for limiter in limiters}
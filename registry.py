@@ -0,0 +1,387 @@
+"""Definition registry: definitions/ and .env parsed into immutable snapshots.
+
+A Snapshot bundles the loaded definitions, provider display names, API keys
+and the pre-encoded catalog built from them. A reload re-parses only the
+files whose mtime or size changed, builds a complete new Snapshot and
+publishes it with a single reference swap, so a request that already read
+the old snapshot finishes with a consistent view of it. A background
+watcher polls for changes every ARCADE_RELOAD_INTERVAL seconds.
+
+Startup reads a snapshot file (ARCADE_DEFINITIONS_CACHE) holding every
+definition's raw JSON next to the little the catalog needs: id, provider,
+env key and palette summary. Files whose mtime and size still match are
+taken from it without parsing; a full definition is parsed the first time
+something asks for it. The snapshot file is rewritten whenever a file had
+to be parsed, and ignored if its checksum or format does not match.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+from dotenv import dotenv_values
+
+from catalog import Catalog, catalog_row
+from proxy import compile_definition_paths
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFS_DIR = os.getenv("ARCADE_DEFINITIONS_DIR", os.path.join(HERE, "definitions"))
+CACHE_PATH = os.getenv("ARCADE_DEFINITIONS_CACHE", os.path.join(HERE, ".cache", "definitions.snapshot"))
+ENV_PATH = os.path.join(HERE, ".env")
+# Seconds between change checks (0 = never reload after startup)
+RELOAD_INTERVAL = float(os.getenv("ARCADE_RELOAD_INTERVAL", "2"))
+
+# Bump when the snapshot file layout or catalog_row() output changes
+CACHE_FORMAT = b"arcade-definitions 1\n"
+
+
+def _process_environment():
+    """The real environment, without the values load_dotenv() copied in from .env.
+
+    Real environment variables keep precedence over .env values, as with
+    load_dotenv(), but .env values must stay hot-reloadable whether or not
+    load_dotenv() already ran. A variable equal to its .env value is taken
+    to come from .env.
+    """
+    file_values = dotenv_values(ENV_PATH) if os.path.exists(ENV_PATH) else {}
+    return {name: value for name, value in os.environ.items() if file_values.get(name) != value}
+
+
+_PROCESS_ENV = _process_environment()
+
+_parse_lock = threading.Lock()
+
+
+class DefinitionFile:
+    """One loaded definition file: its metadata now, its full body on demand."""
+
+    __slots__ = ("stamp", "id", "meta", "summary", "_blob", "_offset", "_length", "_definition")
+
+    def __init__(self, stamp, meta, summary, blob, offset=0, length=None, definition=None):
+        self.stamp = stamp  # (mtime_ns, size)
+        self.id = summary["id"]
+        self.meta = meta  # {"provider_display_name", "env_key", "auth"}
+        self.summary = summary  # catalog_row()
+        self._blob = blob
+        self._offset = offset
+        self._length = len(blob) if length is None else length
+        self._definition = definition
+
+    def raw(self):
+        return self._blob[self._offset:self._offset + self._length]
+
+    def definition(self):
+        """Return the parsed definition, parsing and compiling it on first call."""
+        if self._definition is None:
+            with _parse_lock:
+                if self._definition is None:
+                    definition = json.loads(self.raw())
+                    compile_definition_paths(definition)
+                    self._definition = definition
+        return self._definition
+
+
+class Definitions(Mapping):
+    """Read-only id -> definition mapping that parses each body on first access."""
+
+    __slots__ = ("_files",)
+
+    def __init__(self, files):
+        self._files = files  # id -> DefinitionFile
+
+    def __getitem__(self, definition_id):
+        return self._files[definition_id].definition()
+
+    def __contains__(self, definition_id):
+        return definition_id in self._files
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+
+class Snapshot:
+    """One consistent, never-mutated view of definitions and keys."""
+
+    __slots__ = ("definitions", "provider_names", "api_keys", "validation_auth", "catalog", "loaded_at")
+
+    def __init__(self, definitions, provider_names, api_keys, validation_auth, catalog):
+        self.definitions = definitions
+        self.provider_names = provider_names
+        self.api_keys = api_keys
+        self.validation_auth = validation_auth  # provider -> first auth block with a validation_url
+        self.catalog = catalog
+        self.loaded_at = time.time()
+
+
+class Registry:
+    """Loads definitions incrementally and publishes snapshots."""
+
+    def __init__(self, defs_dir=DEFS_DIR, env_path=ENV_PATH, cache_path=CACHE_PATH):
+        self.defs_dir = defs_dir
+        self.env_path = env_path
+        self.cache_path = cache_path
+        self.snapshot = None
+        self._files = {}  # path -> ((mtime_ns, size), DefinitionFile or None)
+        self._env_stamp = None
+        self._env_values = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._watcher_stop = None
+
+    def reload(self):
+        """Re-read changed files and publish a new snapshot.
+
+        Returns the list of changed paths (empty when nothing changed).
+        """
+        with self._lock:
+            cached = self._read_cache() if self.snapshot is None and self.cache_path else {}
+            changed, parsed = self._scan_definitions(cached)
+            if parsed and self.cache_path:
+                self._write_cache()
+            if self._scan_env():
+                changed.append(self.env_path)
+            if changed or self.snapshot is None:
+                self.snapshot = self._build(self.snapshot)
+            return changed
+
+    def preload(self):
+        """Parse and encode every definition in the current snapshot now.
+
+        Normally each is parsed on first use. A server that forks workers
+        calls this first so they inherit the parsed catalog instead of each
+        parsing it again.
+        """
+        snapshot = self.snapshot
+        for definition_id in snapshot.definitions:
+            snapshot.catalog.definition_body(definition_id)
+        return len(snapshot.definitions)
+
+    def _scan_definitions(self, cached):
+        """Stat every file; parse the ones neither loaded nor cached with the same stamp.
+
+        Returns (changed paths, whether anything was parsed or removed).
+        """
+        changed = []
+        parsed = False
+        seen = set()
+        for path, stamp in _stat_definition_files(self.defs_dir):
+            seen.add(path)
+            current = self._files.get(path)
+            if current is not None and current[0] == stamp:
+                continue
+            record = cached.get(path)
+            if record is None or record.stamp != stamp:
+                record = _parse_definition(path, stamp)
+                parsed = True
+            self._files[path] = (stamp, record)
+            changed.append(path)
+        for path in set(self._files) - seen:
+            del self._files[path]
+            changed.append(path)
+            parsed = True
+        if any(path not in seen for path in cached):
+            parsed = True  # drop cached entries for deleted files
+        return changed, parsed
+
+    def _scan_env(self):
+        try:
+            st = os.stat(self.env_path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp == self._env_stamp:
+            return False
+        self._env_stamp = stamp
+        self._env_values = dotenv_values(self.env_path) if stamp else {}
+        return True
+
+    def _env(self, name):
+        return _PROCESS_ENV.get(name) or self._env_values.get(name) or ""
+
+    def _build(self, previous):
+        files = {}
+        provider_names = {}
+        api_keys = {}
+        validation_auth = {}
+        for path in sorted(self._files):
+            record = self._files[path][1]
+            if record is None:
+                continue
+            if record.id in files:
+                logger.warning("Duplicate definition id '%s' in %s replaces an earlier file", record.id, path)
+            files[record.id] = record
+
+            # Collect provider display name from definition
+            provider = record.summary["provider"]
+            if provider and provider not in provider_names:
+                display_name = record.meta["provider_display_name"]
+                provider_names[provider] = provider.title() if display_name is None else display_name
+
+            # Load API key from auth.env_key (if not already loaded for this provider)
+            env_key = record.meta["env_key"]
+            if provider and env_key and provider not in api_keys:
+                val = self._env(env_key)
+                if val:
+                    api_keys[provider] = val
+
+            auth = record.meta["auth"]
+            if provider not in validation_auth and auth.get("validation_url"):
+                validation_auth[provider] = auth
+
+        definitions = Definitions(files)
+        summaries = {did: record.summary for did, record in files.items()}
+        catalog = Catalog(
+            definitions, summaries, provider_names, api_keys,
+            previous=previous.catalog if previous else None,
+        )
+        return Snapshot(definitions, provider_names, api_keys, validation_auth, catalog)
+
+    # -----------------------------------------------------------------------
+    # Snapshot file: format line, header JSON line, then every file's raw JSON
+    # -----------------------------------------------------------------------
+
+    def _read_cache(self):
+        """Return {path: DefinitionFile} from the snapshot file, or {} if unusable."""
+        try:
+            with open(self.cache_path, "rb") as f:
+                blob = f.read()
+        except OSError:
+            return {}
+        try:
+            if not blob.startswith(CACHE_FORMAT):
+                raise ValueError("unknown format")
+            header_end = blob.index(b"\n", len(CACHE_FORMAT))
+            header = json.loads(blob[len(CACHE_FORMAT):header_end])
+            payload = blob[header_end + 1:]
+            if header["defs_dir"] != os.path.abspath(self.defs_dir):
+                return {}
+            if hashlib.sha256(payload).hexdigest() != header["sha256"]:
+                raise ValueError("checksum mismatch")
+            records = {}
+            for entry in header["files"]:
+                records[os.path.join(self.defs_dir, entry["path"])] = DefinitionFile(
+                    tuple(entry["stamp"]), entry["meta"], entry["summary"],
+                    payload, entry["offset"], entry["length"],
+                )
+            return records
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring definition snapshot %s: %s", self.cache_path, e)
+            return {}
+
+    def _write_cache(self):
+        entries = []
+        chunks = []
+        offset = 0
+        for path in sorted(self._files):
+            record = self._files[path][1]
+            if record is None:
+                continue  # invalid files are re-parsed (and warned about) every start
+            raw = record.raw()
+            entries.append({
+                "path": os.path.relpath(path, self.defs_dir),
+                "stamp": list(record.stamp),
+                "meta": record.meta,
+                "summary": record.summary,
+                "offset": offset,
+                "length": len(raw),
+            })
+            chunks.append(raw)
+            offset += len(raw)
+        payload = b"".join(chunks)
+        header = {
+            "defs_dir": os.path.abspath(self.defs_dir),
+            "sha256": hashlib.sha256(payload).hexdigest(),
+            "files": entries,
+        }
+        tmp = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(CACHE_FORMAT)
+                f.write(json.dumps(header, separators=(",", ":")).encode("utf-8"))
+                f.write(b"\n")
+                f.write(payload)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            logger.warning("Could not write definition snapshot %s: %s", self.cache_path, e)
+
+    # -----------------------------------------------------------------------
+    # Watcher
+    # -----------------------------------------------------------------------
+
+    def start_watcher(self, interval=RELOAD_INTERVAL):
+        """Poll for definition and .env changes in a daemon thread.
+
+        Safe to call again in a forked child, where the parent's watcher
+        thread no longer runs.
+        """
+        if interval <= 0 or (self._watcher is not None and self._watcher.is_alive()):
+            return
+        self._watcher_stop = threading.Event()
+        self._watcher = threading.Thread(
+            target=self._watch, args=(interval, self._watcher_stop), name="definition-watcher", daemon=True
+        )
+        self._watcher.start()
+
+    def stop_watcher(self):
+        """Stop the watcher thread, e.g. in a server master process that only forks workers."""
+        if self._watcher_stop is not None:
+            self._watcher_stop.set()
+        self._watcher = self._watcher_stop = None
+
+    def _watch(self, interval, stop):
+        while not stop.wait(interval):
+            try:
+                changed = self.reload()
+            except Exception:  # keep serving the last good snapshot
+                logger.exception("Definition reload failed")
+                continue
+            if changed:
+                names = ", ".join(os.path.relpath(p, HERE) for p in changed)
+                logger.warning("Reloaded definitions (%d definitions): %s", len(self.snapshot.definitions), names)
+
+
+def _stat_definition_files(root):
+    """Yield (path, (mtime_ns, size)) for every .json file under root."""
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                yield from _stat_definition_files(entry.path)
+            elif entry.name.endswith(".json"):
+                st = entry.stat()
+                yield entry.path, (st.st_mtime_ns, st.st_size)
+        except OSError:
+            continue
+
+
+def _parse_definition(path, stamp):
+    """Parse and precompile one definition file; None if it is unusable."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+        defn = json.loads(raw)
+        compile_definition_paths(defn)
+        summary = catalog_row(defn)
+        auth = defn.get("auth", {})
+        meta = {
+            "provider_display_name": defn.get("provider_display_name"),
+            "env_key": auth.get("env_key", ""),
+            "auth": auth,
+        }
+    except (ValueError, KeyError, TypeError, AttributeError, IndexError, OSError) as e:
+        print(f"WARNING: skipping {path}: {e}")
+        return None
+    return DefinitionFile(stamp, meta, summary, raw, definition=defn)
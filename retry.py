@@ -0,0 +1,273 @@
+"""Retries and hedged requests for upstream calls.
+
+A definition opts in with a "retry" block, e.g.
+
+    {"retry": {"max_attempts": 3, "backoff_ms": 200, "hedge": true, "idempotent": true}}
+
+Connection errors and 5xx responses (on_status, default 500/502/503/504)
+are retried with jittered exponential backoff. Retries are budgeted per
+provider: every call earns BUDGET_RATIO of a retry token and every retry
+or hedge spends a whole one, so a provider outage adds at most that
+fraction of extra traffic instead of multiplying it by max_attempts.
+
+Hedging is for idempotent calls: status and result polls always, sync
+generations only when the block sets "idempotent": true. If the first
+request has not answered after the definition's observed p95 latency (or
+a fixed hedge_after_ms), an identical request is sent and whichever
+answers first wins; the other is closed when it arrives.
+
+Latencies and the hedge delay are measured from when a request's
+rate-limit permit is granted, so time spent queued behind the provider's
+limits neither inflates the p95 nor triggers a hedge.
+"""
+
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+import requests as http_requests
+
+import metrics
+from deadlines import deadline_for
+from ratelimit import Permit
+from upstream import session_for
+
+# Retry tokens earned per call; 0.2 allows one retry or hedge per five calls
+BUDGET_RATIO = float(os.getenv("ARCADE_RETRY_BUDGET", "0.2"))
+# Retry tokens a provider can bank, i.e. the largest burst of retries after a quiet spell
+BUDGET_CAPACITY = 10
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_MS = 200
+MAX_BACKOFF_MS = 5000
+DEFAULT_RETRY_STATUSES = (500, 502, 503, 504)
+# Latencies kept per (definition, kind) for the p95 hedge delay
+LATENCY_WINDOW = 200
+# Don't hedge on p95 until this many latencies have been seen
+MIN_HEDGE_SAMPLES = 20
+
+_budgets = {}  # provider -> RetryBudget
+_latencies = {}  # (definition id, kind) -> deque of recent seconds
+_lock = threading.Lock()
+
+
+def retry_config(definition):
+    """Return the definition's retry block ({} = no retries or hedging)."""
+    conf = definition.get("retry")
+    return conf if isinstance(conf, dict) else {}
+
+
+class RetryBudget:
+    """Token bucket that caps retries and hedges at a fraction of calls."""
+
+    def __init__(self, ratio=BUDGET_RATIO, capacity=BUDGET_CAPACITY):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Spend one token; False when the budget is used up."""
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def _budget(provider):
+    with _lock:
+        budget = _budgets.get(provider)
+        if budget is None:
+            budget = _budgets[provider] = RetryBudget()
+        return budget
+
+
+def observe_latency(key, seconds):
+    with _lock:
+        samples = _latencies.get(key)
+        if samples is None:
+            samples = _latencies[key] = deque(maxlen=LATENCY_WINDOW)
+        samples.append(seconds)
+
+
+def hedge_delay(definition, kind, conf):
+    """Seconds to wait before hedging, or None to not hedge."""
+    fixed = conf.get("hedge_after_ms")
+    if fixed:
+        return fixed / 1000
+    if not conf.get("hedge"):
+        return None
+    with _lock:
+        samples = sorted(_latencies.get((definition["id"], kind), ()))
+    if len(samples) < MIN_HEDGE_SAMPLES:
+        return None
+    return samples[int(0.95 * len(samples))]
+
+
+def call(definition, attempt, kind, idempotent=None, deadline=None):
+    """Run attempt(on_grant) -> (resp, permit) with the definition's retries and hedging.
+
+    attempt passes on_grant to ratelimit.send() (or calls it itself) so the
+    hedge timer starts once the request holds its permit.
+
+    kind names the call ("generate", "poll", ...) for its latency history.
+    idempotent=None takes the retry block's "idempotent" flag; only
+    idempotent calls are hedged. A deadlines.Deadline stops retrying once
+    the backoff would outlast it. Returns (resp, permit, report), where
+    report counts attempts, retries and hedges, or is None when the
+    definition has no retry block. Raises the last RequestException if
+    every attempt failed to connect.
+    """
+    conf = retry_config(definition)
+    if not conf:
+        resp, permit = attempt(_ignore)
+        return resp, permit, None
+
+    budget = _budget(definition["provider"])
+    budget.deposit()
+    statuses = set(conf.get("on_status", DEFAULT_RETRY_STATUSES))
+    max_attempts = conf.get("max_attempts", DEFAULT_MAX_ATTEMPTS)
+    backoff_ms = conf.get("backoff_ms", DEFAULT_BACKOFF_MS)
+    if idempotent is None:
+        idempotent = bool(conf.get("idempotent"))
+    delay = hedge_delay(definition, kind, conf) if idempotent else None
+    if delay is not None and deadline is not None and delay >= deadline.remaining():
+        delay = None  # a hedge would start too late to help
+    key = (definition["id"], kind)
+    report = {"attempts": 0, "retries": 0, "hedges": 0, "hedge_won": False}
+
+    tries = 0
+    while True:
+        if delay is None:
+            report["attempts"] += 1
+            resp, permit, error = _timed(attempt, key, statuses)
+        else:
+            resp, permit, error = _hedged(definition, attempt, key, statuses, delay, budget, report)
+        tries += 1
+        if error is None and resp.status_code not in statuses:
+            return resp, permit, report
+        if error is not None and not isinstance(error, http_requests.RequestException):
+            raise error
+        reason = "connection" if error is not None else "status"
+        backoff = random.uniform(0.5, 1.0) * min(MAX_BACKOFF_MS, backoff_ms * 2 ** (tries - 1)) / 1000
+        out_of_time = deadline is not None and deadline.remaining() <= backoff
+        if tries >= max_attempts or out_of_time or not budget.withdraw():
+            metrics.observe_retry(definition["provider"], definition["id"], "exhausted")
+            if error is not None:
+                raise error
+            return resp, permit, report
+        metrics.observe_retry(definition["provider"], definition["id"], reason)
+        if resp is not None:
+            resp.close()
+            permit.release()
+        report["retries"] += 1
+        time.sleep(backoff)
+
+
+def get(definition, url, headers, kind):
+    """GET a status or result URL with retries and hedging. Returns (resp, report).
+
+    kind ("poll" or "result") also picks the definition's time budget.
+    """
+    session = session_for(definition["provider"])
+    deadline = deadline_for(definition, kind)
+
+    def attempt(on_grant):
+        # Polls are not rate-limited (see ratelimit.py), so each attempt holds a no-op permit
+        permit = Permit(None, 0.0)
+        on_grant()
+        resp = session.get(url, headers=headers, stream=True, timeout=deadline.timeout())
+        deadline.read(resp)
+        return resp, permit
+
+    resp, _permit, report = call(definition, attempt, kind, idempotent=True, deadline=deadline)
+    return resp, report
+
+
+def _ignore():
+    pass
+
+
+def _timed(attempt, key, statuses, granted=None):
+    """One attempt as (resp, permit, error); records its latency when it succeeds.
+
+    The latency runs from the permit's grant, and granted (an Event) is set then.
+    """
+    try:
+        resp, permit = attempt(granted.set if granted is not None else _ignore)
+    except http_requests.RequestException as e:
+        return None, None, e
+    if resp.status_code not in statuses:
+        observe_latency(key, time.monotonic() - permit.granted_at)
+    return resp, permit, None
+
+
+def _hedged(definition, attempt, key, statuses, delay, budget, report):
+    """Send attempt(), and a duplicate if it is slower than delay; first good answer wins."""
+    results = queue.Queue()
+    first_upstream = threading.Event()  # the first request holds its permit, or has already finished
+
+    def run(index, granted):
+        try:
+            results.put((index, _timed(attempt, key, statuses, granted)))
+        except Exception as e:  # e.g. RateLimitTimeout; re-raised by call()
+            results.put((index, (None, None, e)))
+        finally:
+            granted.set()
+
+    def launch(index, granted):
+        report["attempts"] += 1
+        threading.Thread(target=run, args=(index, granted), name=f"hedge-{definition['id']}", daemon=True).start()
+
+    launch(0, first_upstream)
+    pending = launched = 1
+    # The hedge delay counts from when the first request went upstream, not from when it joined the queue
+    first_upstream.wait()
+    try:
+        item = results.get(timeout=delay)
+    except queue.Empty:
+        item = None
+        if budget.withdraw():
+            launch(1, threading.Event())
+            pending = launched = 2
+            report["hedges"] += 1
+
+    while True:
+        if item is None:
+            item = results.get()
+        pending -= 1
+        index, outcome = item
+        item = None
+        resp, _permit, error = outcome
+        if (error is None and resp.status_code not in statuses) or not pending:
+            break
+        _discard(outcome)  # failed, but the other request may still succeed
+
+    if index == 1:
+        report["hedge_won"] = True
+    if launched > 1:
+        metrics.observe_hedge(definition["provider"], definition["id"], "won" if index == 1 else "lost")
+    if pending:
+        threading.Thread(target=_drain, args=(results, pending), daemon=True).start()
+    return outcome
+
+
+def _discard(outcome):
+    resp, permit, _error = outcome
+    if resp is not None:
+        resp.close()
+        permit.release()
+
+
+def _drain(results, pending):
+    """Close the responses of requests that lost the race as they arrive."""
+    for _ in range(pending):
+        _index, outcome = results.get()
+        _discard(outcome)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Production server: app.py under gunicorn with a pool of worker processes and threads.
+
+Workers are gunicorn's threaded (gthread) workers. An open stream holds one
+thread for as long as it runs, so ARCADE_THREADS bounds the streams a
+worker can serve at once; the upstream calls themselves are I/O, so one
+worker with many threads is the default. The app is imported once in the
+master before workers fork, with every definition already parsed, so each
+worker starts with the catalog in memory instead of loading it again.
+
+Stopping the server (SIGTERM) drains each worker: it stops accepting
+connections, ends job event feeds with a "reconnect" event so the browser
+re-subscribes elsewhere, and gives streams and requests already running
+ARCADE_GRACEFUL_TIMEOUT seconds to finish.
+
+Usage:
+    python serve.py
+    python serve.py --bind 127.0.0.1:9000 --workers 2 --threads 128
+"""
+
+import argparse
+import logging
+import os
+import signal
+import threading
+
+from dotenv import load_dotenv
+from gunicorn.app.base import BaseApplication
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BIND = os.getenv("ARCADE_BIND", "0.0.0.0:8080")
+DEFAULT_WORKERS = int(os.getenv("ARCADE_WORKERS", "1"))
+# Concurrent requests (and so open streams) per worker
+DEFAULT_THREADS = int(os.getenv("ARCADE_THREADS", "64"))
+# Seconds a stopping worker lets running requests finish; the default request deadline
+GRACEFUL_TIMEOUT = int(os.getenv("ARCADE_GRACEFUL_TIMEOUT", "60"))
+
+
+def _post_fork(server, worker):
+    """Start this worker's definition watcher (the master's was stopped before forking)."""
+    import app
+
+    app.registry.start_watcher()
+
+
+def _post_worker_init(worker):
+    """Hand job subscribers off before the worker starts its graceful shutdown."""
+    import jobs
+
+    exit_handler = worker.handle_exit
+
+    def handle_exit(sig, frame):
+        # Off the signal handler: drain() takes locks a request thread may hold
+        threading.Thread(target=jobs.drain, name="drain", daemon=True).start()
+        exit_handler(sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_exit)
+
+
+class ArcadeServer(BaseApplication):
+    """gunicorn application serving app.app with settings from the command line and env."""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # With preload_app this runs once, in the master, before the workers fork
+        import app
+
+        count = app.registry.preload()
+        logger.warning("Preloaded %d definitions", count)
+        # The master only forks and supervises workers; each worker reloads on its own
+        app.registry.stop_watcher()
+        return app.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-b", "--bind", default=DEFAULT_BIND, help="host:port to listen on (ARCADE_BIND)")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="worker processes (ARCADE_WORKERS)")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS, help="threads per worker (ARCADE_THREADS)")
+    parser.add_argument(
+        "--graceful-timeout", type=int, default=GRACEFUL_TIMEOUT,
+        help="seconds to drain running requests on shutdown (ARCADE_GRACEFUL_TIMEOUT)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    if args.workers > 1:
+        logger.warning(
+            "Running %d workers: rate limits, retry budgets, shared calls, /metrics, batch progress and "
+            "/api/media/<id> links are per worker, so a follow-up request served by another worker can get "
+            "a 404 or different numbers. Prefer more --threads to more --workers.",
+            args.workers,
+        )
+
+    ArcadeServer({
+        "bind": args.bind,
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        "preload_app": True,
+        "graceful_timeout": args.graceful_timeout,
+        "accesslog": "-",
+        "post_fork": _post_fork,
+        "post_worker_init": _post_worker_init,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Share one upstream call between identical requests that are in flight at once.
+
+Requests are keyed like the response cache (definition id plus the
+canonical URL and body from build_request), so a double-click, a compare
+with the same model on both sides, or several people running the same
+example make one provider call. For /api/generate the first caller makes
+the call and everyone waiting on the same key gets its result. A stream
+runs in a background thread that records every event it produces; anyone
+who joins while it is running gets the events so far replayed and then
+follows the live tail. The upstream stream is closed once its last
+listener disconnects.
+
+Only calls in flight are shared: a request that arrives after the call
+finished makes its own (or hits the response cache, if the definition
+opts in).
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run fn() once per key among concurrent callers."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return (fn(), shared). shared is True if another caller's call was reused."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+
+class Broadcast:
+    """One upstream event stream, recorded and replayed to any number of listeners."""
+
+    def __init__(self, events, on_finish=None, cancel=None):
+        self._events = events
+        self._on_finish = on_finish
+        self._cancel = cancel  # called when the last listener leaves before the end
+        self._buffer = []
+        self._finished = False
+        self._stopped = False  # no longer accepting listeners
+        self._listeners = 0
+        self._cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._run, name="stream-broadcast", daemon=True).start()
+
+    def _run(self):
+        try:
+            for item in self._events:
+                with self._cond:
+                    if not self._listeners:
+                        self._stopped = True
+                        break  # everyone disconnected: stop reading upstream
+                    self._buffer.append(item)
+                    self._cond.notify_all()
+        except Exception:
+            logger.exception("Shared stream failed")
+            with self._cond:
+                self._buffer.append(("error", {"error": "Stream failed"}))
+        finally:
+            with self._cond:
+                self._stopped = True
+            self._events.close()
+            if self._on_finish:
+                self._on_finish(self)
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def listen(self):
+        """Add a listener, or return None if the stream is already winding down."""
+        with self._cond:
+            if self._stopped:
+                return None
+            self._listeners += 1
+        return _Listener(self)
+
+
+class _Listener:
+    """Iterator over a Broadcast's events from the start; close() when done."""
+
+    def __init__(self, broadcast):
+        self._broadcast = broadcast
+        self._sent = 0
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        b = self._broadcast
+        with b._cond:
+            while self._sent == len(b._buffer) and not b._finished and not self._closed:
+                b._cond.wait()
+            if self._sent < len(b._buffer) and not self._closed:
+                self._sent += 1
+                return b._buffer[self._sent - 1]
+        self.close()
+        raise StopIteration
+
+    def close(self):
+        """Stop listening; safe to call from another thread while __next__ waits."""
+        b = self._broadcast
+        with b._cond:
+            if self._closed:
+                return
+            self._closed = True
+            b._listeners -= 1
+            abandoned = not b._listeners and not b._finished
+            if abandoned:
+                b._stopped = True
+            b._cond.notify_all()
+        if abandoned and b._cancel:
+            b._cancel()  # stop reading upstream now rather than at its next event
+
+
+class BroadcastGroup:
+    """In-flight Broadcasts by key."""
+
+    def __init__(self):
+        self._broadcasts = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, start_events, cancel=None):
+        """Listen to the stream for key, starting it with start_events() if none is running.
+
+        cancel() is called if every listener leaves before the stream ends.
+
+        Returns (events, shared): an iterator of the stream's events, to be
+        closed when done, and whether an already running stream was joined.
+        """
+        with self._lock:
+            broadcast = self._broadcasts.get(key)
+            listener = broadcast.listen() if broadcast is not None else None
+            shared = listener is not None
+            if not shared:
+                broadcast = self._broadcasts[key] = Broadcast(
+                    start_events(), on_finish=lambda b: self._finish(key, b), cancel=cancel
+                )
+                listener = broadcast.listen()
+        if not shared:
+            broadcast.start()
+        return listener, shared
+
+    def _finish(self, key, broadcast):
+        with self._lock:
+            if self._broadcasts.get(key) is broadcast:
+                del self._broadcasts[key]
+
+
+def broadcast(events, cancel=None):
+    """Run events in the background for a single listener (not shared)."""
+    b = Broadcast(events, cancel=cancel)
+    listener = b.listen()
+    b.start()
+    return listener
+
+
+def replay(events):
+    """A listener over events that are already complete, e.g. a cached stream."""
+    b = Broadcast(iter(()))
+    b._buffer = list(events)
+    b._finished = b._stopped = True
+    b._listeners = 1
+    return _Listener(b)
+
+
+generations = SingleFlight()
+streams = BroadcastGroup()
@@ -46,6 +46,7 @@ function createSlot() {
         lastSentParams: null,
         lastResponse: null,
         abortController: null,
+        jobRequestId: null,
     };
 }
 
@@ -79,9 +80,23 @@ function abortSlot(slotId) {
         slot.abortController.abort();
         slot.abortController = null;
     }
+    // Abandoning a running async job: cancel it at the provider if the definition supports that
+    if (slot.polling && slot.jobRequestId && slot.definition?.interaction?.cancel_url) {
+        cancelJob(slot.definition.id, slot.jobRequestId);
+    }
+    slot.jobRequestId = null;
     slot.polling = false;
 }
 
+function cancelJob(definitionId, requestId) {
+    fetch('/api/cancel', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ definition_id: definitionId, request_id: requestId }),
+        keepalive: true,
+    }).catch(() => {});
+}
+
 function abortAllSlots() {
     abortSlot('play');
     abortSlot('left');
@@ -134,11 +149,16 @@ function showCompareKeyStatus(side, provider) {
     el.classList.remove('hidden');
 }
 
-function validateKeys() {
-    fetch('/api/validate-keys')
+// Statuses come from a server-side cache and are returned immediately; when
+// some were expired the server re-checks them, and we ask once more, waiting
+// for that shared check to finish.
+function validateKeys(waitSeconds = 0) {
+    fetch('/api/validate-keys' + (waitSeconds ? `?wait=${waitSeconds}` : ''))
         .then(r => r.json())
         .then(data => {
-            Object.assign(KEY_STATUS, data);
+            for (const [provider, info] of Object.entries(data.providers || {})) {
+                KEY_STATUS[provider] = info.status;
+            }
             // Re-render status for currently selected endpoints
             const playDef = slots.play?.definition;
             if (playDef) showApiKeyStatus(playDef.provider);
@@ -146,6 +166,7 @@ function validateKeys() {
             if (leftDef) showCompareKeyStatus('Left', leftDef.provider);
             const rightDef = slots.right?.definition;
             if (rightDef) showCompareKeyStatus('Right', rightDef.provider);
+            if (data.refreshing && !waitSeconds) validateKeys(5);
         })
         .catch(() => {}); // fail silently
 }
@@ -681,14 +702,29 @@ async function selectPaletteItem(idx, isCompare) {
     await transitionToModelStep(item.id, isCompare);
 }
 
+// Definitions are fetched once per page load and shared by the palette, play and compare paths
+const DEFINITION_CACHE = new Map(); // id -> Promise<definition>
+
+function fetchDefinition(defId) {
+    if (!DEFINITION_CACHE.has(defId)) {
+        const pending = fetch(`/api/definitions/${defId}`).then(resp => {
+            if (!resp.ok) throw new Error(`Definition '${defId}' not found`);
+            return resp.json();
+        });
+        // Forget failures so the next selection retries
+        pending.catch(() => DEFINITION_CACHE.delete(defId));
+        DEFINITION_CACHE.set(defId, pending);
+    }
+    return DEFINITION_CACHE.get(defId);
+}
+
 async function transitionToModelStep(defId, isCompare) {
     palettePendingDefId = defId;
     palettePendingIsCompare = isCompare;
     renderPaletteLoading();
 
     try {
-        const resp = await fetch(`/api/definitions/${defId}`);
-        palettePendingDef = await resp.json();
+        palettePendingDef = await fetchDefinition(defId);
     } catch (e) {
         log(`Failed to load definition: ${e.message}`, 'error');
         closePalette();
@@ -804,8 +840,7 @@ async function loadPlayEndpoint(defId) {
     log(`Loading definition: ${defId}`, 'info');
 
     try {
-        const resp = await fetch(`/api/definitions/${defId}`);
-        slots.play.definition = await resp.json();
+        slots.play.definition = await fetchDefinition(defId);
         const def = slots.play.definition;
 
         document.getElementById('welcomeState').classList.add('hidden');
@@ -842,8 +877,7 @@ async function loadCompareEndpoint(side, defId) {
     }
 
     try {
-        const resp = await fetch(`/api/definitions/${defId}`);
-        const def = await resp.json();
+        const def = await fetchDefinition(defId);
         slots[slotId].definition = def;
 
         // Populate model picker
@@ -1240,12 +1274,7 @@ async function startStreaming(slotId, params) {
     const slot = slots[slotId];
     const def = slot.definition;
     slot.lastSentParams = { definitionId: def.id, params };
-    const container = getSlotElement(slotId, 'output');
-    container.innerHTML = '';
-    const textBlock = document.createElement('pre');
-    textBlock.className = 'text-sm text-gray-200 whitespace-pre-wrap leading-relaxed streaming-cursor';
-    textBlock.textContent = '';
-    container.appendChild(textBlock);
+    const { textBlock, textNode } = createStreamingBlock(slotId);
 
     if (slotId === 'play') showResults();
 
@@ -1298,11 +1327,15 @@ async function startStreaming(slotId, params) {
                             if (metrics.ttft === null) {
                                 metrics.ttft = performance.now() - metrics.startTime;
                             }
-                            metrics.tokenCount++;
+                            // n > 1 when the server coalesced several upstream chunks into one frame
+                            metrics.tokenCount += data.n || 1;
                             fullText += data.token;
-                            textBlock.textContent = fullText;
+                            textNode.appendData(data.token);
                             textBlock.scrollTop = textBlock.scrollHeight;
                         }
+                        if (data.metrics) {
+                            applyServerMetrics(slotId, metrics, data.metrics);
+                        }
                         if (data.error) {
                             showSlotError(slotId, data.error);
                         }
@@ -1313,10 +1346,7 @@ async function startStreaming(slotId, params) {
             }
         }
 
-        metrics.totalTime = performance.now() - metrics.startTime;
-        if (metrics.tokenCount > 0 && metrics.totalTime > 0) {
-            metrics.tokensPerSec = metrics.tokenCount / (metrics.totalTime / 1000);
-        }
+        finishStreamMetrics(metrics);
 
         slot.lastResponse = { text: fullText };
         log(`[${slotId}] Streamed ${fullText.length} chars, ${metrics.tokenCount} tokens in ${(metrics.totalTime/1000).toFixed(2)}s`, 'response');
@@ -1332,80 +1362,145 @@ async function startStreaming(slotId, params) {
     if (slotId === 'play') setGenerating(false);
 }
 
+// Replace a slot's output with an empty streaming text block
+function createStreamingBlock(slotId) {
+    const container = getSlotElement(slotId, 'output');
+    container.innerHTML = '';
+    const textBlock = document.createElement('pre');
+    textBlock.className = 'text-sm text-gray-200 whitespace-pre-wrap leading-relaxed streaming-cursor';
+    // Tokens are appended to one text node rather than rewriting the whole string per frame
+    const textNode = document.createTextNode('');
+    textBlock.appendChild(textNode);
+    container.appendChild(textBlock);
+    return { textBlock, textNode };
+}
+
+function finishStreamMetrics(metrics) {
+    metrics.totalTime = performance.now() - metrics.startTime;
+    if (metrics.server) {
+        // Prefer the server's timings: measured at the upstream socket, with real token counts
+        const server = metrics.server;
+        if (server.ttft_ms != null) metrics.ttft = server.ttft_ms;
+        if (server.completion_tokens != null) metrics.tokenCount = server.completion_tokens;
+        metrics.tokensPerSec = server.tokens_per_sec;
+        return;
+    }
+    if (metrics.tokenCount > 0 && metrics.totalTime > 0) {
+        metrics.tokensPerSec = metrics.tokenCount / (metrics.totalTime / 1000);
+    }
+}
+
+// Attach the stream's final server-side timing summary (event: metrics)
+function applyServerMetrics(slotId, metrics, server) {
+    metrics.server = server;
+    const itl = server.itl_ms ? `, inter-token p50 ${server.itl_ms.p50}ms / p95 ${server.itl_ms.p95}ms` : '';
+    log(`[${slotId}] Server timing: connect ${server.connect_ms}ms${server.connection_reused ? ' (reused)' : ''}, TTFB ${server.ttfb_ms}ms, TTFT ${server.ttft_ms}ms${itl}, ${server.completion_tokens} tokens (${server.tokens_source})`, 'info');
+}
+
 // ---------------------------------------------------------------------------
-// Polling — unified, promise-based
+// Polling — server-side job subscription
 // ---------------------------------------------------------------------------
 
+// Read an SSE response body, calling onEvent(eventName, data) for each frame.
+// Frames without an "event:" line are reported as 'message'.
+async function readEventStream(resp, onEvent) {
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop();
+
+        for (const frame of frames) {
+            let eventName = 'message';
+            let dataStr = '';
+            for (const line of frame.split('\n')) {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) dataStr += line.slice(6);
+            }
+            if (!dataStr) continue;
+            try {
+                onEvent(eventName, JSON.parse(dataStr));
+            } catch (e) {
+                // Skip unparseable frames
+            }
+        }
+    }
+}
+
 async function pollLoop(slotId, requestId) {
     const slot = slots[slotId];
     slot.polling = true;
+    slot.jobRequestId = requestId;
     const def = slot.definition;
-    const interval = def.interaction.poll_interval_ms || 2000;
     const metrics = { startTime: performance.now(), submitTime: null, pollCount: 0, totalTime: null };
-    log(`[${slotId}] Polling every ${interval}ms...`, 'info');
-
-    let consecutiveErrors = 0;
-    const MAX_POLL_ERRORS = 10;
+    log(`[${slotId}] Waiting for job updates (server polls every ${def.interaction.poll_interval_ms || 2000}ms)...`, 'info');
 
-    while (slot.polling) {
-        try {
-            metrics.pollCount++;
-            const url = `/api/status?definition_id=${def.id}&request_id=${encodeURIComponent(requestId)}`;
-            const resp = await fetch(url);
-            const data = await resp.json();
-            consecutiveErrors = 0;
-
-            log(`[${slotId}] Status: ${data.poll_status} (poll #${metrics.pollCount})`, 'info');
+    slot.abortController = new AbortController();
+    let finished = false;
+    let reconnect = true;
 
-            if (data.poll_status === 'done') {
-                metrics.totalTime = performance.now() - metrics.startTime;
-                log(`[${slotId}] Job complete. Fetching result...`, 'response');
-                await fetchResult(slotId, requestId);
-                renderMetrics(metrics, getSlotElement(slotId, 'metrics'));
+    try {
+        const url = `/api/jobs/events?definition_id=${def.id}&request_id=${encodeURIComponent(requestId)}`;
+        // The server asks us to reconnect when the worker we're attached to shuts down
+        while (reconnect && !finished && slot.polling) {
+            reconnect = false;
+            const resp = await fetch(url, { signal: slot.abortController.signal });
+            if (!resp.ok) {
+                const errData = await resp.json();
+                showSlotError(slotId, errData.error || 'Failed to subscribe to job.');
                 slot.polling = false;
                 return;
             }
 
-            if (data.poll_status === 'failed' || data.poll_status === 'error') {
-                log(`[${slotId}] Job failed.`, 'error');
-                showSlotError(slotId, 'Generation failed. Check the log for details.');
-                slot.polling = false;
-                return;
-            }
-        } catch (e) {
-            consecutiveErrors++;
-            log(`[${slotId}] Poll error: ${e.message}`, 'error');
-            if (consecutiveErrors >= MAX_POLL_ERRORS) {
-                showSlotError(slotId, 'Polling failed after too many errors.');
-                slot.polling = false;
-                return;
-            }
+            await readEventStream(resp, (event, data) => {
+                if (event === 'status') {
+                    metrics.pollCount = data.poll_count;
+                    log(`[${slotId}] Status: ${data.poll_status} (poll #${data.poll_count})`, 'info');
+                } else if (event === 'result') {
+                    finished = true;
+                    metrics.pollCount = data.poll_count;
+                    metrics.totalTime = performance.now() - metrics.startTime;
+                    log(`[${slotId}] Job complete.`, 'response');
+                    showJobResult(slotId, data);
+                    renderMetrics(metrics, getSlotElement(slotId, 'metrics'));
+                } else if (event === 'error') {
+                    finished = true;
+                    log(`[${slotId}] Job failed: ${data.error}`, 'error');
+                    showSlotError(slotId, data.poll_status === 'failed' ? 'Generation failed. Check the log for details.' : data.error);
+                } else if (event === 'reconnect') {
+                    reconnect = true;
+                    log(`[${slotId}] Server restarting, reconnecting to job updates...`, 'info');
+                }
+            });
         }
 
-        await new Promise(r => setTimeout(r, interval));
+        if (!finished && slot.polling) {
+            showSlotError(slotId, 'Job updates ended unexpectedly.');
+        }
+    } catch (e) {
+        if (e.name === 'AbortError') return;
+        log(`[${slotId}] Job subscription error: ${e.message}`, 'error');
+        showSlotError(slotId, 'Lost connection to job updates.');
     }
+    slot.polling = false;
+    slot.jobRequestId = null;
 }
 
-async function fetchResult(slotId, requestId) {
+function showJobResult(slotId, data) {
     const slot = slots[slotId];
-    const def = slot.definition;
-
-    try {
-        const url = `/api/result?definition_id=${def.id}&request_id=${encodeURIComponent(requestId)}`;
-        const resp = await fetch(url);
-        const data = await resp.json();
-
-        slot.lastResponse = data.response;
+    slot.lastResponse = data.response;
 
-        if (data.outputs && data.outputs.length > 0) {
-            renderOutputs(data.outputs, slotId);
-        } else {
-            log(`[${slotId}] No outputs extracted from response.`, 'error');
-            renderRawFallback(data.response, slotId);
-        }
-    } catch (e) {
-        log(`[${slotId}] Result fetch error: ${e.message}`, 'error');
-        showSlotError(slotId, 'Failed to fetch result.');
+    if (data.outputs && data.outputs.length > 0) {
+        renderOutputs(data.outputs, slotId);
+    } else {
+        log(`[${slotId}] No outputs extracted from response.`, 'error');
+        renderRawFallback(data.response, slotId);
     }
 }
 
@@ -1447,7 +1542,12 @@ function renderOutputs(outputs, slotId) {
 }
 
 function isSafeUrl(url) {
-    return typeof url === 'string' && (url.startsWith('https://') || url.startsWith('http://') || url.startsWith('data:'));
+    return typeof url === 'string' && (url.startsWith('https://') || url.startsWith('http://') || url.startsWith('data:') || isLocalMediaUrl(url));
+}
+
+// Media served by the local proxy (streamed binary passthrough, content-addressed store)
+function isLocalMediaUrl(url) {
+    return url.startsWith('/api/media/') || url.startsWith('/media/');
 }
 
 function createImageRenderer(url, downloadable) {
@@ -1501,7 +1601,7 @@ function createVideoRenderer(url, downloadable) {
 
 function createAudioRenderer(url, downloadable) {
     // Convert raw base64 to a playable data URL
-    if (url && !url.startsWith('data:') && !url.startsWith('http')) {
+    if (url && !url.startsWith('data:') && !url.startsWith('http') && !isLocalMediaUrl(url)) {
         url = `data:audio/wav;base64,${url}`;
     }
 
@@ -2203,16 +2303,130 @@ async function onCompareGenerate() {
     if (leftErr) leftErr.classList.add('hidden');
     if (rightErr) rightErr.classList.add('hidden');
 
-    // Execute both sides in parallel
-    const results = await Promise.allSettled([
-        executeGenerate('left', leftParams),
-        executeGenerate('right', rightParams),
+    // Run both sides through one server-side fan-out so they start at the same instant
+    await runCompare([
+        { slotId: 'left', params: leftParams },
+        { slotId: 'right', params: rightParams },
     ]);
 
     log('Compare generation complete.', 'info');
     setGenerating(false);
 }
 
+// POST every side to /api/compare and route the multiplexed SSE frames back to
+// their slots by index. Metrics for all sides share one start time.
+async function runCompare(sides) {
+    const startTime = performance.now();
+    const controller = new AbortController();
+    const states = sides.map(({ slotId, params }) => {
+        const slot = slots[slotId];
+        slot.abortController = controller;
+        slot.lastSentParams = { definitionId: slot.definition.id, params };
+        const streaming = slot.definition.interaction.pattern === 'streaming' && streamEnabled;
+        log(`[${slotId}] POST /api/compare (${slot.definition.name})`, 'request');
+        return {
+            slotId,
+            stream: null, // { textBlock, textNode } once the first token arrives
+            fullText: '',
+            polling: false,
+            metrics: streaming
+                ? { startTime, ttft: null, tokenCount: 0, totalTime: null, tokensPerSec: null }
+                : { startTime, submitTime: null, pollCount: 0, totalTime: null },
+        };
+    });
+
+    function onEvent(event, data) {
+        const state = states[data.slot];
+        if (!state) {
+            if (event === 'end') log('All compare slots finished.', 'response');
+            return;
+        }
+        const { slotId, metrics } = state;
+        const slot = slots[slotId];
+
+        if (event === 'message' && data.token) {
+            if (!state.stream) state.stream = createStreamingBlock(slotId);
+            if (metrics.ttft === null) metrics.ttft = performance.now() - startTime;
+            metrics.tokenCount += data.n || 1;
+            state.fullText += data.token;
+            state.stream.textNode.appendData(data.token);
+            state.stream.textBlock.scrollTop = state.stream.textBlock.scrollHeight;
+        } else if (event === 'metrics') {
+            applyServerMetrics(slotId, metrics, data.metrics);
+        } else if (event === 'done') {
+            finishStreamMetrics(metrics);
+            if (state.stream) state.stream.textBlock.classList.remove('streaming-cursor');
+            slot.lastResponse = { text: state.fullText };
+            log(`[${slotId}] Streamed ${state.fullText.length} chars, ${metrics.tokenCount} tokens in ${(metrics.totalTime/1000).toFixed(2)}s`, 'response');
+            renderMetrics(metrics, getSlotElement(slotId, 'metrics'));
+        } else if (event === 'submitted') {
+            state.polling = true;
+            slot.polling = true;
+            slot.jobRequestId = data.request_id;
+            metrics.submitTime = performance.now() - startTime;
+            log(`[${slotId}] Job submitted in ${metrics.submitTime.toFixed(0)}ms. request_id: ${data.request_id}`, 'info');
+        } else if (event === 'status') {
+            metrics.pollCount = data.poll_count;
+            log(`[${slotId}] Status: ${data.poll_status} (poll #${data.poll_count})`, 'info');
+        } else if (event === 'result') {
+            metrics.totalTime = performance.now() - startTime;
+            if (state.polling) {
+                slot.polling = false;
+                slot.jobRequestId = null;
+                metrics.pollCount = data.poll_count;
+                log(`[${slotId}] Job complete.`, 'response');
+                showJobResult(slotId, data);
+            } else {
+                if (data.cache && data.cache.hit) {
+                    log(`[${slotId}] Served from ${data.cache.tier} cache (${data.cache.age_seconds}s old)`, 'info');
+                }
+                slot.lastResponse = data.response;
+                if (data.outputs && data.outputs.length > 0) {
+                    renderOutputs(data.outputs, slotId);
+                } else {
+                    renderOutputs([{type: 'text', value: [JSON.stringify(data.response, null, 2)]}], slotId);
+                }
+            }
+            renderMetrics(metrics, getSlotElement(slotId, 'metrics'));
+        } else if (event === 'error') {
+            slot.polling = false;
+            slot.jobRequestId = null;
+            if (state.stream) state.stream.textBlock.classList.remove('streaming-cursor');
+            log(`[${slotId}] Failed: ${typeof data.error === 'string' ? data.error : JSON.stringify(data.error)}`, 'error');
+            if (data.poll_status === 'failed') {
+                showSlotError(slotId, 'Generation failed. Check the log for details.');
+            } else {
+                showSlotError(slotId, typeof data.error === 'string' ? data.error : JSON.stringify(data.error));
+            }
+        }
+    }
+
+    try {
+        const resp = await fetch('/api/compare', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                slots: sides.map(({ slotId, params }) => ({
+                    definition_id: slots[slotId].definition.id,
+                    params,
+                    stream: streamEnabled,
+                })),
+            }),
+            signal: controller.signal,
+        });
+        if (!resp.ok) {
+            const errData = await resp.json();
+            showError(errData.error || 'Compare request failed');
+            return;
+        }
+        await readEventStream(resp, onEvent);
+    } catch (e) {
+        if (e.name === 'AbortError') return;
+        log(`Compare stream error: ${e.message}`, 'error');
+        showError(e.message);
+    }
+}
+
 function collectSideParams(side, params) {
     const container = document.getElementById(`compare${side}Params`);
     if (!container) return;
@@ -2266,6 +2480,9 @@ async function executeGenerate(slotId, params) {
             const data = await resp.json();
             const submitTime = performance.now() - syncStart;
             slot.lastSentParams = { definitionId: def.id, params };
+            if (data.cache && data.cache.hit) {
+                log(`[${slotId}] Served from ${data.cache.tier} cache (${data.cache.age_seconds}s old)`, 'info');
+            }
 
             if (data.error) {
                 showSlotError(slotId, typeof data.error === 'string' ? data.error : JSON.stringify(data.error));
@@ -2308,19 +2525,6 @@ async function loadBookmarks() {
     return bookmarks;
 }
 
-async function saveBookmarksToServer(arr) {
-    bookmarks = arr;
-    try {
-        await fetch('/api/bookmarks', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(arr),
-        });
-    } catch (e) {
-        log('Failed to save bookmarks: ' + e.message, 'error');
-    }
-}
-
 function collectFormParams(container) {
     const params = {};
     const fields = container.querySelectorAll('[data-param-name]');
@@ -2480,13 +2684,30 @@ async function restoreBookmark(bookmark) {
 async function addBookmark(name) {
     const state = captureBookmarkState();
     state.name = name;
-    bookmarks.push(state);
-    await saveBookmarksToServer(bookmarks);
+    try {
+        const resp = await fetch('/api/bookmarks', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(state),
+        });
+        if (!resp.ok) throw new Error((await resp.json()).error || resp.statusText);
+        bookmarks.push(await resp.json());
+    } catch (e) {
+        log('Failed to save bookmark: ' + e.message, 'error');
+    }
 }
 
 async function deleteBookmark(index) {
-    bookmarks.splice(index, 1);
-    await saveBookmarksToServer(bookmarks);
+    const bookmark = bookmarks[index];
+    if (!bookmark) return;
+    try {
+        const resp = await fetch(`/api/bookmarks/${bookmark.id}`, { method: 'DELETE' });
+        // 404: already deleted from another tab
+        if (!resp.ok && resp.status !== 404) throw new Error((await resp.json()).error || resp.statusText);
+        bookmarks.splice(bookmarks.indexOf(bookmark), 1);
+    } catch (e) {
+        log('Failed to delete bookmark: ' + e.message, 'error');
+    }
 }
 
 function generateBookmarkSubtitle(bookmark) {
@@ -0,0 +1,427 @@
+"""Asyncio engine that multiplexes upstream SSE streams on one event loop.
+
+Flask routes stay synchronous: open_stream() schedules the upstream request
+on a shared background event loop and returns an UpstreamStream once the
+provider's response headers arrive. Socket reads, TLS and line splitting
+happen on the loop; lines are handed to the route over a thread-safe queue.
+Slow provider streams therefore cost one loop thread rather than one
+blocked requests call each. The browser side is still WSGI: every SSE
+client holds a server thread until its stream ends (see serve.py's
+ARCADE_THREADS). Lines are buffered up to MAX_BUFFERED_LINES per stream;
+past that the loop stops reading from the provider until the route
+catches up, so a stalled client pushes back on the upstream socket
+instead of growing memory.
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import json as jsonlib
+import logging
+import os
+import queue
+import ssl
+import threading
+import time
+
+import aiohttp
+import certifi
+import requests as http_requests
+
+from proxy import compile_path
+from upstream import POOL_IDLE_SECONDS, POOL_MAXSIZE
+
+# Default token coalescing for /api/stream (0 = one frame per upstream chunk)
+COALESCE_MS = int(os.getenv("ARCADE_STREAM_COALESCE_MS", "0"))
+COALESCE_BYTES = int(os.getenv("ARCADE_STREAM_COALESCE_BYTES", "0"))
+
+# Lines held per stream before reading from the provider pauses
+MAX_BUFFERED_LINES = 1024
+
+_END = object()
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamStream:
+    """A streaming upstream response, readable from a synchronous thread.
+
+    Mirrors the parts of requests.Response used by the /api/stream route:
+    ok, status_code, text, json() and iter_lines().
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._lines = queue.Queue()  # bounded by _wait_for_room(), not maxsize: errors and _END must never block
+        self._room = None  # asyncio.Event set when _lines has room again (loop thread)
+        self._ready = concurrent.futures.Future()
+        self._task = None
+        self.status_code = None
+        self.headers = {}
+        self.text = ""
+        # time.monotonic() timestamps taken on the event loop as events happen
+        self.started = None  # request handed to aiohttp
+        self.connected = None  # connection acquired (new or reused)
+        self.connection_reused = None
+        self.headers_at = None  # response headers received
+        self.first_byte_at = None  # first body bytes received
+        self.line_time = None  # arrival time of the line last yielded by iter_lines()
+
+    @property
+    def ok(self):
+        return self.status_code is not None and self.status_code < 400
+
+    def json(self):
+        return jsonlib.loads(self.text)
+
+    def iter_lines(self, decode_unicode=True, idle=None):
+        """Yield decoded lines as they arrive from the provider.
+
+        idle is an optional callable returning how many seconds to wait for
+        the next line (or None to wait indefinitely). When that wait expires
+        None is yielded instead of a line, letting callers flush timed work.
+        """
+        while True:
+            timeout = idle() if idle else None
+            try:
+                item = self._lines.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+            room = self._room
+            if room is not None and not room.is_set() and self._lines.qsize() <= MAX_BUFFERED_LINES // 2:
+                self._engine._loop.call_soon_threadsafe(room.set)
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            line, self.line_time = item
+            yield line
+
+    def close(self):
+        """Cancel the upstream request and release its connection."""
+        self._engine._cancel(self)
+
+
+class TokenCoalescer:
+    """Batch streamed tokens into fewer SSE frames.
+
+    The first token is released immediately so time-to-first-token is
+    unchanged. After that, tokens are held until window_ms has passed since
+    the last flush or max_bytes have accumulated, whichever comes first.
+    With both limits at 0 every token is released as it arrives.
+    """
+
+    def __init__(self, window_ms=0, max_bytes=0):
+        self.window = max(window_ms, 0) / 1000
+        self.max_bytes = max(max_bytes, 0)
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = None  # None until the first token goes out
+
+    @property
+    def enabled(self):
+        return self.window > 0 or self.max_bytes > 0
+
+    def add(self, token):
+        """Queue a token. Returns (text, count) to send now, or None to hold it."""
+        if not self.enabled or self._last_flush is None:
+            self._last_flush = time.monotonic()
+            return token, 1
+        self._pending.append(token)
+        self._pending_bytes += len(token.encode("utf-8"))
+        if self.max_bytes and self._pending_bytes >= self.max_bytes:
+            return self.flush()
+        if self.window and time.monotonic() - self._last_flush >= self.window:
+            return self.flush()
+        return None
+
+    def wait_time(self):
+        """Seconds until held tokens are due, or None when nothing is held."""
+        if not self._pending or not self.window:
+            return None
+        return max(self._last_flush + self.window - time.monotonic(), 0)
+
+    def flush(self):
+        """Release held tokens as (text, count), or None if there are none."""
+        if not self._pending:
+            return None
+        text, count = "".join(self._pending), len(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = time.monotonic()
+        return text, count
+
+
+class StreamTimer:
+    """Server-side timing and token accounting for one upstream stream.
+
+    Times come from the stream engine's own timestamps, so proxy overhead
+    and browser latency are excluded. Token counts prefer the provider's
+    usage block (read from whichever chunk carries it, usually the last);
+    without one, each token-bearing chunk counts as one token.
+    """
+
+    def __init__(self, definition):
+        usage_path = definition.get("interaction", {}).get("usage_path", "$.usage")
+        self._usage_path = compile_path(usage_path) if usage_path else None
+        self.chunks = 0
+        self.token_chunks = 0
+        self.first_token_at = None
+        self.last_token_at = None
+        self._gaps = []  # seconds between consecutive token-bearing chunks
+        self.usage = None
+
+    def chunk(self, data, arrived, has_token):
+        """Record one parsed upstream chunk that arrived at time arrived."""
+        self.chunks += 1
+        if self._usage_path is not None:
+            usage = self._usage_path.extract(data)
+            if isinstance(usage, dict):
+                self.usage = usage
+        if has_token:
+            self.token_chunks += 1
+            if self.first_token_at is None:
+                self.first_token_at = arrived
+            else:
+                self._gaps.append(arrived - self.last_token_at)
+            self.last_token_at = arrived
+
+    def summary(self, stream, finished):
+        """Return the timing summary sent as the stream's final metrics event."""
+        started = stream.started
+
+        def ms(t):
+            return round((t - started) * 1000, 1) if t is not None and started is not None else None
+
+        prompt_tokens = completion_tokens = None
+        if self.usage:
+            prompt_tokens = self.usage.get("prompt_tokens", self.usage.get("input_tokens"))
+            completion_tokens = self.usage.get("completion_tokens", self.usage.get("output_tokens"))
+        tokens = completion_tokens if isinstance(completion_tokens, int) else self.token_chunks
+
+        # Decode rate: tokens after the first, over the time from first to last token
+        tokens_per_sec = None
+        if self.first_token_at is not None and self.last_token_at > self.first_token_at and tokens > 1:
+            tokens_per_sec = round((tokens - 1) / (self.last_token_at - self.first_token_at), 1)
+
+        return {
+            "connect_ms": ms(stream.connected),
+            "connection_reused": stream.connection_reused,
+            "ttfb_ms": ms(stream.first_byte_at or stream.headers_at),
+            "ttft_ms": ms(self.first_token_at),
+            "total_ms": ms(finished),
+            "chunks": self.chunks,
+            "itl_ms": _latency_summary(self._gaps),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": tokens,
+            "tokens_source": "usage" if isinstance(completion_tokens, int) else "chunks",
+            "tokens_per_sec": tokens_per_sec,
+        }
+
+
+def _latency_summary(seconds):
+    """mean/p50/p95/max in milliseconds for a list of durations, or None."""
+    if not seconds:
+        return None
+    ordered = sorted(seconds)
+
+    def pct(p):
+        return round(ordered[min(int(p * len(ordered)), len(ordered) - 1)] * 1000, 1)
+
+    return {
+        "mean": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50": pct(0.5),
+        "p95": pct(0.95),
+        "max": round(ordered[-1] * 1000, 1),
+    }
+
+
+def _trace_config():
+    """aiohttp tracing hooks that timestamp connection setup for a stream."""
+
+    async def on_connection_created(_session, ctx, _params):
+        stream = ctx.trace_request_ctx
+        if stream is not None:
+            stream.connected = time.monotonic()
+            stream.connection_reused = False
+
+    async def on_connection_reused(_session, ctx, _params):
+        stream = ctx.trace_request_ctx
+        if stream is not None:
+            stream.connected = time.monotonic()
+            stream.connection_reused = True
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(on_connection_created)
+    trace.on_connection_reuseconn.append(on_connection_reused)
+    return trace
+
+
+class StreamEngine:
+    """Owns the background event loop and one aiohttp session per provider."""
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+        self._sessions = {}  # provider -> aiohttp.ClientSession (loop thread only)
+        self._active = 0
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="stream-engine", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def active_streams(self):
+        """Number of upstream streams currently open."""
+        return self._active
+
+    def open(self, provider, method, url, headers=None, json=None, timeout=60, total=None, cancellation=None):
+        """Start an upstream request and block until its headers arrive.
+
+        Raises requests.Timeout / requests.ConnectionError on failure so
+        callers can keep catching requests.RequestException, including when
+        the headers, or any later read, take longer than timeout. total, if
+        given, bounds the whole stream: one still running after that many
+        seconds is cut off with a requests.Timeout. A cancellation
+        (deadlines.Cancellation) closes the stream, even while waiting here.
+        """
+        loop = self._ensure_loop()
+        stream = UpstreamStream(self)
+        coro = self._run(stream, provider, method, url, headers, json, timeout, total)
+        stream._task = asyncio.run_coroutine_threadsafe(coro, loop)
+        stream._task.add_done_callback(lambda _task: _fail_unready(stream))
+        if cancellation is not None:
+            cancellation.attach(stream)
+        try:
+            stream._ready.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            stream.close()
+            raise http_requests.Timeout(f"No response headers after {timeout}s") from None
+        return stream
+
+    def shutdown(self):
+        """Close every provider session and stop the event loop."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close_sessions(), loop)
+        try:
+            future.result(timeout=5)
+        except (concurrent.futures.TimeoutError, RuntimeError):
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+
+    async def _close_sessions(self):
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            await session.close()
+
+    def _cancel(self, stream):
+        if stream._task is not None and not stream._task.done():
+            self._loop.call_soon_threadsafe(stream._task.cancel)
+
+    def _session(self, provider):
+        session = self._sessions.get(provider)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=POOL_MAXSIZE,
+                keepalive_timeout=POOL_IDLE_SECONDS,
+                ssl=ssl.create_default_context(cafile=certifi.where()),
+            )
+            session = self._sessions[provider] = aiohttp.ClientSession(
+                connector=connector, trace_configs=[_trace_config()]
+            )
+        return session
+
+    async def _run(self, stream, provider, method, url, headers, body, timeout, total):
+        self._active += 1
+        try:
+            client_timeout = aiohttp.ClientTimeout(total=total, sock_connect=timeout, sock_read=timeout)
+            stream.started = time.monotonic()
+            async with self._session(provider).request(
+                method, url, headers=headers, json=body, timeout=client_timeout, trace_request_ctx=stream
+            ) as resp:
+                stream.headers_at = time.monotonic()
+                stream.status_code = resp.status
+                stream.headers = dict(resp.headers)
+                if resp.status >= 400:
+                    stream.text = await resp.text(errors="replace")
+                    stream._ready.set_result(None)
+                    stream._lines.put(_END)
+                    return
+                stream._ready.set_result(None)
+
+                stream._room = asyncio.Event()
+                buffer = b""
+                async for chunk in resp.content.iter_any():
+                    arrived = time.monotonic()
+                    if stream.first_byte_at is None:
+                        stream.first_byte_at = arrived
+                    buffer += chunk
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        stream._lines.put((line.rstrip(b"\r").decode("utf-8", errors="replace"), arrived))
+                    if stream._lines.qsize() >= MAX_BUFFERED_LINES:
+                        stream._room.clear()
+                        if stream._lines.qsize() >= MAX_BUFFERED_LINES:  # the reader may have drained it meanwhile
+                            await stream._room.wait()
+                if buffer:
+                    stream._lines.put((buffer.rstrip(b"\r").decode("utf-8", errors="replace"), time.monotonic()))
+                stream._lines.put(_END)
+        except asyncio.CancelledError:
+            # A reader still waiting must not mistake a cancelled stream for a finished one
+            error = http_requests.ConnectionError("Upstream request cancelled")
+            if not stream._ready.done():
+                stream._ready.set_exception(error)
+            stream._lines.put(error)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                error = http_requests.Timeout(f"Upstream timed out after {timeout}s")
+            else:
+                error = http_requests.ConnectionError(str(e))
+            if not stream._ready.done():
+                stream._ready.set_exception(error)
+            else:
+                stream._lines.put(error)
+        except Exception as e:
+            # Anything else (a bad URL, an unserializable body) must still reach the waiting thread
+            logger.exception("Upstream stream failed")
+            error = http_requests.ConnectionError(f"Upstream stream failed: {e}")
+            if not stream._ready.done():
+                stream._ready.set_exception(error)
+            else:
+                stream._lines.put(error)
+        finally:
+            self._active -= 1
+
+
+def _fail_unready(stream):
+    """Unblock open() if the request task ended without headers (e.g. cancelled before it ran)."""
+    if not stream._ready.done():
+        try:
+            stream._ready.set_exception(http_requests.ConnectionError("Upstream request cancelled"))
+        except concurrent.futures.InvalidStateError:
+            pass
+
+
+_engine = StreamEngine()
+atexit.register(_engine.shutdown)
+
+
+def open_stream(provider, method, url, headers=None, json=None, timeout=60, total=None, cancellation=None):
+    """Open a streaming upstream request on the shared event loop."""
+    return _engine.open(
+        provider, method, url, headers=headers, json=json, timeout=timeout, total=total, cancellation=cancellation
+    )
+
+
+def active_streams():
+    """Number of upstream streams currently open on the shared event loop."""
+    return _engine.active_streams()
@@ -0,0 +1,121 @@
+"""Pooled, keep-alive HTTP sessions for upstream provider calls.
+
+Each provider gets its own requests.Session so TCP + TLS connections are
+reused across routes (generate, stream, status polls, key validation).
+Sessions with no response for longer than POOL_IDLE_SECONDS, and no
+request still in progress, are closed and dropped.
+"""
+
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of distinct hosts cached per provider (most providers use one or two)
+POOL_CONNECTIONS = int(os.getenv("ARCADE_POOL_CONNECTIONS", "4"))
+# Keep-alive sockets kept open per host
+POOL_MAXSIZE = int(os.getenv("ARCADE_POOL_MAXSIZE", "16"))
+# Close a provider's sessions after this many seconds without use
+POOL_IDLE_SECONDS = float(os.getenv("ARCADE_POOL_IDLE_SECONDS", "300"))
+
+_pools = {}  # provider -> _ProviderPool
+_retired = {}  # provider -> {"requests": n, "connections": n} from evicted pools
+_lock = threading.Lock()
+
+
+class _ProviderPool:
+    """A keep-alive session for one provider plus its last-use timestamp."""
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.created = time.monotonic()
+        self.last_used = self.created
+        # Sessions are handed out long before some of their requests finish
+        # (polls, audio downloads), so every response counts as a use
+        self.session.hooks["response"].append(self._touch)
+
+    def _touch(self, resp, *args, **kwargs):
+        self.last_used = time.monotonic()
+
+    def in_use(self):
+        """Number of connections currently checked out (e.g. a body still being read)."""
+        checked_out = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None and pool.pool is not None:
+                    checked_out += pool.pool.maxsize - pool.pool.qsize()
+        return checked_out
+
+    def counts(self):
+        """Return (requests, new_connections) summed across this session's host pools."""
+        num_requests = 0
+        num_connections = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+        return num_requests, num_connections
+
+
+def _evict_idle(now):
+    """Close sessions idle past POOL_IDLE_SECONDS with no request in progress. Caller holds _lock."""
+    idle = [p for p, pool in _pools.items() if now - pool.last_used > POOL_IDLE_SECONDS and not pool.in_use()]
+    for provider in idle:
+        pool = _pools.pop(provider)
+        num_requests, num_connections = pool.counts()
+        retired = _retired.setdefault(provider, {"requests": 0, "connections": 0})
+        retired["requests"] += num_requests
+        retired["connections"] += num_connections
+        pool.session.close()
+
+
+def session_for(provider):
+    """Return the shared keep-alive session for a provider, creating it on first use."""
+    now = time.monotonic()
+    with _lock:
+        _evict_idle(now)
+        pool = _pools.get(provider)
+        if pool is None:
+            pool = _pools[provider] = _ProviderPool()
+        pool.last_used = now
+        return pool.session
+
+
+def pool_stats():
+    """Return per-provider connection reuse counts.
+
+    A "hit" is a request served on an already-open keep-alive connection;
+    a "miss" is a request that had to open a new connection (TCP + TLS).
+    """
+    now = time.monotonic()
+    stats = {}
+    with _lock:
+        providers = set(_pools) | set(_retired)
+        for provider in sorted(providers):
+            retired = _retired.get(provider, {"requests": 0, "connections": 0})
+            num_requests = retired["requests"]
+            num_connections = retired["connections"]
+            pool = _pools.get(provider)
+            if pool is not None:
+                live_requests, live_connections = pool.counts()
+                num_requests += live_requests
+                num_connections += live_connections
+            stats[provider] = {
+                "requests": num_requests,
+                "hits": max(num_requests - num_connections, 0),
+                "misses": num_connections,
+                "active": pool is not None,
+                "idle_seconds": round(now - pool.last_used, 1) if pool else None,
+            }
+    return stats
@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
-"""Validation harness for arcade definition files."""
+"""Validation harness for arcade definition files.
 
+Files are validated in parallel across processes, and each file's result
+is cached by a hash of its content (and of this validator) in
+.cache/validate.json, so a rerun only checks files that changed.
+
+Usage:
+    python validate.py                              # every file under definitions/
+    python validate.py definitions/openai/          # files or folders
+    python validate.py --json > report.json         # machine-readable report
+"""
+
+import argparse
+import hashlib
 import json
 import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 REQUIRED_TOP_LEVEL = [
     "schema_version", "id", "provider", "name", "auth",
@@ -15,19 +28,42 @@ VALID_UI_TYPES = {"textarea", "dropdown", "slider", "text"}
 VALID_PATTERNS = {"polling", "streaming", "sync"}
 VALID_OUTPUT_TYPES = {"text", "image", "audio", "video"}
 VALID_OUTPUT_SOURCES = {"inline", "url", "base64"}
+VALID_TIMEOUT_KINDS = {"request", "poll", "result", "cancel", "job"}
+
+CACHE_PATH = os.getenv(
+    "ARCADE_VALIDATE_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "validate.json")
+)
+# Cached results kept across runs (old file revisions included) before pruning
+CACHE_MAX_ENTRIES = 100_000
+# Below this many files to check, a process pool costs more than it saves
+MIN_PARALLEL_FILES = 64
 
 
 def validate_definition(path):
     """Validate a single definition file. Returns list of error strings."""
-    errors = []
-
     try:
-        with open(path) as f:
-            defn = json.load(f)
-    except json.JSONDecodeError as e:
-        return [f"Invalid JSON: {e}"]
+        with open(path, "rb") as f:
+            data = f.read()
     except OSError as e:
         return [f"Cannot read file: {e}"]
+    return validate_source(data)[0]
+
+
+def validate_source(data):
+    """Validate one definition file's bytes. Returns (errors, id or None)."""
+    try:
+        defn = json.loads(data)
+    except ValueError as e:  # JSONDecodeError, or bytes that aren't UTF-8
+        return [f"Invalid JSON: {e}"], None
+    if not isinstance(defn, dict):
+        return ["Definition must be a JSON object"], None
+    did = defn.get("id")
+    return check_definition(defn), did if isinstance(did, str) and did else None
+
+
+def check_definition(defn):
+    """Validate a parsed definition. Returns list of error strings."""
+    errors = []
 
     # --- Schema checks ---
     for field in REQUIRED_TOP_LEVEL:
@@ -112,6 +148,12 @@ def validate_definition(path):
             errors.append("status_url must contain {request_id} placeholder")
         if result_url and "{request_id}" not in result_url:
             errors.append("result_url must contain {request_id} placeholder")
+        cancel_url = interaction.get("cancel_url", "")
+        if cancel_url and "{request_id}" not in cancel_url:
+            errors.append("cancel_url must contain {request_id} placeholder")
+        cancel_method = interaction.get("cancel_method")
+        if cancel_method is not None and cancel_method not in ("POST", "DELETE", "PUT"):
+            errors.append("interaction.cancel_method must be POST, DELETE or PUT")
 
         done_when = interaction.get("done_when", {})
         if done_when:
@@ -130,6 +172,9 @@ def validate_definition(path):
     if pattern == "streaming":
         if "stream_path" not in interaction:
             errors.append("Streaming pattern missing: stream_path")
+        usage_path = interaction.get("usage_path")
+        if usage_path is not None and (not isinstance(usage_path, str) or not usage_path.startswith("$")):
+            errors.append("interaction.usage_path must be a JSONPath starting with '$'")
 
     # --- Response checks ---
     response = defn.get("response", {})
@@ -153,6 +198,64 @@ def validate_definition(path):
     elif "path" not in response.get("error", {}):
         errors.append("response.error must have a 'path'")
 
+    # --- Cache checks ---
+    cache = defn.get("cache")
+    if cache is not None:
+        if not isinstance(cache, dict):
+            errors.append("cache must be an object")
+        elif "ttl_seconds" in cache:  # without it the ARCADE_CACHE_TTL default applies
+            ttl = cache["ttl_seconds"]
+            if not isinstance(ttl, (int, float)) or isinstance(ttl, bool) or ttl < 0:
+                errors.append("cache.ttl_seconds must be a non-negative number")
+
+    # --- Rate limit checks ---
+    rate_limit = defn.get("rate_limit")
+    if rate_limit is not None:
+        if not isinstance(rate_limit, dict):
+            errors.append("rate_limit must be an object")
+        else:
+            for field in ("requests_per_minute", "tokens_per_minute", "max_concurrency"):
+                value = rate_limit.get(field)
+                if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0):
+                    errors.append(f"rate_limit.{field} must be a positive number")
+            retries = rate_limit.get("max_retries")
+            if retries is not None and (not isinstance(retries, int) or isinstance(retries, bool) or retries < 0):
+                errors.append("rate_limit.max_retries must be a non-negative integer")
+
+    # --- Retry checks ---
+    retry = defn.get("retry")
+    if retry is not None:
+        if not isinstance(retry, dict):
+            errors.append("retry must be an object")
+        else:
+            attempts = retry.get("max_attempts")
+            if attempts is not None and (not isinstance(attempts, int) or isinstance(attempts, bool) or attempts < 1):
+                errors.append("retry.max_attempts must be a positive integer")
+            for field in ("backoff_ms", "hedge_after_ms"):
+                value = retry.get(field)
+                if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0):
+                    errors.append(f"retry.{field} must be a positive number")
+            statuses = retry.get("on_status")
+            if statuses is not None and (
+                not isinstance(statuses, list) or not all(isinstance(c, int) and 500 <= c <= 599 for c in statuses)
+            ):
+                errors.append("retry.on_status must be a list of 5xx status codes")
+            for field in ("hedge", "idempotent"):
+                if field in retry and not isinstance(retry[field], bool):
+                    errors.append(f"retry.{field} must be true or false")
+
+    # --- Timeouts checks ---
+    timeouts = defn.get("timeouts")
+    if timeouts is not None:
+        if not isinstance(timeouts, dict):
+            errors.append("timeouts must be an object")
+        else:
+            for kind, value in timeouts.items():
+                if kind not in VALID_TIMEOUT_KINDS:
+                    errors.append(f"timeouts.{kind} not in {VALID_TIMEOUT_KINDS}")
+                elif not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+                    errors.append(f"timeouts.{kind} must be a positive number of seconds")
+
     # --- Examples checks ---
     examples = defn.get("examples", [])
     if not examples:
@@ -210,56 +313,144 @@ def find_all_definitions(defs_dir):
     return paths
 
 
-def main():
-    if len(sys.argv) > 1:
-        paths = [sys.argv[1]]
-    else:
-        defs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "definitions")
-        paths = find_all_definitions(defs_dir)
+# ---------------------------------------------------------------------------
+# Result cache (content hash -> errors and id)
+# ---------------------------------------------------------------------------
 
-    if not paths:
-        print("No definition files found.")
-        sys.exit(1)
 
-    total = 0
-    passed = 0
-    all_ids = {}
-    all_errors = []
+def _validator_version():
+    """Hash of this file, so editing the rules invalidates every cached result."""
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_cache(path, version):
+    """Return {sha256: {"errors": [...], "id": ...}}, or {} if missing or stale."""
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("validator") != version:
+        return {}
+    results = cache.get("results")
+    return results if isinstance(results, dict) else {}
 
-    for path in paths:
-        rel = os.path.relpath(path)
-        print(f"Validating {rel}")
-        errors = validate_definition(path)
 
-        # Collect ids for cross-definition duplicate check
+def save_cache(path, version, results):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump({"validator": version, "results": results}, f, separators=(",", ":"))
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not write validation cache {path}: {e}", file=sys.stderr)
+
+
+# ---------------------------------------------------------------------------
+# Run
+# ---------------------------------------------------------------------------
+
+
+def validate_paths(paths, jobs=None, cache_path=CACHE_PATH):
+    """Validate files, reusing cached results for unchanged content.
+
+    Files not in the cache are validated across a pool of jobs processes
+    (default: one per CPU). Returns one report per path, in order:
+    {"path", "id", "errors", "cached"}. Duplicate ids are reported on every
+    file after the first that uses them.
+    """
+    version = _validator_version()
+    cache = load_cache(cache_path, version) if cache_path else {}
+    reports = []
+    digests = []
+    misses = {}  # sha256 -> file bytes
+    for path in paths:
+        report = {"path": path, "id": None, "errors": [], "cached": False}
+        reports.append(report)
         try:
-            with open(path) as f:
-                defn = json.load(f)
-            did = defn.get("id", "")
-            if did:
-                if did in all_ids:
-                    errors.append(f"Duplicate id '{did}' (also in {os.path.relpath(all_ids[did])})")
-                else:
-                    all_ids[did] = path
-        except (json.JSONDecodeError, OSError):
-            pass
-
-        total += 1
-        if errors:
-            for e in errors:
-                print(f"  \u2717 {e}")
-            print(f"  {len(errors)} error(s) found.\n")
-            all_errors.extend(errors)
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            report["errors"] = [f"Cannot read file: {e}"]
+            digests.append(None)
+            continue
+        digest = hashlib.sha256(data).hexdigest()
+        digests.append(digest)
+        if digest in cache:
+            report["cached"] = True
+        else:
+            misses[digest] = data
+
+    if misses:
+        jobs = jobs or os.cpu_count() or 1
+        if jobs > 1 and len(misses) >= MIN_PARALLEL_FILES:
+            chunksize = max(1, len(misses) // (jobs * 4))
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(validate_source, misses.values(), chunksize=chunksize))
         else:
-            print("  \u2713 Schema valid")
-            print("  \u2713 Interaction valid")
-            print("  \u2713 Response valid")
-            print("  \u2713 Examples valid")
-            print()
-            passed += 1
-
-    print(f"{passed}/{total} definitions valid.")
-    sys.exit(0 if passed == total else 1)
+            results = [validate_source(data) for data in misses.values()]
+        for digest, (errors, did) in zip(misses, results):
+            cache[digest] = {"errors": errors, "id": did}
+
+    seen_ids = {}
+    for report, digest in zip(reports, digests):
+        if digest is None:
+            continue
+        result = cache[digest]
+        report["id"] = result["id"]
+        report["errors"] = list(result["errors"])
+        did = result["id"]
+        if did:
+            if did in seen_ids:
+                report["errors"].append(f"Duplicate id '{did}' (also in {os.path.relpath(seen_ids[did])})")
+            else:
+                seen_ids[did] = report["path"]
+
+    if cache_path and misses:
+        if len(cache) > CACHE_MAX_ENTRIES:
+            # Keep only this run's files; results for old revisions would otherwise pile up
+            cache = {d: cache[d] for d in digests if d is not None}
+        save_cache(cache_path, version, cache)
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="definition files or folders (default: definitions/)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--json", action="store_true", help="print a JSON report instead of text")
+    parser.add_argument("--no-cache", action="store_true", help="revalidate every file, ignoring the cache")
+    args = parser.parse_args()
+
+    paths = []
+    for target in args.paths or [os.path.join(os.path.dirname(os.path.abspath(__file__)), "definitions")]:
+        paths.extend(find_all_definitions(target) if os.path.isdir(target) else [target])
+
+    if not paths:
+        print("No definition files found.")
+        sys.exit(1)
+
+    reports = validate_paths(paths, args.jobs, None if args.no_cache else CACHE_PATH)
+    failed = [r for r in reports if r["errors"]]
+
+    if args.json:
+        json.dump({
+            "total": len(reports),
+            "valid": len(reports) - len(failed),
+            "cached": sum(r["cached"] for r in reports),
+            "definitions": [dict(r, path=os.path.relpath(r["path"])) for r in reports],
+        }, sys.stdout, indent=2)
+        print()
+    else:
+        for report in failed:
+            print(f"\u2717 {os.path.relpath(report['path'])}")
+            for e in report["errors"]:
+                print(f"    {e}")
+        cached = sum(r["cached"] for r in reports)
+        print(f"{len(reports) - len(failed)}/{len(reports)} definitions valid ({cached} unchanged since last run).")
+    sys.exit(1 if failed else 0)
 
 
 if __name__ == "__main__":